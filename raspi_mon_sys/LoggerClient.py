@@ -32,17 +32,87 @@ The default configuration is as follows:
 >>> logger.config(logger.levels.WARNING, logger.schedules.INSTANTANEOUSLY)
 >>> logger.config(logger.levels.ERROR, logger.schedules.INSTANTANEOUSLY)
 
+Messages of levels configured as SILENTLY are discarded before formatting them.
+The rest are stored in a bounded ring buffer and a background thread, woken up
+by `write()`, sends them to the server FLUSH_INTERVAL seconds later, in batches
+of ZMQ multipart messages, so writing never blocks the caller. When the server
+doesn't keep up, the oldest messages of the ring are dropped and counted in
+`logger.dropped`, and a WARNING message with the number of dropped messages is
+sent afterwards.
+
+Every batch is a multipart message using a compact binary format, encoded by
+`encode_batch()` and decoded by the servers with `decode_batch()`. Its first
+frame is the version byte followed by the NUL separated names of the batch, and
+every other frame is a message record, a packed header with the version, a
+level/schedule byte, the index of its name and its timestamp in milliseconds
+since epoch, followed by the UTF-8 text.
+
+The background thread keeps the client alive, so `logger.close()` must always
+be called to send the pending messages and release the thread and the socket.
 """
 from enum import Enum
 
+import collections
 import datetime
+import struct
 import threading
+import time
 import zmq
 
 default_transport = "ipc:///tmp/zmq_logger_server.ipc"
 levels = Enum('DEBUG', 'INFO', 'ALERT', 'WARNING', 'ERROR')
 schedules = Enum('SILENTLY', 'INSTANTANEOUSLY', 'HOURLY', 'DAILY', 'WEEKLY')
 
+RING_SIZE = 4096      # maximum number of messages waiting to be sent
+FLUSH_INTERVAL = 0.05 # seconds a flush waits for more messages to batch
+MAX_BATCH_SIZE = 256  # maximum number of messages in a multipart message
+
+WIRE_VERSION = 1
+_RECORD = struct.Struct("!BBHQ") # version, level<<4 | schedule, name id, epoch ms
+
+_level_codes = dict( (l,i) for i,l in enumerate(levels) )
+_level_names = [ str(l) for l in levels ]
+_schedule_codes = dict( (s,i) for i,s in enumerate(schedules) )
+_schedule_names = [ str(s) for s in schedules ]
+
+def encode_batch(names, records):
+    """Encodes a list of (name id, level, schedule, text, timestamp) records
+    as a list of frames for a ZMQ multipart message. Name ids are indices in the
+    given list of names."""
+    frames = [ chr(WIRE_VERSION) + "\0".join(n.encode("utf-8") if isinstance(n, unicode) else n
+                                             for n in names) ]
+    for name_id, level, schedule, text, timestamp in records:
+        if isinstance(text, unicode): text = text.encode("utf-8")
+        code = _level_codes[level] << 4 | _schedule_codes[schedule]
+        frames.append( _RECORD.pack(WIRE_VERSION, code, name_id,
+                                    int(timestamp * 1000)) + text )
+    return frames
+
+def decode_batch(frames):
+    """Decodes the frames of a multipart message into a list of dictionaries
+    with name, level, schedule, text and datetime fields. It raises ValueError
+    when the frames are malformed or use an unknown version."""
+    if len(frames) == 0 or len(frames[0]) == 0 or ord(frames[0][0]) != WIRE_VERSION:
+        raise ValueError("Unknown logger wire format version")
+    names = frames[0][1:].split("\0")
+    fromtimestamp = datetime.datetime.fromtimestamp
+    result = []
+    try:
+        for frame in frames[1:]:
+            version, code, name_id, ms = _RECORD.unpack_from(frame)
+            if version != WIRE_VERSION:
+                raise ValueError("Unknown logger wire format version")
+            result.append({
+                "name"     : names[name_id],
+                "level"    : _level_names[code >> 4],
+                "schedule" : _schedule_names[code & 0x0F],
+                "text"     : frame[_RECORD.size:],
+                "datetime" : fromtimestamp(ms / 1000.0)
+            })
+    except (struct.error, IndexError):
+        raise ValueError("Malformed logger message")
+    return result
+
 class LoggerClient:
     """This class implements the interface to communicate with a MailLoggerServer or
     ScreenLoggerServer."""
@@ -51,11 +121,11 @@ class LoggerClient:
         """Initializes connection with server using the given transport and
         builds a default mapping between levels and schedules."""
         self.__level2schedule = {
-            str(levels.DEBUG)   : schedules.SILENTLY,
-            str(levels.INFO)    : schedules.DAILY,
-            str(levels.ALERT)   : schedules.INSTANTANEOUSLY,
-            str(levels.WARNING) : schedules.INSTANTANEOUSLY,
-            str(levels.ERROR)   : schedules.INSTANTANEOUSLY
+            levels.DEBUG   : schedules.SILENTLY,
+            levels.INFO    : schedules.DAILY,
+            levels.ALERT   : schedules.INSTANTANEOUSLY,
+            levels.WARNING : schedules.INSTANTANEOUSLY,
+            levels.ERROR   : schedules.INSTANTANEOUSLY
         }
         ctx = zmq.Context.instance()
         self.__s = ctx.socket(zmq.PUSH)
@@ -63,21 +133,60 @@ class LoggerClient:
         self.__transport = transport
         self.__lock = threading.RLock()
         self.__name = name
+        self.__ring = collections.deque(maxlen=RING_SIZE)
+        self.__batch = []
+        self.__reported_drops = 0
+        self.dropped = 0
         self.levels = levels
         self.schedules = schedules
+        self.__running = True
+        self.__wakeup = threading.Event()
+        self.__flusher = threading.Thread(target=self.__flush_loop)
+        self.__flusher.setDaemon(True)
+        self.__flusher.start()
 
-    def __del__(self):
-        self.close()
+    def __take_batch(self):
+        """Removes up to MAX_BATCH_SIZE messages from the ring and serializes them."""
+        batch = []
+        if self.dropped > self.__reported_drops:
+            text = "%d log messages dropped" % (self.dropped - self.__reported_drops)
+            self.__reported_drops = self.dropped
+            batch.append( (0, levels.WARNING, self.__level2schedule[levels.WARNING],
+                           text, time.time()) )
+        try:
+            while len(batch) < MAX_BATCH_SIZE:
+                batch.append( (0,) + self.__ring.popleft() )
+        except IndexError:
+            pass
+        if len(batch) == 0: return []
+        return encode_batch([self.__name], batch)
+
+    def __flush(self):
+        """Sends all the messages of the ring without blocking. When the server
+        doesn't keep up, the pending batch is retried in the next flush."""
+        while True:
+            if len(self.__batch) == 0:
+                self.__batch = self.__take_batch()
+                if len(self.__batch) == 0: return
+            try:
+                self.__s.send_multipart(self.__batch, zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.__batch = []
+
+    def __flush_loop(self):
+        """Sleeps until write() signals new messages, waiting FLUSH_INTERVAL
+        seconds more to batch them. A batch which couldn't be sent is retried
+        every FLUSH_INTERVAL seconds."""
+        wakeup = self.__wakeup
+        while self.__running:
+            if len(self.__batch) == 0: wakeup.wait()
+            else: wakeup.wait(FLUSH_INTERVAL)
+            wakeup.clear()
+            if not self.__running: break
+            time.sleep(FLUSH_INTERVAL)
+            self.__flush()
 
-    def __generate_message(self, name, level, schedule, text):
-        return {
-            "name"     : name,
-            "level"    : str(level),
-            "schedule" : str(schedule),
-            "text"     : text,
-            "datetime" : datetime.datetime.now()
-        }
-        
     def clone(self):
         """Returns a deep copy of the caller object."""
         other = LoggerClient(self.__name, self.__transport)
@@ -91,22 +200,27 @@ class LoggerClient:
         if not level in levels or not schedule in schedules:
             raise Exception("Needs a level and a schedule as arguments")
         self.__lock.acquire()
-        self.__level2schedule[str(level)] = schedule
+        self.__level2schedule[level] = schedule
         self.__lock.release()
 
+    def enabled(self, level):
+        """Returns True when messages of the given level are not discarded, so
+        expensive messages can be skipped before formatting them."""
+        return self.__level2schedule[level] != schedules.SILENTLY
+
     def write(self, level, strfmt, *args):
         """Writes a text string using the given level.
         
         This function implements kind of printf(), so it receives a string
-        format and a variadic list of values.
+        format and a variadic list of values. The message is only formatted when
+        its level is not SILENTLY, and it is sent by a background thread.
         """
-        self.__lock.acquire()
-        schedule = self.__level2schedule[str(level)]
-        if schedule != schedules.SILENTLY:
-            text = strfmt % args
-            msg = self.__generate_message(self.__name, level, schedule, text)
-            self.__s.send_pyobj(msg)
-        self.__lock.release()
+        schedule = self.__level2schedule[level]
+        if schedule == schedules.SILENTLY: return
+        ring = self.__ring
+        if len(ring) == RING_SIZE: self.dropped += 1
+        ring.append( (level, schedule, strfmt % args, time.time()) )
+        if not self.__wakeup.is_set(): self.__wakeup.set()
 
     def debug(self, strfmt, *args):
         """Writes a text string at DEBUG level.
@@ -149,9 +263,16 @@ class LoggerClient:
         self.write(levels.ERROR, strfmt, *args)
 
     def close(self):
-        """Terminates connection with MailLoggerServer or ScreenLoggerServer."""
+        """Sends pending messages, stops the background thread and terminates
+        connection with MailLoggerServer or ScreenLoggerServer. It must be
+        called always, the client is never released otherwise."""
         self.__lock.acquire()
         if self.__s is not None:
+            self.__running = False
+            self.__wakeup.set()
+            if self.__flusher is not threading.current_thread():
+                self.__flusher.join()
+            self.__flush()
             self.__s.close()
             self.__s = None
         self.__lock.release()
@@ -5,7 +5,7 @@ This module is executed as:
 
 .. code-block:: bash
 
-   $ python MailLoggerServer.py [mail_credentials [zmq_transport]]
+   $ python MailLoggerServer.py [mail_credentials [zmq_transport [spool_dir]]]
 
 By default it looks for `/etc/mail_credentials.json` if first argument is not
 given and uses a default ZeroMQ transport if second one is given either.
@@ -15,6 +15,21 @@ transport. Messages would be shown at screen using stderr output and they would
 be enqueued for delayed mail delivery, ignored from mail, or sended
 instantaneously.
 
+Instantaneous messages received during COALESCE_WINDOW seconds are sent in a
+single mail, and every logger name has a token bucket of RATE_LIMIT_BURST
+instantaneous messages refilled every RATE_LIMIT_PERIOD seconds, exceeding
+messages being delayed to the hourly mail. Identical messages are collapsed
+into one line with an "(xN)" count, and mails are sent through a pooled SMTP
+session which is kept alive while it is used.
+
+Delayed messages are appended to a spool file per schedule in `spool_dir`,
+which is synced to disk every SPOOL_SYNC_INTERVAL seconds or SPOOL_SYNC_LINES
+messages. When its mail is due, the spool file is renamed as pending and sent
+in mails of at most MAX_MAIL_LINES lines, so memory doesn't grow with the
+number of messages. Pending files which couldn't be sent, including failed
+instantaneous mails, are retried with exponential back-off and replayed when
+the server starts again.
+
 Alternatively, it is possible to import the module from another Python script
 calling directly `start_thread()` function:
 
@@ -22,9 +37,11 @@ calling directly `start_thread()` function:
 >>> server.start_thread()
 """
 import datetime
+import glob
 import json
-import Queue
+import os
 import Scheduler
+import smtplib
 import socket
 import threading
 import time
@@ -37,87 +54,341 @@ import raspi_mon_sys.Utils as Utils
 
 __transport = LoggerClient.default_transport
 __mail_credentials_path = "/etc/mail_credentials.json"
+__spool_dir = "/var/spool/raspimon_mail"
 __mac_addr  = Utils.getmac()
+__host_prefix = "%s %s"%(socket.gethostname(), __mac_addr)
+
+COALESCE_WINDOW   = 10   # seconds to gather instantaneous messages in one mail
+RATE_LIMIT_BURST  = 5    # instantaneous messages allowed at once per logger name
+RATE_LIMIT_PERIOD = 600  # seconds to earn one more instantaneous message
+SMTP_KEEPALIVE    = 60   # seconds between NOOP commands to the pooled session
+SMTP_IDLE_TIMEOUT = 900  # seconds before closing an unused pooled session
 
-# Queues of pending messages.
-__hourly_queue = Queue.PriorityQueue()
-__daily_queue  = Queue.PriorityQueue()
-__weekly_queue = Queue.PriorityQueue()
+SPOOL_SYNC_INTERVAL = 5     # seconds between fsync of spool files
+SPOOL_SYNC_LINES    = 100   # messages appended before a forced fsync
+MAX_MAIL_LINES      = 1000  # lines of every mail sent from a spool file
+MIN_RETRY_DELAY     = 60    # seconds before retrying a failed mail
+MAX_RETRY_DELAY     = 3600  # maximum seconds between retries
 
 # Enums.
 __levels    = LoggerClient.levels
 __schedules = LoggerClient.schedules
 
-# Mapping between schedule options and python queues.
-__schedule2queue = {
-    str(__schedules.HOURLY) : __hourly_queue,
-    str(__schedules.DAILY)  : __daily_queue,
-    str(__schedules.WEEKLY) : __weekly_queue
-}
+# Mapping between schedule options and spools of pending messages, opened by
+# start(). The INSTANTANEOUSLY spool keeps instantaneous mails which failed.
+__spools = {}
+
+# Instantaneous messages waiting for the end of the coalescing window.
+__instant_entries   = []
+__instant_scheduled = False
+# Token buckets of instantaneous messages, logger name -> (tokens, time).
+__buckets = {}
+__lock = threading.Lock()
+
+# Mail credentials, path -> (modification time, credentials).
+__credentials_cache = {}
+
+# Pooled SMTP session.
+__smtp = None
+__smtp_credentials = None
+__smtp_last_use = 0
+__smtp_lock = threading.Lock()
+
+class _Spool:
+    """Append-only file of pending messages of a schedule.
+
+    Every line is a JSON list with the deduplication key and the text line of a
+    message. The file is renamed as `<name>.<ms>.pending` by `rotate()`, and
+    pending files are sent by `__send_pending()`, which stores in a
+    `<pending>.offset` file the position of the last message sent.
+    """
+
+    def __init__(self, spool_dir, name):
+        self.name = name
+        self.path = os.path.join(spool_dir, name + ".spool")
+        self.retry_delay = 0
+        self.retry_scheduled = False
+        self.lock = threading.RLock()
+        self.send_lock = threading.Lock()
+        self.unsynced = 0
+        self.f = open(self.path, "a")
+
+    def __unicode(self, s):
+        return s.decode("utf-8", "replace") if isinstance(s, str) else s
+
+    def append(self, key, line):
+        record = json.dumps([ [ self.__unicode(k) for k in key ], self.__unicode(line) ])
+        with self.lock:
+            self.f.write(record + "\n")
+            self.unsynced += 1
+            if self.unsynced >= SPOOL_SYNC_LINES: self.sync()
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced > 0:
+                self.f.flush()
+                os.fsync(self.f.fileno())
+                self.unsynced = 0
+
+    def rotate(self):
+        """Moves the spool file to a pending file when it isn't empty."""
+        with self.lock:
+            self.sync()
+            if self.f.tell() > 0:
+                self.f.close()
+                os.rename(self.path, "%s.%d.pending"%(self.path[:-len(".spool")],
+                                                      int(time.time()*1000)))
+                self.f = open(self.path, "a")
+
+    def pending(self):
+        """Returns the pending files sorted by creation time."""
+        return sorted(glob.glob(self.path[:-len(".spool")] + ".*.pending"),
+                      key=lambda x: int(x.split(".")[-2]))
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.f.close()
+
+def __read_offset(path):
+    try:
+        return int(open(path + ".offset").read())
+    except IOError:
+        return 0
+
+def __write_offset(path, offset):
+    with open(path + ".offset.tmp", "w") as f: f.write(str(offset))
+    os.rename(path + ".offset.tmp", path + ".offset")
+
+def __read_entries(path):
+    """Generator of (key, line, offset) entries of a pending file, starting at
+    the last offset sent."""
+    with open(path) as f:
+        f.seek(__read_offset(path))
+        while True:
+            record = f.readline()
+            if not record: return
+            if not record.endswith("\n"): return # truncated by a crash
+            try:
+                key,line = json.loads(record)
+            except ValueError:
+                continue
+            yield tuple(key), line.encode("utf-8"), f.tell()
+
+def __send_pending(mail_credentials_path, frequency, spool):
+    """Sends the pending files of the given spool in mails of at most
+    MAX_MAIL_LINES lines, scheduling a retry with exponential back-off when it
+    fails. Returns True when all of them have been sent."""
+    with spool.send_lock:
+        subject = __generate_subject(frequency)
+        try:
+            for path in spool.pending():
+                entries = []
+                for key,line,offset in __read_entries(path):
+                    entries.append( (key,line) )
+                    if len(entries) == MAX_MAIL_LINES:
+                        __sendmail(mail_credentials_path, subject,
+                                   '\n'.join( __collapse(entries) ))
+                        __write_offset(path, offset)
+                        entries = []
+                if len(entries) > 0:
+                    __sendmail(mail_credentials_path, subject,
+                               '\n'.join( __collapse(entries) ))
+                os.remove(path)
+                if os.path.exists(path + ".offset"): os.remove(path + ".offset")
+        except:
+            print "Unexpected error:", traceback.format_exc()
+            __schedule_retry(mail_credentials_path, frequency, spool)
+            return False
+        spool.retry_delay = 0
+        return True
+
+def __retry_pending(mail_credentials_path, frequency, spool):
+    spool.retry_scheduled = False
+    __send_pending(mail_credentials_path, frequency, spool)
+
+def __schedule_retry(mail_credentials_path, frequency, spool):
+    with spool.lock:
+        if spool.retry_scheduled or not Scheduler.is_running(): return
+        spool.retry_delay = min(MAX_RETRY_DELAY,
+                                max(MIN_RETRY_DELAY, spool.retry_delay*2))
+        spool.retry_scheduled = True
+    Scheduler.once_after(spool.retry_delay*1000, __retry_pending,
+                         mail_credentials_path, frequency, spool)
+
+def __sync_spools():
+    for spool in __spools.itervalues(): spool.sync()
+
+def __load_credentials(mail_credentials_path):
+    """Returns the mail credentials, the file is read again when it changes."""
+    mtime = os.stat(mail_credentials_path).st_mtime
+    cached = __credentials_cache.get(mail_credentials_path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, json.loads( open(mail_credentials_path).read() ))
+        __credentials_cache[mail_credentials_path] = cached
+    return cached[1]
+
+def __close_smtp():
+    global __smtp
+    if __smtp is not None:
+        try:
+            __smtp.quit()
+        except:
+            __smtp.close()
+        __smtp = None
+
+def __sendmail(mail_credentials_path, subject, msg):
+    """Sends a mail using the pooled SMTP session, which is opened again when
+    it has been closed by the server or the credentials have changed."""
+    global __smtp, __smtp_credentials, __smtp_last_use
+    credentials = __load_credentials(mail_credentials_path)
+    with __smtp_lock:
+        if __smtp_credentials is not credentials: __close_smtp()
+        for retry in (False, True):
+            try:
+                if __smtp is None:
+                    __smtp = Utils.smtpconnect(credentials)
+                    __smtp_credentials = credentials
+                Utils.sendmail(credentials, subject, msg, __smtp)
+                __smtp_last_use = time.time()
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                __close_smtp()
+                if retry: raise
+
+def __smtp_keepalive():
+    """Keeps the pooled SMTP session alive, closing it when it is not used."""
+    with __smtp_lock:
+        if __smtp is None: return
+        if time.time() - __smtp_last_use > SMTP_IDLE_TIMEOUT:
+            __close_smtp()
+            return
+        try:
+            if __smtp.noop()[0] != 250: __close_smtp()
+        except:
+            __close_smtp()
+
+def __take_token(name, now):
+    """Consumes a token of the bucket of the given logger name, returns False
+    when it is empty."""
+    tokens, last = __buckets.get(name, (RATE_LIMIT_BURST, now))
+    tokens = min(RATE_LIMIT_BURST, tokens + (now - last) / float(RATE_LIMIT_PERIOD))
+    if tokens < 1:
+        __buckets[name] = (tokens, now)
+        return False
+    __buckets[name] = (tokens - 1, now)
+    return True
+
+def __collapse(entries):
+    """Given a list of (key, line) pairs, returns the lines collapsing the ones
+    with identical keys into the first one followed by an (xN) count."""
+    counts = {}
+    order  = []
+    for key,line in entries:
+        if key in counts:
+            counts[key][1] += 1
+        else:
+            counts[key] = [line, 1]
+            order.append(key)
+    return [ line if n == 1 else "%s (x%d)"%(line, n)
+             for line,n in (counts[key] for key in order) ]
 
 def __generate_message_line(msg):
     """Given a message it generates a string to be shown at screen or mail."""
     time_str     = datetime.datetime.strftime(msg["datetime"], "%c")
-    host_str     = socket.gethostname()
     name_str     = msg["name"]
     level_str    = msg["level"]
     schedule_str = msg["schedule"]
     text_str     = msg["text"].replace('\n', '\\n')
-    line_str     = "%s %s %s %9s %17s: %s: %s"%(time_str, host_str, __mac_addr,
-                                                level_str, schedule_str,
-                                                name_str, text_str)
+    line_str     = "%s %s %9s %17s: %s: %s"%(time_str, __host_prefix,
+                                             level_str, schedule_str,
+                                             name_str, text_str)
     return line_str
 
 def __generate_subject(frequency, name="LIST"):
     """Generates a subject for the email."""
     return "MailLogger raspi %s - %s - %s"%(__mac_addr, name, str(frequency))
 
-def __queue_handler(mail_credentials_path, frequency, queue):
-    """Traverses the given queue and concatenates by lines all message texts."""
-    if not queue.empty():
-        subject = __generate_subject(frequency)
-        lines_list = []
-        while not queue.empty(): lines_list.append( queue.get()[1] )
-        msg = '\n'.join( lines_list )
-        try:
-            mail_credentials = json.loads( open(mail_credentials_path).read() )
-            Utils.sendmail(mail_credentials, subject, msg)
-            mail_credentials = None
-        except:
-            print "Unexpected error:", traceback.format_exc()
-            print("FATAL ERROR: irrecoverable information loss :(")
+def __queue_handler(mail_credentials_path, frequency):
+    """Sends the messages spooled for the given frequency, and the ones which
+    failed before."""
+    spool = __spools[frequency]
+    spool.rotate()
+    __send_pending(mail_credentials_path, frequency, spool)
+
+def __receive(s):
+    """Receives a batch of messages, malformed batches are discarded."""
+    frames = s.recv_multipart()
+    try:
+        return LoggerClient.decode_batch(frames)
+    except ValueError:
+        print "Unexpected error:", traceback.format_exc()
+        return []
+
+def __flush_instantaneous(mail_credentials_path):
+    """Sends in one mail the instantaneous messages of the coalescing window."""
+    global __instant_entries, __instant_scheduled
+    with __lock:
+        entries = __instant_entries
+        __instant_entries = []
+        __instant_scheduled = False
+    if len(entries) == 0: return
+    names = set( key[0] for key,line in entries )
+    name = names.pop() if len(names) == 1 else "LIST"
+    subject = __generate_subject(__schedules.INSTANTANEOUSLY, name)
+    try:
+        __sendmail(mail_credentials_path, subject, '\n'.join( __collapse(entries) ))
+    except:
+        print "Unexpected error:", traceback.format_exc()
+        spool = __spools[str(__schedules.INSTANTANEOUSLY)]
+        for key,txt in entries: spool.append(key, txt)
+        spool.rotate()
+        __schedule_retry(mail_credentials_path, "INSTANTANEOUSLY", spool)
 
 def __process_message(mail_credentials_path, msg):
+    global __instant_scheduled
     sched = msg["schedule"]
     txt   = __generate_message_line(msg)
+    key   = (msg["name"], msg["level"], msg["text"])
 
     if sched != str(__schedules.SILENTLY):
         sys.stderr.write(txt + "\n")
     
     if sched == str(__schedules.INSTANTANEOUSLY):
-        subject = __generate_subject(__schedules.INSTANTANEOUSLY,
-                                     msg["name"])
-        try:
-            mail_credentials = json.loads( open(mail_credentials_path).read() )
-            Utils.sendmail(mail_credentials, subject, txt)
-            mail_credentials = None
-        except:
-            print "Unexpected error:", traceback.format_exc()
+        with __lock:
+            allowed = __take_token(msg["name"], time.time())
+            if allowed:
+                __instant_entries.append( (key,txt) )
+                schedule_flush = not __instant_scheduled and Scheduler.is_running()
+                if schedule_flush: __instant_scheduled = True
+        if not allowed:
+            __spools[str(__schedules.HOURLY)].append(key, txt)
+        elif schedule_flush:
+            Scheduler.once_after(COALESCE_WINDOW*1000, __flush_instantaneous,
+                                 mail_credentials_path)
+        elif not Scheduler.is_running():
+            __flush_instantaneous(mail_credentials_path)
             
     elif sched != str(__schedules.SILENTLY):
-        __schedule2queue[ sched ].put( (msg["datetime"],txt) )
+        __spools[ sched ].append(key, txt)
 
 def start(mail_credentials_path=__mail_credentials_path,
-          transport_string=__transport):
+          transport_string=__transport, spool_dir=__spool_dir):
     """Starts the execution of the server.
     
-    The first argument is a path to `mail_credentials.json` file and the second
-    argument is a ZeroMQ transport string for bind server socket.
+    The first argument is a path to `mail_credentials.json` file, the second
+    argument is a ZeroMQ transport string for bind server socket and the third
+    one is the directory where pending messages are stored.
 
     """
     if not Scheduler.is_running():
         Utils.ntpcheck()
         
+        if not os.path.isdir(spool_dir): os.makedirs(spool_dir)
+        for sched in __schedules:
+            if sched != __schedules.SILENTLY:
+                __spools[str(sched)] = _Spool(spool_dir, str(sched))
+        
         ctx = zmq.Context.instance()
         s   = ctx.socket(zmq.PULL)
         s.bind(transport_string)
@@ -131,27 +402,34 @@ def start(mail_credentials_path=__mail_credentials_path,
             "text" : "Logging service STARTED",
             "datetime" : datetime.datetime.now()
         })
-        mail_credentials = json.loads( open(mail_credentials_path).read() )
-        mail_credentials = None
+        __load_credentials(mail_credentials_path)
         
         Scheduler.start()
+        Scheduler.repeat_every(SMTP_KEEPALIVE*1000, __smtp_keepalive)
+        Scheduler.repeat_every(SPOOL_SYNC_INTERVAL*1000, __sync_spools)
         Scheduler.repeat_o_clock(3600*1000, __queue_handler,
-                                 mail_credentials_path, "HOURLY", __hourly_queue)
+                                 mail_credentials_path, "HOURLY")
         Scheduler.repeat_o_clock(3600*24*1000, __queue_handler,
-                                 mail_credentials_path, "DAILY", __daily_queue)
+                                 mail_credentials_path, "DAILY")
         Scheduler.repeat_o_clock(3600*24*7*1000, __queue_handler,
-                                 mail_credentials_path, "WEEKLY", __weekly_queue)
+                                 mail_credentials_path, "WEEKLY")
+        
+        # replay of mails which were pending when the server stopped
+        for frequency,spool in __spools.iteritems():
+            if len(spool.pending()) > 0:
+                Scheduler.once_after(0, __send_pending, mail_credentials_path,
+                                     frequency, spool)
         
         print("Running server at ZMQ transport: " + transport_string)
         try:
             while True:
-                msg = s.recv_pyobj()
-                __process_message(mail_credentials_path, msg)
+                for msg in __receive(s):
+                    __process_message(mail_credentials_path, msg)
             raise Exception("Unexpected error (probably NTP related)")
         except:
-            __queue_handler(mail_credentials_path, "HOURLY", __hourly_queue)
-            __queue_handler(mail_credentials_path, "DAILY", __daily_queue)
-            __queue_handler(mail_credentials_path, "WEEKLY", __weekly_queue)
+            __queue_handler(mail_credentials_path, "HOURLY")
+            __queue_handler(mail_credentials_path, "DAILY")
+            __queue_handler(mail_credentials_path, "WEEKLY")
             __process_message(mail_credentials_path, {
                 "name" : "MailLoggerServer",
                 "level" : "ALERT",
@@ -159,15 +437,19 @@ def start(mail_credentials_path=__mail_credentials_path,
                 "text" : "Logging service STOPPED",
                 "datetime" : datetime.datetime.now()
             })
+            __flush_instantaneous(mail_credentials_path)
             print("Stopping server")
             Scheduler.stop()
+            with __smtp_lock: __close_smtp()
+            for spool in __spools.itervalues(): spool.close()
             raise
 
 def start_thread(mail_credentials_path=__mail_credentials_path,
-                 transport_string=__transport):
+                 transport_string=__transport, spool_dir=__spool_dir):
     """Starts the sever in a python thread."""
     thread = threading.Thread(target=start, args=(mail_credentials_path,
-                                                  transport_string))
+                                                  transport_string,
+                                                  spool_dir))
     thread.setDaemon(True)
     thread.start()
 
@@ -176,4 +458,5 @@ def start_thread(mail_credentials_path=__mail_credentials_path,
 if __name__ == "__main__":
     credentials = sys.argv[1] if len(sys.argv) > 1 else __mail_credentials_path
     transport = sys.argv[2] if len(sys.argv) > 2 else __transport
-    start(credentials, transport)
+    spool_dir = sys.argv[3] if len(sys.argv) > 3 else __spool_dir
+    start(credentials, transport, spool_dir)
@@ -65,6 +65,14 @@ if __name__ == "__main__":
 
     config = Utils.getconfig("main", logger)
     for module_info in config["modules"]: try_start(module_info)
+
+    # Optional publication of scheduler timing statistics.
+    stats_client = None
+    if "scheduler_stats_period" in config:
+        stats_client = Utils.getpahoclient(logger)
+        Scheduler.repeat_o_clock(config["scheduler_stats_period"],
+                                 Scheduler.publish_stats, stats_client,
+                                 Utils.gettopic("scheduler/{0}/{1}"))
     
     logger.info("Scheduler configured")
     logger.info("Starting infinite loop")
@@ -79,4 +87,5 @@ if __name__ == "__main__":
         Scheduler.stop()
         logger.info("Stopping modules")
         for m in started_modules: __try_call(logger, m.stop)
+        if stats_client is not None: stats_client.disconnect()
         logger.info("Bye!")
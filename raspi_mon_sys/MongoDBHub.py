@@ -5,30 +5,110 @@ This module inserts into GVA2015_data collection documents with the following
 structure::
 
     {
-        "_id": ObjectID(...),
+        "_id": "HOUSE_NAME:TOPIC:BASETIME:FIRST_DELTA_TIME",
         "house": HOUSE_NAME,
         "basetime": DATE VALUE IN TIMESTAMP,
         "topic": MQTT TOPIC WITH '/' REPLACED BY '.',
         "delta_times": AN ARRAY,
         "values": ANOTHER ARRAY
     }
+
+Messages are kept until upload in hour buckets indexed by (topic, basetime).
+Every bucket stores delta_times and values in `array('d')` buffers, and values
+fall back to a list when a non numeric value is received. Buckets are guarded
+by a striped lock, so messages of different topics rarely wait each other, and
+they are only sorted when messages arrive out of order.
+
+Every received message is also written to a write-ahead log at WAL_PATH, so
+buffered hours and pending documents survive a crash. Messages are appended to
+a memory buffer which is written and synced to disk by a background thread of
+the log every WAL_FLUSH_INTERVAL seconds, or when it reaches WAL_FLUSH_BYTES,
+reducing writes on the SD card.
+The log is split into segment files of records with a CRC32 checksum. After a
+successful upload, a checkpoint stores the basetime before which all the hours
+have been uploaded and the segments older than it are removed. At start, the
+segments are replayed to rebuild the buckets which were not uploaded.
+
+Documents are uploaded in chunks of UPLOAD_CHUNK_SIZE documents with unordered
+bulk inserts, building them while the previous chunks are written. Their _id
+is derived from their content, so a document written again after a partial
+failure is ignored as a duplicate, and only documents which failed are kept
+in `pending_documents` for the next upload. When a duplicated document has
+values which aren't stored yet (an hour replayed from the write-ahead log after
+a crash, with messages received after its upload), they are inserted as a new
+document of the same hour.
+
+When the house configuration enables "compressed_documents", numeric series
+are stored compressed by TimeSeriesCodec, replacing "delta_times" and "values"
+by "encoding", "count" and a binary "data" field. Timestamps of compressed
+documents keep a precision of milliseconds.
+
+For every uploaded numeric series, GVA2015_rollups collection is updated with
+pre-aggregated statistics at ROLLUP_RESOLUTIONS, with the following structure::
+
+    {
+        "_id": "TOPIC:RESOLUTION:START",
+        "house": HOUSE_NAME,
+        "topic": MQTT TOPIC WITH '/' REPLACED BY '.',
+        "resolution": SECONDS,
+        "time": START DATE,
+        "count": NUMBER OF VALUES,
+        "min": MIN VALUE,
+        "max": MAX VALUE,
+        "first": { "secs": TIMESTAMP, "value": FIRST VALUE },
+        "last": { "secs": TIMESTAMP, "value": LAST VALUE },
+        "sum": TIME-WEIGHTED SUM OF VALUES (TRAPEZOIDS BETWEEN VALUES),
+        "t": SECONDS COVERED BY sum,
+        "head": { "sum": PART OF sum BEFORE THE FIRST VALUE, "t": ITS SECONDS },
+        "sources": _id OF THE GVA2015_data DOCUMENTS ADDED TO THIS ROLLUP
+    }
+
+Rollups are upserted after their document has been inserted, and only when
+their "sources" don't contain the document yet, so retrying an upload never
+counts a document twice. A document whose rollups fail is uploaded again.
+The trapezoid between the last value of an interval and the first value of the
+next one of the same document is carried into the later interval, and it is
+also stored as its "head", so readers can drop it at the start of their keys.
+Trapezoids between values of two different documents aren't added to "sum",
+readers join consecutive rollups without "head" instead. For this reason
+rollups are never coarser than the one hour of a document, and coarser keys
+are reduced from the hourly rollups.
 """
 
+from array import array
+
 import bson
+import calendar
 import datetime
+import glob
+import itertools
 import json
-import Queue
+import os
+import pymongo
+import struct
 import time
 import threading
 import traceback
+import zlib
 
 import raspi_mon_sys.LoggerClient as LoggerClient
 import raspi_mon_sys.Scheduler as Scheduler
+import raspi_mon_sys.TimeSeriesCodec as TimeSeriesCodec
 import raspi_mon_sys.Utils as Utils
 
 PENDING_DOCUMENTS_LENGTH_WARNING = 10000 # expected 40MB of messages for warning
 PENDING_DOCUMENTS_LENGTH_ERROR = 30000 # expected 120MB of messages for data loss
 PERIOD = 3600 # every 3600 seconds (1 hour) we send data to hour server
+UPLOAD_CHUNK_SIZE = 500 # documents written by every bulk insert
+DUPLICATE_KEY_ERROR = 11000
+NUM_LOCK_STRIPES = 16
+ROLLUP_RESOLUTIONS = [ 60, 900, 3600 ] # 1 min, 15 min and 1 hour, never above PERIOD
+COMPRESSED_DOCUMENTS = False # default when the house doesn't configure it
+
+WAL_PATH = "/var/lib/raspimon/mongodbhub_wal"
+WAL_FLUSH_INTERVAL = 10         # seconds between writes of the WAL buffer
+WAL_FLUSH_BYTES = 64*1024       # buffer size which forces a write
+WAL_SEGMENT_SIZE = 4*1024*1024  # size of segment files
 
 assert PENDING_DOCUMENTS_LENGTH_ERROR > PENDING_DOCUMENTS_LENGTH_WARNING
 
@@ -36,80 +116,293 @@ raspi_mac = Utils.getmac()
 logger = None
 mqtt_client = None
 house_data = None
-lock = threading.RLock()
+stripes = [ threading.Lock() for i in range(NUM_LOCK_STRIPES) ]
 
 pending_documents = []
 raspimon_message_queues = {}
 forecast_message_queues = {}
+wal = None
+
+class _Bucket(object):
+    """Columnar storage of the messages of one topic and hour."""
+    __slots__ = ("delta_times", "values", "integral", "ordered")
+
+    def __init__(self):
+        self.delta_times = array('d')
+        self.values = array('d')
+        self.integral = True # all values are int, they are restored as int
+        self.ordered = True  # delta_times are in ascending order
+
+    def append(self, delta_time, data):
+        delta_times = self.delta_times
+        if self.ordered and len(delta_times) > 0 and delta_time < delta_times[-1]:
+            self.ordered = False
+        if isinstance(self.values, array):
+            t = type(data)
+            if t is float:
+                self.integral = False
+            elif t is not int and t is not long:
+                # not a number, values are stored as python objects from now
+                self.values = self.values.tolist()
+                if self.integral: self.values = [ int(x) for x in self.values ]
+        delta_times.append(delta_time)
+        self.values.append(data)
+
+    def columns(self):
+        """Returns delta_times and values lists sorted by delta_times."""
+        delta_times = self.delta_times.tolist()
+        values = self.values
+        if isinstance(values, array):
+            values = values.tolist()
+            if self.integral: values = [ int(x) for x in values ]
+        if not self.ordered:
+            order = sorted(xrange(len(delta_times)), key=delta_times.__getitem__)
+            delta_times = [ delta_times[i] for i in order ]
+            values = [ values[i] for i in order ]
+        return delta_times,values
+
+class _WriteAheadLog(object):
+    """Append-only log of MQTT messages split into segment files.
+
+    Every record is its length and CRC32 followed by the topic and the JSON
+    payload separated by a new line. Segments are numbered files
+    `<path>/<seq>.wal`, and `<path>/checkpoint.json` stores the last segment
+    and basetime given to `checkpoint()`.
+    """
+    RECORD_HEADER = struct.Struct("!II")
+
+    def __init__(self, path):
+        if not os.path.isdir(path): os.makedirs(path)
+        self.path = path
+        self.lock = threading.Lock()
+        self.segments = {} # seq -> max basetime, for closed segments
+        self.buf = []
+        self.buf_size = 0
+        self.f = None
+        self.seq = 0
+        self.size = 0
+        self.max_basetime = None
+        self.closed = threading.Event()
+        self.flusher = None
+
+    def __segment_path(self, seq):
+        return os.path.join(self.path, "%08d.wal"%(seq))
+
+    def __open_segment(self, seq):
+        self.seq = seq
+        self.f = open(self.__segment_path(seq), "ab")
+        self.size = self.f.tell()
+        self.max_basetime = None
+
+    def __read_checkpoint(self):
+        try:
+            checkpoint = json.loads( open(os.path.join(self.path, "checkpoint.json")).read() )
+            return checkpoint["segment"],checkpoint["uploaded_before"]
+        except IOError:
+            return -1,0
+
+    def __records(self, filename):
+        """Generator of the (topic, payload) records of a segment file, stops at
+        the first truncated or corrupted record."""
+        with open(filename, "rb") as f:
+            while True:
+                header = f.read(self.RECORD_HEADER.size)
+                if len(header) < self.RECORD_HEADER.size: return
+                length,crc = self.RECORD_HEADER.unpack(header)
+                data = f.read(length)
+                if len(data) < length or zlib.crc32(data) & 0xFFFFFFFF != crc:
+                    print "Corrupted WAL record at", filename, f.tell()
+                    return
+                yield data.split("\n", 1)
+
+    def replay(self, func):
+        """Calls func(topic, payload) for every record not uploaded before the
+        last checkpoint, func returns the basetime of the record. Afterwards a
+        new segment is opened for appending, and the buffer is flushed every
+        WAL_FLUSH_INTERVAL seconds until close()."""
+        last_segment,uploaded_before = self.__read_checkpoint()
+        count = 0
+        seqs = sorted( int(os.path.basename(x)[:-4])
+                       for x in glob.glob(os.path.join(self.path, "*.wal")) )
+        for seq in seqs:
+            max_basetime = None
+            for topic,payload in self.__records(self.__segment_path(seq)):
+                try:
+                    basetime = int(json.loads(payload)["timestamp"] // PERIOD * PERIOD)
+                    if seq <= last_segment and basetime < uploaded_before: continue
+                    func(topic, payload)
+                    max_basetime = max(max_basetime, basetime)
+                    count += 1
+                except:
+                    print "Unexpected error:", traceback.format_exc()
+            if max_basetime is None:
+                os.remove(self.__segment_path(seq))
+            else:
+                self.segments[seq] = max_basetime
+        self.__open_segment(seqs[-1] + 1 if len(seqs) > 0 else 0)
+        self.flusher = threading.Thread(target=self.__flush_loop)
+        self.flusher.setDaemon(True)
+        self.flusher.start()
+        return count
+
+    def __flush_loop(self):
+        while not self.closed.wait(WAL_FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except:
+                print "Unexpected error:", traceback.format_exc()
+
+    def append(self, topic, payload, basetime):
+        data = topic + "\n" + payload
+        record = self.RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xFFFFFFFF) + data
+        with self.lock:
+            self.buf.append(record)
+            self.buf_size += len(record)
+            self.max_basetime = max(self.max_basetime, basetime)
+            if self.buf_size >= WAL_FLUSH_BYTES: self.__flush()
+
+    def __flush(self):
+        if self.buf_size > 0:
+            self.f.write("".join(self.buf))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.size += self.buf_size
+            self.buf = []
+            self.buf_size = 0
+        if self.size >= WAL_SEGMENT_SIZE: self.__rotate()
+
+    def __rotate(self):
+        if self.size > 0:
+            self.f.close()
+            self.segments[self.seq] = self.max_basetime
+            self.__open_segment(self.seq + 1)
+
+    def flush(self):
+        """Writes and syncs the buffered records."""
+        with self.lock: self.__flush()
+
+    def rotate(self):
+        """Closes the current segment, so it can be removed by checkpoint()."""
+        with self.lock:
+            self.__flush()
+            self.__rotate()
+
+    def checkpoint(self, uploaded_before):
+        """Removes closed segments with all their hours before the given
+        basetime, which is stored to skip them in replay."""
+        with self.lock:
+            if len(self.segments) == 0: return
+            filename = os.path.join(self.path, "checkpoint.json")
+            with open(filename + ".tmp", "w") as f:
+                f.write(json.dumps({ "segment" : max(self.segments.keys()),
+                                     "uploaded_before" : uploaded_before }))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(filename + ".tmp", filename)
+            for seq,max_basetime in self.segments.items():
+                if max_basetime < uploaded_before:
+                    os.remove(self.__segment_path(seq))
+                    del self.segments[seq]
+
+    def close(self):
+        self.closed.set()
+        if self.flusher is not None: self.flusher.join()
+        with self.lock:
+            self.__flush()
+            self.f.close()
+
+def __stripe(key):
+    return stripes[hash(key) % NUM_LOCK_STRIPES]
 
 def __enqueue_raspimon_message(client, userdata, topic, message):
     timestamp = message["timestamp"]
     data = message["data"]
     basetime = int(timestamp // PERIOD * PERIOD)
-    lock.acquire()
-    q = raspimon_message_queues.setdefault( (topic,basetime), Queue.Queue() )
-    lock.release()
     delta_time = timestamp - basetime
-    q.put( (delta_time, data) )
-    logger.debug("%s %f %f %f %s", topic, float(basetime), float(timestamp),
-                 float(delta_time), str(data))
+    key = (topic,basetime)
+    with __stripe(key):
+        bucket = raspimon_message_queues.get(key)
+        if bucket is None:
+            bucket = raspimon_message_queues[key] = _Bucket()
+        bucket.append(delta_time, data)
+    if logger.enabled(logger.levels.DEBUG):
+        logger.debug("%s %f %f %f %s", topic, float(basetime), float(timestamp),
+                     float(delta_time), str(data))
+    return basetime
 
 def __enqueue_forecast_message(client, userdata, topic, message):
     timestamp = message["timestamp"]
     basetime = int(timestamp // PERIOD * PERIOD)
-    lock.acquire()
-    q = forecast_message_queues.setdefault( (topic,basetime), Queue.Queue() )
-    lock.release()
-    q.put( message )
-    logger.debug("%s %f %s", topic, float(timestamp), str(message))
+    key = (topic,basetime)
+    with __stripe(key):
+        forecast_message_queues.setdefault(key, []).append( message )
+    if logger.enabled(logger.levels.DEBUG):
+        logger.debug("%s %f %s", topic, float(timestamp), str(message))
+    return basetime
 
 def __on_mqtt_connect(client, userdata, rc):
     client.subscribe("raspimon/#")
     client.subscribe("forecast/#")
 
-def __on_mqtt_message(client, userdata, msg):
-    global raspimon_message_queues
-    topic = msg.topic.replace("/",".")
-    message = json.loads(msg.payload)
+def __enqueue_message(client, userdata, topic, payload):
+    """Enqueues a JSON payload and returns its basetime."""
+    message = json.loads(payload)
     if topic.startswith("raspimon"):
-        __enqueue_raspimon_message(client, userdata, topic, message)
+        return __enqueue_raspimon_message(client, userdata, topic, message)
     elif topic.startswith("forecast"):
-        __enqueue_forecast_message(client, userdata, topic, message)
+        return __enqueue_forecast_message(client, userdata, topic, message)
     else:
         raise ValueError("Unknown MQTT topic " + topic)
 
+def __on_mqtt_message(client, userdata, msg):
+    topic = msg.topic.replace("/",".")
+    basetime = __enqueue_message(client, userdata, topic, msg.payload)
+    # the message is logged after being enqueued, so a checkpoint never removes
+    # a message which isn't in a bucket
+    wal.append(topic, msg.payload, basetime)
+
 def __configure_mqtt(client):
     client.on_connect = __on_mqtt_connect
     client.on_message = __on_mqtt_message
 
-def __build_raspimon_documents(key):
-    global raspimon_message_queues
-    topic,basetime = key
-    q = raspimon_message_queues.pop(key)
-    q.put('STOP')
-    data_pairs = [ x for x in iter(q.get, 'STOP') ]
-    data_pairs.sort(key=lambda x: x[0])
-    delta_times,values = zip(*data_pairs)
+def __raspimon_document(topic, basetime, delta_times, values):
     document = {
+        "_id" : "%s:%s:%d:%.3f"%(house_data["name"], topic, basetime, delta_times[0]),
         "house" : house_data["name"],
         "basetime" : datetime.datetime.utcfromtimestamp(basetime),
         "topic" : topic,
-        "delta_times" : delta_times,
-        "values" : values
     }
+    data = None
+    if house_data.get("compressed_documents", COMPRESSED_DOCUMENTS):
+        data = TimeSeriesCodec.encode(delta_times, values)
+    if data is not None:
+        document["encoding"] = TimeSeriesCodec.ENCODING
+        document["count"] = len(delta_times)
+        document["data"] = bson.Binary(data)
+    else:
+        document["delta_times"] = delta_times
+        document["values"] = values
+    return document
+
+def __build_raspimon_documents(key):
+    global raspimon_message_queues
+    topic,basetime = key
+    with __stripe(key):
+        bucket = raspimon_message_queues.pop(key)
+    delta_times,values = bucket.columns()
     logger.info("New document for topic= %s basetime= %d with n= %d",
                 topic, int(basetime), len(delta_times))
-    return [ document ]
+    return [ __raspimon_document(topic, basetime, delta_times, values) ]
 
 def __build_forecast_documents(key):
     global forecast_message_queues
     topic,basetime = key
-    q = forecast_message_queues.pop(key)
-    q.put('STOP')
-    messages = [ x for x in iter(q.get, 'STOP') ]
+    with __stripe(key):
+        messages = forecast_message_queues.pop(key)
     messages.sort(key=lambda x: x["timestamp"])
     time2dt = datetime.datetime.utcfromtimestamp
     for doc in messages:
+        doc["_id"] = "%s:%s:%.3f"%(house_data["name"], topic, doc["timestamp"])
         doc["timestamp"] = time2dt(doc["timestamp"])
         doc["periods_start"] = [ time2dt(x) for x in doc["periods_start"] ]
         doc["periods_end"]   = [ time2dt(x) for x in doc["periods_end"] ]
@@ -119,79 +412,267 @@ def __build_forecast_documents(key):
                 topic, int(basetime), len(messages))
     return messages
 
-def __upload_all_data(db, build_documents, queues):
-    insert_batch = [ y for x in queues.keys() for y in build_documents(x)]
-    db.GVA2015_data.insert(insert_batch)
-    logger.info("Inserted %d documents", len(insert_batch))
+def __checkpoint(default):
+    """Removes WAL segments of uploaded hours, which are the ones before the
+    oldest bucket, or before default when there are no buckets."""
+    wal.rotate()
+    basetimes = [ x[1] for x in raspimon_message_queues.keys() + forecast_message_queues.keys() ]
+    wal.checkpoint(min(basetimes) if len(basetimes) > 0 else default)
+
+def __rollup_points(delta_times, values, basetime, resolution):
+    """Returns a dictionary with the statistics of every resolution interval
+    start, delta_times must be sorted. The trapezoid which crosses the start of
+    an interval is added to it and to its head."""
+    result = {}
+    prev_key = None
+    last = None
+    for delta_time,value in zip(delta_times, values):
+        secs = basetime + delta_time
+        key = int(secs // resolution * resolution)
+        if key != prev_key:
+            r = result.get(key)
+            if r is None:
+                r = result[key] = { "count" : 0, "min" : value, "max" : value,
+                                    "first" : (secs,value), "sum" : 0.0, "t" : 0.0,
+                                    "head_sum" : 0.0, "head_t" : 0.0 }
+            prev_key = key
+        if last is not None:
+            dt = secs - last[0]
+            if dt > 0.0:
+                area = (0.5*value + 0.5*last[1]) * dt
+                r["sum"] += area
+                r["t"]   += dt
+                if r["count"] == 0:
+                    r["head_sum"] += area
+                    r["head_t"]   += dt
+        last = (secs,value)
+        r["count"] += 1
+        if value < r["min"]: r["min"] = value
+        if value > r["max"]: r["max"] = value
+        r["last"] = (secs,value)
+    return result
+
+def __build_rollup_requests(doc):
+    """Returns the upserts of GVA2015_rollups for a GVA2015_data document,
+    an empty list when its values aren't numbers."""
+    if "basetime" not in doc: return [] # forecast documents
+    delta_times,values = TimeSeriesCodec.decode_document(doc)
+    if not all(type(x) is int or type(x) is long or type(x) is float for x in values):
+        return []
+    basetime = calendar.timegm(doc["basetime"].utctimetuple())
+    topic = doc["topic"]
+    requests = []
+    for resolution in ROLLUP_RESOLUTIONS:
+        for key,r in __rollup_points(delta_times, values, basetime, resolution).iteritems():
+            first = bson.SON([ ("secs", r["first"][0]), ("value", r["first"][1]) ])
+            last = bson.SON([ ("secs", r["last"][0]), ("value", r["last"][1]) ])
+            requests.append(pymongo.UpdateOne(
+                { "_id" : "%s:%d:%d"%(topic, resolution, key), "sources" : { "$ne" : doc["_id"] } },
+                {
+                    "$setOnInsert" : { "house" : doc["house"], "topic" : topic,
+                                       "resolution" : resolution,
+                                       "time" : datetime.datetime.utcfromtimestamp(key) },
+                    "$push" : { "sources" : doc["_id"] },
+                    "$inc" : { "count" : r["count"], "sum" : r["sum"], "t" : r["t"],
+                               "head.sum" : r["head_sum"], "head.t" : r["head_t"] },
+                    # embedded documents are compared by secs first
+                    "$min" : { "min" : r["min"], "first" : first },
+                    "$max" : { "max" : r["max"], "last" : last },
+                },
+                upsert=True))
+    return requests
+
+def __update_rollups(db, docs, stats):
+    """Upserts the rollups of the given documents and returns the documents
+    whose rollups failed. A duplicate key error means that the rollup already
+    contains the document."""
+    owners = []
+    requests = []
+    for doc in docs:
+        doc_requests = __build_rollup_requests(doc)
+        owners.extend( [ doc ] * len(doc_requests) )
+        requests.extend(doc_requests)
+    if len(requests) == 0: return []
+    failed = []
+    try:
+        db.GVA2015_rollups.bulk_write(requests, ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        failed_ids = set()
+        for x in errors:
+            doc = owners[x["index"]]
+            if x["code"] != DUPLICATE_KEY_ERROR and doc["_id"] not in failed_ids:
+                failed_ids.add(doc["_id"])
+                failed.append(doc)
+    stats["rollups"] += len(requests)
+    return failed
+
+def __point_key(point):
+    delta_time,value = point
+    if type(value) is int or type(value) is long or type(value) is float:
+        return delta_time,float(value)
+    return delta_time,json.dumps(value, sort_keys=True)
+
+def __merge_duplicate(db, doc):
+    """Returns the documents stored for the topic and hour of a duplicated
+    document, and a document with its values which aren't stored yet, or None
+    when all of them are. Values are missing when the hour received more
+    messages after an upload whose checkpoint was lost by a crash."""
+    if "basetime" not in doc: return [ doc ],None # forecast documents
+    stored_docs = list(db.GVA2015_data.find({ "house" : doc["house"], "topic" : doc["topic"],
+                                              "basetime" : doc["basetime"] }))
+    stored = set()
+    for x in stored_docs:
+        stored.update( __point_key(p) for p in zip(*TimeSeriesCodec.decode_document(x)) )
+    rest = [ p for p in zip(*TimeSeriesCodec.decode_document(doc)) if __point_key(p) not in stored ]
+    if len(rest) == 0: return stored_docs,None
+    basetime = calendar.timegm(doc["basetime"].utctimetuple())
+    logger.info("Merged document for topic= %s basetime= %d with n= %d",
+                doc["topic"], basetime, len(rest))
+    return stored_docs,__raspimon_document(doc["topic"], basetime,
+                                           [ x[0] for x in rest ], [ x[1] for x in rest ])
+
+def __insert_chunk(db, chunk, stats):
+    """Writes a chunk with an unordered bulk insert and returns the documents
+    which failed, documents already in the database are not failures. Rollups
+    of the inserted documents are updated after the insert. The values of a
+    duplicated document which aren't stored yet are inserted as a new
+    document, and rollups are updated from the stored documents."""
+    t0 = time.time()
+    failed = []
+    duplicated = []
+    try:
+        db.GVA2015_data.insert_many(chunk, ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        failed = [ chunk[x["index"]] for x in errors if x["code"] != DUPLICATE_KEY_ERROR ]
+        duplicated = [ chunk[x["index"]] for x in errors if x["code"] == DUPLICATE_KEY_ERROR ]
+        stats["duplicated"] += len(duplicated)
+    skipped_ids = set( x["_id"] for x in failed + duplicated )
+    rollup_docs = [ x for x in chunk if x["_id"] not in skipped_ids ]
+    remainders = []
+    for doc in duplicated:
+        stored_docs,remainder = __merge_duplicate(db, doc)
+        rollup_docs.extend(stored_docs)
+        if remainder is not None: remainders.append(remainder)
+    failed_rollups = __update_rollups(db, rollup_docs, stats)
+    stats["inserted"] += len(chunk) - len(failed)
+    failed.extend(failed_rollups)
+    stats["chunks"] += 1
+    stats["latency"] += time.time() - t0
+    if len(remainders) > 0: failed.extend( __insert_chunk(db, remainders, stats) )
+    return failed
+
+def __upload_documents(db, pending, documents):
+    """Uploads documents in chunks, starting with the pending iterator. When a
+    chunk fails entirely the upload stops, documents not built yet remain in
+    their buckets. Returns the documents which failed."""
+    t0 = time.time()
+    stats = { "inserted" : 0, "duplicated" : 0, "chunks" : 0, "latency" : 0.0,
+              "rollups" : 0 }
+    failed = []
+    chunk = []
+    try:
+        for doc in itertools.chain(pending, documents):
+            chunk.append(doc)
+            if len(chunk) == UPLOAD_CHUNK_SIZE:
+                failed.extend( __insert_chunk(db, chunk, stats) )
+                chunk = []
+        if len(chunk) > 0: failed.extend( __insert_chunk(db, chunk, stats) )
+    except pymongo.errors.PyMongoError:
+        print "Unexpected error:", traceback.format_exc()
+        logger.warning("Connection with database is failing")
+        failed.extend(chunk)
+        failed.extend(pending)
+    stats["inserted"] -= stats["duplicated"]
+    elapsed = time.time() - t0
+    # backlog counts failed documents and buckets waiting for upload
+    logger.info("Inserted %d documents (%d duplicated, %d failed) and %d rollup updates in %d chunks, %.2f s, %.1f docs/s, %.3f s per chunk, backlog %d",
+                stats["inserted"], stats["duplicated"], len(failed), stats["rollups"],
+                stats["chunks"],
+                elapsed, stats["inserted"] / max(elapsed, 1e-6),
+                stats["latency"] / max(stats["chunks"], 1),
+                len(failed) + len(raspimon_message_queues) + len(forecast_message_queues))
+    return failed
 
 def __build_after_deadline_documents(build_docs, queues, t):
-    lock.acquire()
+    # keys() returns a copy taken atomically, buckets are popped under their stripe
     keys = queues.keys()
-    lock.release()
-    batch = [ y for x in keys if t - x[1] > PERIOD for y in build_docs(x) ]
-    return batch
+    return ( y for x in keys if t - x[1] > PERIOD for y in build_docs(x) )
 
-def start():
-    """Opens connections with logger, MongoDB and MQTT broker."""
+def __build_all_documents(build_docs, queues):
+    return ( y for x in queues.keys() for y in build_docs(x) )
+
+def start(wal_path=WAL_PATH):
+    """Opens connections with logger, MongoDB and MQTT broker, after rebuilding
+    from the write-ahead log the buckets which weren't uploaded."""
     global logger
     global mqtt_client
     global house_data
+    global wal
     logger = LoggerClient.open("MongoDBHub")
+    wal = _WriteAheadLog(wal_path)
+    n = wal.replay(lambda topic,payload: __enqueue_message(None, None, topic, payload))
+    if n > 0: logger.info("Replayed %d messages from write-ahead log", n)
     mqtt_client = Utils.getpahoclient(logger, __configure_mqtt)
-    mongo_client = Utils.getmongoclient(logger)
-    db = mongo_client["raspimon"]
-    col = db["GVA2015_houses"]
-    house_data = col.find_one({ "raspi":raspi_mac })
+    with Utils.borrowmongoclient(logger) as mongo_client:
+        col = mongo_client["raspimon"]["GVA2015_houses"]
+        house_data = col.find_one({ "raspi":raspi_mac })
+        mongo_client["raspimon"]["GVA2015_rollups"].create_index([ ("topic",pymongo.ASCENDING),
+                                                                   ("resolution",pymongo.ASCENDING),
+                                                                   ("time",pymongo.ASCENDING) ])
     assert house_data is not None
-    mongo_client.close()
 
 def stop():
-    mongo_client = Utils.getmongoclient(logger)
-    db = mongo_client["raspimon"]
     # close MQTT broker connection
     mqtt_client.disconnect()
-    # force sending data to MongoDB
-    __upload_all_data(db, __build_raspimon_documents, raspimon_message_queues)
-    __upload_all_data(db, __build_forecast_documents, forecast_message_queues)
-    if len(pending_documents) > 0: db.GVA2015_data.insert(pending_documents)
-    # close rest of pending connections
-    mongo_client.close()
-    logger.close()
+    wal.flush()
+    try:
+        # force sending data to MongoDB
+        with Utils.borrowmongoclient(logger) as mongo_client:
+            failed = __upload_documents(mongo_client["raspimon"], iter(pending_documents),
+                                        itertools.chain(
+                                            __build_all_documents(__build_raspimon_documents,
+                                                                  raspimon_message_queues),
+                                            __build_all_documents(__build_forecast_documents,
+                                                                  forecast_message_queues)))
+        if len(failed) > 0:
+            logger.error("Unable to upload %d documents, they are kept at the write-ahead log",
+                         len(failed))
+        else:
+            __checkpoint(int(time.time()) + PERIOD)
+    finally:
+        # the write-ahead log keeps the data when the upload fails
+        wal.close()
+        # close rest of pending connections
+        Utils.closemongoclient()
+        logger.close()
 
 def upload_data():
+    global pending_documents
     try:
-        mongo_client = Utils.getmongoclient(logger)
-        db = mongo_client["raspimon"]
-        t = time.time()
-
-        raspimon_batch = __build_after_deadline_documents(__build_raspimon_documents,
-                                                          raspimon_message_queues, t)
-        forecast_batch = __build_after_deadline_documents(__build_forecast_documents,
-                                                          forecast_message_queues, t)
-        
-        global pending_documents
-        insert_batch = raspimon_batch + forecast_batch + pending_documents
-        pending_documents = []
-        
-        try:
-            if len(insert_batch) > 0: db.GVA2015_data.insert(insert_batch)
-        except:
-            pending_documents = insert_batch
-            if len(pending_documents) > PENDING_DOCUMENTS_LENGTH_ERROR:
-                logger.error("Pending %s messages is above data loss threshold %d, sadly pending list set to zero :S",
-                             len(pending_documents),
-                             PENDING_DOCUMENTS_LENGTH_ERROR)
-                pending_documents = [] # data loss here :'(
-            elif len(pending_documents) > PENDING_DOCUMENTS_LENGTH_WARNING:
-                logger.alert("Pending %s messages is above warning threshold %d, data loss will occur at %d",
-                             len(pending_documents),
-                             PENDING_DOCUMENTS_LENGTH_WARNING,
-                             PENDING_DOCUMENTS_LENGTH_ERROR)
-            else:
-                logger.warning("Connection with database is failing")
-            raise
-        logger.info("Inserted %d documents", len(insert_batch))
-        mongo_client.close()
+        with Utils.borrowmongoclient(logger) as mongo_client:
+            t = time.time()
+            raspimon_docs = __build_after_deadline_documents(__build_raspimon_documents,
+                                                             raspimon_message_queues, t)
+            forecast_docs = __build_after_deadline_documents(__build_forecast_documents,
+                                                             forecast_message_queues, t)
+            pending_documents = __upload_documents(mongo_client["raspimon"],
+                                                   iter(pending_documents),
+                                                   itertools.chain(raspimon_docs,
+                                                                   forecast_docs))
+        if len(pending_documents) > PENDING_DOCUMENTS_LENGTH_ERROR:
+            logger.error("Pending %s messages is above data loss threshold %d, sadly pending list set to zero :S",
+                         len(pending_documents),
+                         PENDING_DOCUMENTS_LENGTH_ERROR)
+            pending_documents = [] # data loss here :'(
+        elif len(pending_documents) > PENDING_DOCUMENTS_LENGTH_WARNING:
+            logger.alert("Pending %s messages is above warning threshold %d, data loss will occur at %d",
+                         len(pending_documents),
+                         PENDING_DOCUMENTS_LENGTH_WARNING,
+                         PENDING_DOCUMENTS_LENGTH_ERROR)
+        elif len(pending_documents) == 0:
+            __checkpoint(int(t // PERIOD * PERIOD))
     except:
         print "Unexpected error:", traceback.format_exc()
         logger.error("Unexpected error: %s", traceback.format_exc())
@@ -76,6 +76,7 @@ client = None
 iface = None
 is_running = False
 logger = None
+pending_config = None
 
 def __build_null_values(node2keys):
     t = time.time()
@@ -100,7 +101,11 @@ def __try_open(logger):
 def __process(logger, client, iface, nodes, node2keys):
     last_timestamp = time.time()
     topic = Utils.gettopic("rfemon/{0}/{1}/{2}")
+    global pending_config
     while is_running:
+        if pending_config is not None:
+            new_config,pending_config = pending_config,None
+            __apply_config(node2keys, new_config)
         if iface is None:
             time.sleep(0.1)
             iface = __try_open(logger)
@@ -147,6 +152,26 @@ def __process(logger, client, iface, nodes, node2keys):
             logger.error("Unexpected error: %s", traceback.format_exc())
         time.sleep(0.05)
 
+def __on_config_change(new_config):
+    global pending_config
+    # applied by __process(), so node2keys doesn't change while it is used
+    pending_config = new_config
+
+def __apply_config(node2keys, new_config):
+    """Updates node2keys with a changed configuration, keys which were already
+    configured keep their last published reading."""
+    new_node2keys = new_config["node2keys"]
+    for n in new_config["nodes"]:
+        node_id = str(n["id"])
+        old = dict( (conf["key"],conf) for conf in node2keys.get(node_id, []) )
+        for conf in new_node2keys[node_id]:
+            conf["data"] = old[conf["key"]]["data"] if conf["key"] in old else -10000.0
+            conf["when"] = old[conf["key"]]["when"] if conf["key"] in old else 0.0
+        node2keys[node_id] = new_node2keys[node_id]
+    for node_id in set(node2keys) - set(str(n["id"]) for n in new_config["nodes"]):
+        del node2keys[node_id]
+    logger.info("Configuration changed, %d nodes", len(node2keys))
+
 def start():
     """Starts a thread which reads from RFM69Pi and publishes using MQTT."""    
     global logger
@@ -162,7 +187,7 @@ def start():
     # config is a dictionary with:
     # devices : [ { id, desc, name  } ]
     # keys : [ { nodeId, key, desc, name } ]
-    config    = Utils.getconfig("open_energy_monitor", logger)
+    config    = Utils.getconfig("open_energy_monitor", logger, __on_config_change)
     nodes     = config["nodes"]
     node2keys = config["node2keys"]
     for n in nodes:
@@ -15,6 +15,17 @@ Plugwise data is published under topics::
 This sequence is a time series of power consumption and state values. State
 value messages are only sended if state changes from previous and current read.
 
+Besides, the power log buffers stored by the circles are published under topics::
+
+    BASETOPIC/plugwise/NAME1/powerlog/MACADDRESS1 {"timestamp":t1,"data":power}
+
+with the average power of every log interval. The last consumed log buffer of
+every circle is kept in the file given by "backfill_state_path" (plugwise
+configuration), so after a reboot or a Stick outage the missing buffers are
+read back, at most BACKFILL_BUFFERS_PER_RUN every "backfill_period" ms. The
+backfill job is scheduled by `start()`, so it doesn't need an entry in the
+"schedules" of MainMonitoringSystem configuration.
+
 Looking into code and `Plugwise-2-py <https://github.com/SevenW/Plugwise-2-py>`_
 it seems that 1 second sampling period is allowed but 8-10 seconds would obtain
 better resolution from pulse counters.
@@ -25,12 +36,31 @@ This module allow commands givan as MQTT messages with the following structure::
     plugwise/MACADDRESS/state
 
 with the content 'on' or 'off'.
+
+Every circle is polled with its own period, given in the optional "period"
+field of its entry in the plugwise configuration (by default the global
+"period"), as a multiple of the global period. Offline circles are only
+probed with a ping, with an exponential back-off up to MAX_OFFLINE_BACKOFF
+seconds, and they are polled again as soon as they answer. The relay state is
+read again only every "info_ttl" seconds (plugwise configuration, by default
+plugwise.api.DEFAULT_INFO_TTL) or after a switch command.
+
+Changes of the plugwise configuration are applied at the next publish() round
+without restarting: new circles are added, removed circles are dropped and the
+settings of the rest (tolerance, alert threshold, period...) are updated, a
+circle whose period changes is polled again at the next round. The global
+"period" and "backfill_period" are only read at start, their new values are
+ignored, also as default period of the circles.
 """
 
 # Copyright (C) 2015 Miguel Lorenzo, Francisco Zamora-Martinez
 # Use of this source code is governed by the GPLv3 license found in the LICENSE file.
 
+import calendar
 import json
+import math
+import os
+import threading
 import time
 import traceback
 
@@ -42,6 +72,11 @@ import raspi_mon_sys.Utils as Utils
 # Plugwise connection configuration.
 MAX_TIME_BETWEEN_READINGS = 1800
 DEFAULT_POWER_TOLERANCE = 0.0
+MAX_OFFLINE_BACKOFF = 300 # maximum seconds between pings to an offline circle
+BACKFILL_PERIOD = 10000 # mili-seconds between runs of backfill()
+BACKFILL_BUFFERS_PER_RUN = 4 # log buffers read in every run of backfill()
+MAX_BACKFILL_BUFFERS = 1024 # older log buffers are not read after an outage
+DEFAULT_BACKFILL_STATE_PATH = "/var/tmp/raspimon_plugwise_backfill.json"
 DEFAULT_SERIAL_PORT = "/dev/ttyUSB0" # USB port used by Plugwise receiver
 OUTPUT_LIST = [ {"key":0,"suffix":"1s"}, {"key":1,"suffix":"8s"} ]
 
@@ -53,6 +88,10 @@ device = None
 circles_config = None
 circles = None
 mac2circle = None
+backfill_state = None
+backfill_job = None
+pending_config = None
+circles_lock = threading.Lock()
 verbose = False
 
 def __on_connect(client, userdata, rc):
@@ -73,6 +112,97 @@ def __on_message(client, userdata, msg):
             elif message == "off": c.switch_off()
             else: logger.error("Unknown message value: %s", message)
 
+def __reschedule(circle_data, now, online):
+    """Computes the next poll time of a circle, aligned to its period when it is
+    online and with an exponential back-off when it is offline."""
+    period = circle_data["poll_period"]
+    if online:
+        circle_data["backoff"] = period
+        circle_data["next_poll"] = (math.floor(now / period) + 1) * period
+    else:
+        circle_data["backoff"] = min(2*circle_data["backoff"], MAX_OFFLINE_BACKOFF)
+        circle_data["next_poll"] = now + circle_data["backoff"]
+
+def __load_backfill_state():
+    try:
+        with open(config.get("backfill_state_path", DEFAULT_BACKFILL_STATE_PATH)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+    except ValueError:
+        logger.info("Unable to parse plugwise backfill state, starting from scratch")
+        return {}
+
+def __save_backfill_state():
+    path = config.get("backfill_state_path", DEFAULT_BACKFILL_STATE_PATH)
+    try:
+        with open(path + ".tmp", "w") as f: json.dump(backfill_state, f)
+        os.rename(path + ".tmp", path)
+    except:
+        print "Unexpected error:", traceback.format_exc()
+        logger.info("Unable to write plugwise backfill state: %s", traceback.format_exc())
+
+def __init_circle(circle_data):
+    """Returns the Circle of a circle configuration, adding to it the fields
+    used to track its readings."""
+    c = plugwise_api.Circle(logger, circle_data["mac"], device, {
+        "name" : circle_data["name"],
+        "location" : circle_data["desc"],
+        "always_on" : "False",
+        "production" : "True",
+        "info_ttl" : config.get("info_ttl", plugwise_api.DEFAULT_INFO_TTL)
+    })
+    circle_data["state"] = "NA"
+    circle_data["poll_period"] = circle_data.get("period", config["period"]) / 1000.0
+    circle_data["backoff"] = circle_data["poll_period"]
+    circle_data["next_poll"] = 0.0
+    circle_data["probe"] = None
+    for v in OUTPUT_LIST:
+        circle_data["power" + v["suffix"]] = -10000.0
+        circle_data["when" + v["suffix"]] = 0.0
+    return c
+
+def __on_config_change(new_config):
+    global pending_config
+    # applied by publish(), so the circles lists don't change during a round
+    pending_config = new_config
+
+def __apply_config(new_config):
+    """Replaces the circles lists following the given configuration. Known
+    circles keep their Circle and tracked readings, and the global periods
+    scheduled at start are kept."""
+    global config, circles_config, circles, mac2circle
+    tracked = [ "state", "backoff", "next_poll", "probe" ] + \
+              [ x + v["suffix"] for v in OUTPUT_LIST for x in ("power", "when") ]
+    old = dict( (x["mac"], (x, circles[i])) for i,x in enumerate(circles_config) )
+    new_circles_config = []
+    new_circles = []
+    new_mac2circle = {}
+    for k in ("period", "backfill_period"):
+        if k in config: new_config[k] = config[k]
+        else: new_config.pop(k, None)
+    config = new_config
+    for circle_data in new_config["circles"]:
+        mac = circle_data["mac"]
+        if mac in old:
+            old_data,c = old[mac]
+            for k in tracked: circle_data[k] = old_data[k]
+            circle_data["poll_period"] = circle_data.get("period", config["period"]) / 1000.0
+            if circle_data["poll_period"] != old_data["poll_period"]:
+                circle_data["backoff"] = circle_data["poll_period"]
+                circle_data["next_poll"] = 0.0
+        else:
+            c = __init_circle(circle_data)
+        new_circles_config.append(circle_data)
+        new_circles.append(c)
+        new_mac2circle[mac] = c
+    with circles_lock:
+        circles_config = new_circles_config
+        circles = new_circles
+        mac2circle = new_mac2circle
+    logger.info("Plugwise configuration changed, %d circles (%d new)",
+                len(new_circles), len(set(new_mac2circle) - set(old)))
+
 def __configure(client):
     client.on_connect = __on_connect
     client.on_message = __on_message
@@ -87,59 +217,90 @@ def start():
     global circles_config
     global circles
     global mac2circle
+    global backfill_state
+    global backfill_job
     logger  = LoggerClient.open("PlugwiseMonitor")
     if not verbose: logger.config(logger.levels.WARNING, logger.schedules.DAILY)
-    config  = Utils.getconfig("plugwise", logger)
+    config  = Utils.getconfig("plugwise", logger, __on_config_change)
     assert config is not None
     device  = plugwise_api.Stick(logger, DEFAULT_SERIAL_PORT)
 
     # circles_config is a list of dictionaries: name, mac, desc.  state field is
-    # added in next loop to track its value so it can be used to only send
+    # added by __init_circle() to track its value so it can be used to only send
     # messages in state transitions. power1s and power8s field is used to check
     # the relative difference in power in order to reduce the network overhead.
     circles_config = config["circles"]
     circles = []
     mac2circle = {}
     for circle_data in circles_config:
-        mac = circle_data["mac"]
-        circles.append( plugwise_api.Circle(logger, mac, device, {
-            "name" : circle_data["name"],
-            "location" : circle_data["desc"],
-            "always_on" : "False",
-            "production" : "True"
-        }) )
-        mac2circle[mac] = circles[-1]
-        circle_data["state"] = "NA"
-        for v in OUTPUT_LIST:
-            circle_data["power" + v["suffix"]] = -10000.0
-            circle_data["when" + v["suffix"]] = 0.0
+        circles.append( __init_circle(circle_data) )
+        mac2circle[circle_data["mac"]] = circles[-1]
     
+    backfill_state = __load_backfill_state()
     client = Utils.getpahoclient(logger, __configure)
     client.loop_start()
+    backfill_job = Scheduler.repeat_every(config.get("backfill_period", BACKFILL_PERIOD), backfill)
+    Scheduler.set_job_name(backfill_job, "PlugwiseMonitor.backfill")
 
 def stop():
+    Scheduler.remove(backfill_job)
     client.disconnect()
+    device.close()
     logger.close()
 
 def publish():
-    """Publishes circle messages via MQTT."""
+    """Publishes circle messages via MQTT.
+
+    Requests to the circles due in this round are pipelined through the Stick,
+    so a poll round costs about one round-trip. Offline circles are pinged
+    without waiting for the answer, so they don't delay the rest.
+    """
+    global pending_config
     try:
-        # All circles messages are generated together and before sending data
-        # via MQTT. This way sending data overhead is ignored and we expect
-        # similar timestamps between all circles.
+        if pending_config is not None:
+            new_config,pending_config = pending_config,None
+            __apply_config(new_config)
+        now = time.time()
+        # pings to offline circles complete in background, a circle which
+        # answered is polled in this round
+        for i,x in enumerate(circles_config):
+            if x["probe"] is not None and x["probe"].done():
+                x["probe"] = None
+                if circles[i].online: x["next_poll"] = now
+                else: __reschedule(x, now, False)
+        # half a global period of tolerance absorbs the scheduler jitter
+        due_time = now + config["period"] / 2000.0
+        due = [ i for i,x in enumerate(circles_config)
+                if x["next_poll"] <= due_time and x["probe"] is None ]
+        # All circles requests are sent together and responses are collected
+        # before sending data via MQTT. This way sending data overhead is
+        # ignored and we expect similar timestamps between all circles.
+        futures = {}
+        for i in due:
+            c = circles[i]
+            if c.online:
+                # relay state is read again only when the cached info expires
+                info_future = c.get_info_async() if c.info_expired() else None
+                futures[i] = (c.get_power_usage_async(), info_future)
+            else:
+                circles_config[i]["probe"] = c.ping_async()
+        device.wait([ f for pair in futures.values() for f in pair if f is not None ])
         messages = []
-        for i,c in enumerate(circles):
-            config = circles_config[i]
-            t    = time.time()
-            mac  = config["mac"]
-            name = config["name"]
-            last_powers = [ config["power"+x["suffix"]] for x in OUTPUT_LIST ]
-            last_state = config["state"]
+        for i in sorted(futures):
+            c = circles[i]
+            circle_data = circles_config[i]
+            power_future,info_future = futures[i]
+            t    = power_future.timestamp or time.time()
+            mac  = circle_data["mac"]
+            name = circle_data["name"]
+            last_powers = [ circle_data["power"+x["suffix"]] for x in OUTPUT_LIST ]
+            last_state = circle_data["state"]
             try:
-                reading = c.get_power_usage()
+                reading = power_future.result()
                 powers  = [ reading[x["key"]] for x in OUTPUT_LIST ]
-                state   = c.get_info()['relay_state']
-                alert_below_th = config.get("alert_below_threshold", None)
+                if info_future is not None: info_future.result()
+                state   = c.relay_state
+                alert_below_th = circle_data.get("alert_below_threshold", None)
                 for i,p in enumerate(powers):
                     p = max(0, p)
                     key = OUTPUT_LIST[i]["key"]
@@ -147,19 +308,20 @@ def publish():
                     if alert_below_th is not None and p < alert_below_th:
                         logger.alert("Value %f %s for circle %s registered with name %s is below threshold %f",
                                      float(p), suffix, mac, name, float(alert_below_th))
-                    if Utils.compute_relative_difference(last_powers[i], p) > config.get("tolerance",DEFAULT_POWER_TOLERANCE) or t - config["when"+suffix] > MAX_TIME_BETWEEN_READINGS:
+                    if Utils.compute_relative_difference(last_powers[i], p) > circle_data.get("tolerance",DEFAULT_POWER_TOLERANCE) or t - circle_data["when"+suffix] > MAX_TIME_BETWEEN_READINGS:
                         usage_message = { 'timestamp' : t, 'data': p }
                         messages.append( (topic.format(name, "power"+suffix, mac), usage_message) )
-                        config["power"+suffix] = p
-                        config["when"+suffix] = t
+                        circle_data["power"+suffix] = p
+                        circle_data["when"+suffix] = t
                 # check state transition before message is appended
                 if state != last_state:
                     state_message = { 'timestamp' : t, 'data' : state }
                     messages.append( (topic.format(name, "state", mac), state_message) )
-                    config["state"] = state # track current state value
+                    circle_data["state"] = state # track current state value
             except:
                 print "Unexpected error:", traceback.format_exc()
                 logger.info("Error happened while processing circles data: %s", traceback.format_exc())
+            __reschedule(circle_data, now, c.online)
         for top,message in messages:
             client.publish(top, json.dumps(message))
     except:
@@ -167,11 +329,78 @@ def publish():
         logger.error("Error happened while processing circles data")
         raise
 
+def backfill():
+    """Publishes the circles log buffers written since the last consumed one.
+
+    Log buffers are requested back-to-back, one circle after another, at most
+    BACKFILL_BUFFERS_PER_RUN in every run so live polling is not starved.
+    """
+    try:
+        # a consistent view of the circles, they may change between rounds
+        with circles_lock: current_circles,current_circles_config = circles,circles_config
+        previous_state = dict(backfill_state)
+        missing = {}
+        for i,c in enumerate(current_circles):
+            if not c.online: continue
+            mac = current_circles_config[i]["mac"]
+            try:
+                # the current log buffer is still being written
+                last = c.get_cached_info()["last_logaddr"] - 1
+            except (plugwise_api.TimeoutException, plugwise_api.SerialException):
+                continue
+            consumed = backfill_state.get(mac)
+            if consumed is None or consumed > last:
+                # unknown circle or log addresses wrapped around
+                backfill_state[mac] = last
+                continue
+            if last - consumed > MAX_BACKFILL_BUFFERS:
+                logger.info("Losing %d log buffers of circle %s", last - consumed - MAX_BACKFILL_BUFFERS, mac)
+                backfill_state[mac] = consumed = last - MAX_BACKFILL_BUFFERS
+            if consumed < last: missing[i] = range(consumed + 1, last + 1)
+        batch = []
+        while len(batch) < BACKFILL_BUFFERS_PER_RUN and len(missing) > 0:
+            for i in sorted(missing):
+                if len(batch) == BACKFILL_BUFFERS_PER_RUN: break
+                batch.append( (i, missing[i].pop(0)) )
+                if len(missing[i]) == 0: del missing[i]
+        futures = [ current_circles[i].get_power_usage_history_async(addr) for i,addr in batch ]
+        device.wait(futures)
+        messages = []
+        for (i,addr),f in zip(batch, futures):
+            mac  = current_circles_config[i]["mac"]
+            name = current_circles_config[i]["name"]
+            # buffers are consumed in order, a failed one is retried next run
+            if backfill_state[mac] != addr - 1: continue
+            try:
+                log = f.result()
+            except (plugwise_api.TimeoutException, plugwise_api.SerialException):
+                continue
+            prev_dt = None
+            for dt,watt,watthour in log:
+                # production values repeat the timestamp of usage values
+                if dt == prev_dt: continue
+                prev_dt = dt
+                message = { 'timestamp' : calendar.timegm(dt.utctimetuple()), 'data' : max(0, watt) }
+                messages.append( (topic.format(name, "powerlog", mac), message) )
+            backfill_state[mac] = addr
+        if backfill_state != previous_state: __save_backfill_state()
+        for top,message in messages:
+            client.publish(top, json.dumps(message))
+    except:
+        print "Unexpected error:", traceback.format_exc()
+        logger.error("Error happened while backfilling circles data")
+
 if __name__ == "__main__":
     Utils.startup_wait()
-    start()
+    # start() schedules the backfill job, so the scheduler runs first
     Scheduler.start()
-    Scheduler.repeat_o_clock(config["period"], publish)
+    start()
+    uuid = Scheduler.repeat_o_clock(config["period"], publish)
+    Scheduler.set_job_name(uuid, "PlugwiseMonitor.publish")
+    if "scheduler_stats_period" in config:
+        Scheduler.repeat_o_clock(config["scheduler_stats_period"],
+                                 Scheduler.publish_stats, client,
+                                 Utils.gettopic("scheduler/{0}/{1}"))
     try:
         while True:
             time.sleep(60)
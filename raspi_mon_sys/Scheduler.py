@@ -18,10 +18,41 @@ any function scheduling, and `stop()` function once the program is ready to its
 termination. If the program is intended to run forever, you can use
 `loop_forever()` function which never returns.
 
+Pending jobs are kept in a binary heap indexed by job, so `remove()` takes them
+out of the scheduler in logarithmic time. Jobs are executed by a fixed pool of
+worker threads (see `start()`), instead of creating a new thread for every
+execution. When a repeated job is still running at its next tick, the scheduler
+follows the job overlap policy, which can be changed with
+`set_overlap_policy()`:
+
+- `OVERLAP_SKIP` ignores the tick (default).
+- `OVERLAP_QUEUE` runs the job again as soon as current execution finishes.
+  Ticks arrived meanwhile are coalesced into one run, the rest count as
+  skipped, so a job which always overruns doesn't build a backlog.
+- `OVERLAP_CONCURRENT` runs the job in another worker at the same time.
+
+Every execution is measured: how late it started compared with its expected
+time, how long it ran and whether it overran the period of the job. These
+measures are accumulated as histograms indexed by job name, which by default is
+`MODULE.FUNCTION`, followed by `.N` when another scheduled job already has that
+name (for instance the same function with other arguments), and can be changed
+with `set_job_name()`. Jobs given the same name share their statistics. They are available
+using `get_stats()`, and they can be published via MQTT using
+`publish_stats()`.
+
 **ATTENTION**: this module uses UTC timestamps, so don't expect it to be
 correlated with your timezone. Add the required offset to timestamps depending
 in your timezone if you really need it.
 
+Jobs are ordered and waited using a monotonic clock (`CLOCK_MONOTONIC`), so
+NTP corrections don't change the period of `repeat_every()` jobs and don't
+stall the scheduler. Jobs aligned with the wall clock (`once_when()`,
+`once_o_clock()`, `repeat_o_clock()` and `repeat_o_clock_with_offset()`) are
+re-anchored when a clock step larger than `CLOCK_STEP_THRESHOLD` mili-seconds
+is detected. After a step, every repeated job is executed once at its next
+wall clock alignment, without catching up missed executions. If the monotonic
+clock is not available, `MONOTONIC` is False and wall clock is used for all.
+
 Example:
 
 >>> import Scheduler
@@ -29,6 +60,7 @@ Example:
 >>> Scheduler.start()
 >>> a = Scheduler.repeat_every(5000, say, "Hello", "World")
 >>> b = Scheduler.repeat_o_clock(60000, say, "One", "Minute")
+>>> Scheduler.set_overlap_policy(b, Scheduler.OVERLAP_QUEUE)
 >>> DO_STUFF()
 >>> Scheduler.remove(a)
 >>> DO_STUFF()
@@ -47,6 +79,14 @@ Another Example:
 All functions receive mili-second resolution as integer values.
 
 """
+import bisect
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import json
+import os
+import select
 import time
 import threading
 import traceback
@@ -67,6 +107,25 @@ T1_HOUR = 3600000
 T1_DAY = 24 * T1_HOUR
 T1_WEEK = 7 * T1_DAY
 
+# Policies for repeated jobs which are still running when next tick arrives.
+OVERLAP_SKIP = "skip"
+OVERLAP_QUEUE = "queue"
+OVERLAP_CONCURRENT = "concurrent"
+
+DEFAULT_NUM_WORKERS = 8
+
+# Minimum difference in mili-seconds between wall and monotonic clocks to be
+# considered a clock step.
+CLOCK_STEP_THRESHOLD = 500
+# Maximum time in mili-seconds waited by main thread before checking clocks.
+MAX_WAIT = 1000
+DEFAULT_OVERLAP_POLICY = OVERLAP_SKIP
+
+# Upper bounds in mili-seconds of histogram buckets used for job statistics,
+# plus an implicit overflow bucket.
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500,
+                    1000, 2000, 5000, 10000, 60000)
+
 __TRANSFORMATION_DICT = {
     "s" : lambda x: x*T1_SECOND,
     "m" : lambda x: x*T1_MINUTE,
@@ -75,14 +134,140 @@ __TRANSFORMATION_DICT = {
     "w" : lambda x: x*T1_WEEK,
 }
 
-# Set of removed jobs.
-__removed = set()
-# Queue of pending jobs. Every job is tuple (timestamp, (function, args, kwargs)).
-__jobs = Queue.PriorityQueue()
-# Event to awake main thread when jobs are ready or sleep time has passed.
-__awake = threading.Event()
-# List of pending threads, in order to execute join when the terminate.
-__running = []
+__OVERLAP_POLICIES = set([OVERLAP_SKIP, OVERLAP_QUEUE, OVERLAP_CONCURRENT])
+
+class _Job(object):
+    """Internal state of a scheduled job.
+
+    The `when` field is the monotonic timestamp of next execution, and `wall` is
+    its wall clock timestamp for jobs aligned with the wall clock (None for
+    the rest). The `index` field keeps the position of the job in the heap, it
+    is -1 when the job is not enqueued. The `repeat` field is a function which
+    receives the job, current monotonic and wall times and returns the
+    monotonic timestamp of next execution, or None for jobs executed only once.
+    """
+    __slots__ = ("uuid", "name", "when", "wall", "seq", "index", "func",
+                 "args", "kwargs", "repeat", "period", "offset", "overlap",
+                 "running", "queued", "cancelled")
+
+    def __init__(self, uuid, when, func, args, kwargs):
+        self.uuid = uuid
+        module = getattr(func, "__module__", None) or "unknown"
+        self.name = module.split(".")[-1] + "." + getattr(func, "__name__", "unknown")
+        self.when = when
+        self.wall = None
+        self.seq = 0
+        self.index = -1
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.repeat = None
+        self.period = None
+        self.offset = None
+        self.overlap = DEFAULT_OVERLAP_POLICY
+        self.running = 0
+        # expected times of queued executions
+        self.queued = []
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+class _Histogram(object):
+    """Counts values into buckets bounded by HISTOGRAM_BOUNDS."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max: self.max = value
+
+    def percentile(self, q):
+        """Returns the upper bound of the bucket containing the q quantile."""
+        if self.count == 0: return 0.0
+        target = q * self.count
+        acc = 0
+        for i,n in enumerate(self.buckets):
+            acc += n
+            if acc >= target and i < len(HISTOGRAM_BOUNDS):
+                return float(min(HISTOGRAM_BOUNDS[i], self.max))
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count" : self.count,
+            "mean" : self.total / self.count if self.count > 0 else 0.0,
+            "max" : self.max,
+            "bounds" : list(HISTOGRAM_BOUNDS),
+            "buckets" : list(self.buckets),
+        }
+
+class _JobStats(object):
+    """Timing statistics of all the jobs sharing a name."""
+
+    def __init__(self):
+        self.lateness = _Histogram()
+        self.duration = _Histogram()
+        self.overruns = 0
+        self.skipped = 0
+
+    def to_dict(self):
+        return {
+            "runs" : self.duration.count,
+            "overruns" : self.overruns,
+            "skipped" : self.skipped,
+            "lateness" : self.lateness.to_dict(),
+            "duration" : self.duration.to_dict(),
+        }
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [ ("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long) ]
+
+def __load_clock_gettime():
+    """Returns libc clock_gettime function or None if it is not available."""
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library("rt") or
+                          ctypes.util.find_library("c"), use_errno=True)
+        func = lib.clock_gettime
+        func.argtypes = [ ctypes.c_int, ctypes.POINTER(_Timespec) ]
+        if func(__CLOCK_MONOTONIC, ctypes.byref(_Timespec())) != 0: return None
+        return func
+    except:
+        return None
+
+__CLOCK_MONOTONIC = 1
+__clock_gettime = __load_clock_gettime()
+MONOTONIC = __clock_gettime is not None
+
+# Lock protecting all scheduler state.
+__lock = threading.RLock()
+# Pipe used to awake main thread when jobs change or scheduler is stopped.
+# Waiting with select() is not affected by wall clock steps, contrary to
+# Python 2 Condition.wait().
+__wakeup_r, __wakeup_w = os.pipe()
+fcntl.fcntl(__wakeup_w, fcntl.F_SETFL, os.O_NONBLOCK)
+fcntl.fcntl(__wakeup_r, fcntl.F_SETFL, os.O_NONBLOCK)
+# Difference between wall and monotonic clocks at last check.
+__clock_offset = None
+# Heap of pending jobs, ordered by (when, seq).
+__heap = []
+# Mapping between UUIDs and alive jobs.
+__jobs = {}
+# Sequence counter, it keeps FIFO order of jobs with equal timestamp.
+__seq = 0
+# Queue of jobs ready to be executed by worker threads.
+__ready = Queue.Queue()
+# Statistics indexed by job name, protected by its own lock.
+__stats = {}
+__stats_lock = threading.Lock()
+# Pool of worker threads.
+__workers = []
 # Thread for main function execution.
 __main_thread = None
 __main_thread_running = False
@@ -98,6 +283,34 @@ def __transform(msec):
 def __gettime():
     return time.time()*1000
 
+def __monotonic():
+    """Returns a monotonic timestamp in mili-seconds."""
+    if __clock_gettime is None: return __gettime()
+    ts = _Timespec()
+    if __clock_gettime(__CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        raise OSError(ctypes.get_errno(), "clock_gettime failed")
+    return ts.tv_sec*1000.0 + ts.tv_nsec/1000000.0
+
+def __notify():
+    """Awakes the main thread."""
+    try:
+        os.write(__wakeup_w, b"x")
+    except OSError as e:
+        if e.errno != errno.EAGAIN: raise
+
+def __wait(seconds):
+    """Waits the given seconds or until __notify() is called."""
+    try:
+        r,_,_ = select.select([__wakeup_r], [], [], seconds)
+    except select.error as e:
+        if e.args[0] != errno.EINTR: raise
+        return
+    if r:
+        try:
+            while os.read(__wakeup_r, 4096): pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN: raise
+
 def __run_threaded(job_func, *args, **kwargs):
     """Executes the given function with args and kwargs in a thread."""
     job_thread = threading.Thread(target=job_func, args=args, kwargs=kwargs)
@@ -107,84 +320,225 @@ def __run_threaded(job_func, *args, **kwargs):
         print "Unexpected error:", traceback.format_exc()
     return job_thread
 
-def __check_running_threads(timeout=0.0):
-    """Traverses __running list looking for joinable threads."""
-    global __running
-    r = []
-    for th in __running:
-        th.join(timeout)
-        if th.isAlive():
-            r.append(th)
-    __running = r
+def __heap_swap(i, j):
+    __heap[i], __heap[j] = __heap[j], __heap[i]
+    __heap[i].index = i
+    __heap[j].index = j
+
+def __heap_sift_up(i):
+    while i > 0:
+        parent = (i - 1) >> 1
+        if not __heap[i] < __heap[parent]: break
+        __heap_swap(i, parent)
+        i = parent
+
+def __heap_sift_down(i):
+    n = len(__heap)
+    while True:
+        child = 2*i + 1
+        if child >= n: break
+        if child + 1 < n and __heap[child+1] < __heap[child]: child += 1
+        if not __heap[child] < __heap[i]: break
+        __heap_swap(i, child)
+        i = child
+
+def __heap_push(job):
+    """Inserts the job into the heap, O(log n)."""
+    global __seq
+    __seq += 1
+    job.seq = __seq
+    job.index = len(__heap)
+    __heap.append(job)
+    __heap_sift_up(job.index)
+
+def __heap_rebuild():
+    """Restores the heap property after changing timestamps of many jobs."""
+    __heap.sort()
+    for i,job in enumerate(__heap): job.index = i
+
+def __heap_remove(job):
+    """Removes the job from any position of the heap, O(log n)."""
+    i = job.index
+    last = __heap.pop()
+    job.index = -1
+    if last is not job:
+        __heap[i] = last
+        last.index = i
+        __heap_sift_up(i)
+        __heap_sift_down(last.index)
+
+def __get_job_stats(name):
+    """Returns the statistics for the given job name. It should be called with
+    __stats_lock acquired."""
+    stats = __stats.get(name)
+    if stats is None:
+        stats = __stats[name] = _JobStats()
+    return stats
+
+def __record_skip(job):
+    with __stats_lock:
+        __get_job_stats(job.name).skipped += 1
+
+def __record_run(job, expected_when, started, finished):
+    duration = finished - started
+    with __stats_lock:
+        stats = __get_job_stats(job.name)
+        stats.lateness.add(max(0.0, started - expected_when))
+        stats.duration.add(duration)
+        if job.period is not None and duration > job.period:
+            stats.overruns += 1
+
+def __execute(job, expected_when):
+    """Executes the job function, and repeats it while it has queued runs. A job
+    removed after being dispatched isn't executed, so one-shot jobs are kept in
+    __jobs until their execution starts."""
+    with __lock:
+        if job.repeat is None: __jobs.pop(job.uuid, None)
+        if job.cancelled:
+            job.running -= 1
+            return
+    while True:
+        started = __monotonic()
+        try:
+            job.func(*job.args, **job.kwargs)
+        except:
+            print "Unexpected error:", traceback.format_exc()
+        __record_run(job, expected_when, started, __monotonic())
+        with __lock:
+            if len(job.queued) > 0 and not job.cancelled:
+                expected_when = job.queued.pop(0)
+                continue
+            job.running -= 1
+            return
+
+def __worker_loop():
+    """Executes jobs from __ready queue until a None job is received."""
+    while True:
+        item = __ready.get()
+        if item is None: break
+        __execute(*item)
+
+def __dispatch(job, expected_when):
+    """Decides if the job has to be executed. It should be called with
+    __lock acquired."""
+    if job.running > 0 and job.repeat is not None:
+        if job.overlap == OVERLAP_SKIP:
+            __record_skip(job)
+            return False
+        elif job.overlap == OVERLAP_QUEUE:
+            # at most one pending run, expected at the latest tick
+            if len(job.queued) > 0: __record_skip(job)
+            job.queued[:] = [ expected_when ]
+            return False
+    job.running += 1
+    return True
+
+def __check_clock_step(now, wall_now):
+    """Re-anchors jobs aligned with wall clock when a clock step is detected.
+    It should be called with __lock acquired."""
+    global __clock_offset
+    offset = wall_now - now
+    if __clock_offset is not None and abs(offset - __clock_offset) > CLOCK_STEP_THRESHOLD:
+        print "Clock step of %.0f ms detected, re-anchoring wall clock jobs"%(offset - __clock_offset)
+        for job in __heap:
+            if job.wall is None: continue
+            if job.repeat is __next_o_clock:
+                job.wall = __next_o_clock_wall(job.period, job.offset, wall_now)
+            job.when = now + (job.wall - wall_now)
+        __heap_rebuild()
+    __clock_offset = offset
 
 def __main_loop():
-    """Traverses the priority queue __jobs executing jobs in order.
+    """Traverses the heap of jobs executing jobs in order.
 
-    When a job is ready (its timestamp has passed), it is executed. Otherwise,
-    the main thread will wait until the expected timestamp or until __awake
-    condition is notified.
+    When a job is ready (its timestamp has passed), it is sent to the worker
+    pool. Otherwise, the main thread will wait until the expected timestamp
+    (at most MAX_WAIT mili-seconds) or until __notify() is called. Repeated
+    jobs are rescheduled when they are sent to the worker pool, so their
+    period doesn't depend on the execution time of the job.
     """
-    while __main_thread_running:
-        __check_running_threads()
-        when, uuid, data = __jobs.get()
-        if uuid in __removed:
-            __removed.discard(uuid)
-            continue
-        amount = when - __gettime()
-        if amount > 0:
-            __jobs.put((when, uuid, data))
-            amount = when - __gettime()
-            if amount > 0:
-                __awake.wait(amount/1000.0)
-                __awake.clear()
-        else:
-            job, args, kwargs = data
-            __running.append(__run_threaded(job, *args, **kwargs))
+    while True:
+        ready = False
+        with __lock:
+            if not __main_thread_running: return
+            now = __monotonic()
+            wall_now = __gettime()
+            __check_clock_step(now, wall_now)
+            timeout = None
+            if len(__heap) > 0:
+                amount = __heap[0].when - now
+                if amount <= 0:
+                    job = __heap[0]
+                    __heap_remove(job)
+                    expected_when = job.when
+                    if job.repeat is not None:
+                        job.when = job.repeat(job, now, wall_now)
+                        __heap_push(job)
+                    ready = __dispatch(job, expected_when)
+                else:
+                    timeout = min(amount, MAX_WAIT) / 1000.0
+            else:
+                timeout = MAX_WAIT / 1000.0
+        if ready: __ready.put( (job, expected_when) )
+        elif timeout is not None: __wait(timeout)
+
+def __next_every(job, now, wall_now):
+    """Returns next timestamp of a job repeated every job.period mili-seconds.
+
+    This function uses job.when (the expected time) in order to improve
+    precision of next repetition.
+    """
+    diff = now - job.when
+    amount = job.period - diff
+    if amount < 0:
+        return now + amount % job.period
+    return job.when + job.period
 
-def __once_after(mili_seconds, uuid, func, *args, **kwargs):
-    """Executes the given job function after given mili-seconds amount."""
-    if __main_thread_running:
-        now = __gettime()
-        when = now + mili_seconds
-        __jobs.put((when, uuid, (func, args, kwargs)))
-        __awake.set()
-    else:
-        raise Exception("Unable to enqueue any job while Scheduler is stopped.")
+def __next_o_clock_wall(mili_seconds, offset, wall_now):
+    """Returns next wall timestamp multiple of mili_seconds plus offset."""
+    return wall_now + (mili_seconds - ((wall_now - offset) % mili_seconds))
 
-def __repeated_job(mili_seconds, expected_when, uuid, func, *args, **kwargs):
-    """Repeats execution of a function every mili-seconds.
+def __next_o_clock(job, now, wall_now):
+    """Returns next timestamp multiple of job.period plus job.offset.
 
-    This function uses expected_when in order to improve precision of next
-    repetition.
+    The next wall timestamp is computed after the one of current execution,
+    so small differences between clocks never repeat an execution.
     """
-    try:
-        func(*args, **kwargs)
-    except:
-        print "Unexpected error:", traceback.format_exc()
-    now = __gettime()
-    diff = now - expected_when
-    amount = mili_seconds - diff
-    if amount < 0:
-        amount = amount % mili_seconds
-        expected_when = now + amount
-    else:
-        expected_when += mili_seconds
-    __once_after(amount, uuid, __repeated_job, mili_seconds, expected_when, uuid,
-                 func, *args, **kwargs)
-
-def __repeated_o_clock_with_offset(mili_seconds, offset, uuid,
-                                   func, *args, **kwargs):
-    """Repeats execution of job function at next time multiple of the
-    given mili-seconds plus the given offset.
-    """
-    try:
-        func(*args, **kwargs)
-    except:
-        print "Unexpected error:", traceback.format_exc()
-    now = __gettime()
-    when = now + (mili_seconds - ((now-offset) % mili_seconds))
-    __once_after(when - now, uuid, __repeated_o_clock_with_offset,
-                 mili_seconds, offset, uuid, func, *args, **kwargs)
+    job.wall = __next_o_clock_wall(job.period, job.offset,
+                                   max(wall_now, job.wall + 1))
+    return now + (job.wall - wall_now)
+
+def __once_after(mili_seconds, uuid, func, *args, **kwargs):
+    """Executes the given job function after given mili-seconds amount."""
+    return __enqueue(__monotonic() + mili_seconds, uuid, func, args, kwargs)
+
+def __once_at_wall(wall, uuid, func, args, kwargs, repeat=None, period=None,
+                   offset=None):
+    """Executes the given job function at the given wall timestamp."""
+    job = __enqueue(__monotonic() + (wall - __gettime()), uuid, func, args, kwargs,
+                    repeat=repeat, period=period, offset=offset, wall=wall)
+    return job
+
+def __enqueue(when, uuid, func, args, kwargs, repeat=None, period=None,
+              offset=None, wall=None):
+    """Creates a job and pushes it into the heap."""
+    with __lock:
+        if not __main_thread_running:
+            raise Exception("Unable to enqueue any job while Scheduler is stopped.")
+        job = _Job(uuid, when, func, args, kwargs)
+        names = set( x.name for x in __jobs.itervalues() )
+        if job.name in names:
+            i = 2
+            while "%s.%d"%(job.name, i) in names: i += 1
+            job.name = "%s.%d"%(job.name, i)
+        job.wall = wall
+        job.repeat = repeat
+        job.period = period
+        job.offset = offset
+        __jobs[uuid] = job
+        __heap_push(job)
+    __notify()
+    return job
 
 ####################
 ## PUBLIC SECTION ##
@@ -193,11 +547,91 @@ def __repeated_o_clock_with_offset(mili_seconds, offset, uuid,
 def remove(uuid):
     """Allow remove a job scheduled using any repeat_* or once_* functions.
 
-    This function is not removing the job from the scheduler, it uses a set of
-    removed uuids ignoring the execution of the job once it pops out of the
-    priority queue.
+    The job is removed from the scheduler heap. If the job is running at this
+    moment, current execution will finish but no more executions would
+    happen, even if they were already waiting for a free worker.
+    """
+    with __lock:
+        job = __jobs.pop(uuid, None)
+        if job is not None:
+            job.cancelled = True
+            if job.index >= 0: __heap_remove(job)
+    __notify()
+
+def set_overlap_policy(uuid, policy):
+    """Changes the overlap policy of a job scheduled using any repeat_*
+    function.
+
+    The policy indicates what to do when the job is still running at its next
+    tick, and it should be one of `OVERLAP_SKIP`, `OVERLAP_QUEUE` or
+    `OVERLAP_CONCURRENT`.
+    """
+    if policy not in __OVERLAP_POLICIES:
+        raise Exception("Unknown overlap policy %s"%(str(policy)))
+    with __lock:
+        job = __jobs.get(uuid)
+        if job is None:
+            raise Exception("Unknown job %s"%(str(uuid)))
+        job.overlap = policy
+
+def set_job_name(uuid, name):
+    """Changes the name used to accumulate timing statistics of a job, jobs
+    with the same name share their statistics."""
+    with __lock:
+        job = __jobs.get(uuid)
+        if job is None:
+            raise Exception("Unknown job %s"%(str(uuid)))
+        job.name = name
+
+def get_stats(name=None):
+    """Returns timing statistics of executed jobs.
+
+    The result is a dictionary indexed by job name. Every value is a dictionary
+    with the number of `runs`, the number of `overruns` (executions longer than
+    job period), the number of `skipped` executions due to overlap policy, and
+    `lateness` and `duration` histograms in mili-seconds. If a name is given,
+    only the statistics of that job are returned (or None).
     """
-    __removed.add(uuid)
+    with __stats_lock:
+        if name is not None:
+            stats = __stats.get(name)
+            return stats.to_dict() if stats is not None else None
+        return dict( (k,v.to_dict()) for k,v in __stats.iteritems() )
+
+def reset_stats():
+    """Removes all timing statistics."""
+    with __stats_lock:
+        __stats.clear()
+
+def publish_stats(client, topic, reset=True):
+    """Publishes timing statistics using the given MQTT client.
+
+    The topic should be a string with two format placeholders, the first one
+    is replaced by job name and the second one by statistic name, as returned
+    by `Utils.gettopic("scheduler/{0}/{1}")`. Every message follows the usual
+    structure `{"timestamp":t,"data":value}` where value is a number. If reset
+    is True, statistics are removed after publication, so every publication
+    covers the period since the previous one.
+    """
+    t = time.time()
+    with __stats_lock:
+        stats = __stats.items()
+        if reset: __stats.clear()
+    for name,s in stats:
+        values = {
+            "runs" : s.duration.count,
+            "overruns" : s.overruns,
+            "skipped" : s.skipped,
+            "lateness_p50" : s.lateness.percentile(0.50),
+            "lateness_p99" : s.lateness.percentile(0.99),
+            "lateness_max" : s.lateness.max,
+            "duration_p50" : s.duration.percentile(0.50),
+            "duration_p99" : s.duration.percentile(0.99),
+            "duration_max" : s.duration.max,
+        }
+        for k,v in values.iteritems():
+            message = { "timestamp" : t, "data" : v }
+            client.publish(topic.format(name, k), json.dumps(message))
 
 def once_after(mili_seconds, func, *args, **kwargs):
     """Executes the given job function after given mili-seconds amount and returns a UUID."""
@@ -212,17 +646,16 @@ def repeat_every(mili_seconds, func, *args, **kwargs):
     mili_seconds = __transform(mili_seconds)
     assert isinstance(mili_seconds, int), "Needs an integer as mili_seconds parameter"
     uuid = uuid4()
-    __once_after(mili_seconds, uuid, __repeated_job, mili_seconds, __gettime() + mili_seconds, uuid,
-                 func, *args, **kwargs)
+    __enqueue(__monotonic() + mili_seconds, uuid, func, args, kwargs,
+              repeat=__next_every, period=mili_seconds)
     return uuid
 
 def once_when(ms_timestamp, func, *args, **kwargs):
     """Executes job function at the given timestamp in mili-seconds and returns a UUID."""
     assert isinstance(ms_timestamp, int), "Needs an integer as ms_timestamp parameter"
     uuid = uuid4()
-    mili_seconds = ms_timestamp - __gettime()
-    if mili_seconds > 0:
-        __once_after(mili_seconds, uuid, func, *args, **kwargs)
+    if ms_timestamp > __gettime():
+        __once_at_wall(ms_timestamp, uuid, func, args, kwargs)
     else:
         raise Exception("Unable to schedule functions in the past")
     return uuid
@@ -232,9 +665,8 @@ def once_o_clock(mili_seconds, func, *args, **kwargs):
     mili_seconds = __transform(mili_seconds)
     assert isinstance(mili_seconds, int), "Needs an integer as mili_seconds parameter"
     uuid = uuid4()
-    now = __gettime()
-    when = now + (mili_seconds - (now % mili_seconds))
-    __once_after(when - now, uuid, func, *args, **kwargs)
+    __once_at_wall(__next_o_clock_wall(mili_seconds, 0, __gettime()),
+                   uuid, func, args, kwargs)
     return uuid
 
 def repeat_o_clock_with_offset(mili_seconds, offset, func, *args, **kwargs):
@@ -248,10 +680,9 @@ def repeat_o_clock_with_offset(mili_seconds, offset, func, *args, **kwargs):
     assert isinstance(mili_seconds, int), "Needs an integer as mili_seconds parameter"
     assert isinstance(offset, int), "Needs an integer as offset parameter"
     uuid = uuid4()
-    now = __gettime()
-    when = now + (mili_seconds - ((now-offset) % mili_seconds))
-    __once_after(when - now, uuid, __repeated_o_clock_with_offset,
-                 mili_seconds, offset, uuid, func, *args, **kwargs)
+    __once_at_wall(__next_o_clock_wall(mili_seconds, offset, __gettime()),
+                   uuid, func, args, kwargs,
+                   repeat=__next_o_clock, period=mili_seconds, offset=offset)
     return uuid
 
 def repeat_o_clock(mili_seconds, func, *args, **kwargs):
@@ -261,26 +692,45 @@ def repeat_o_clock(mili_seconds, func, *args, **kwargs):
     mili_seconds = __transform(mili_seconds)
     return repeat_o_clock_with_offset(mili_seconds, 0, func, *args, **kwargs)
 
-def start():
-    """Executes the scheduler."""
+def start(num_workers=DEFAULT_NUM_WORKERS):
+    """Executes the scheduler.
+
+    The argument is the number of worker threads used to execute jobs, so at
+    most `num_workers` jobs will be running at the same time.
+    """
     global __main_thread_running
-    if not __main_thread_running:
-        global __main_thread
+    global __clock_offset
+    with __lock:
+        if __main_thread_running: return
         __main_thread_running = True
-        __main_thread = __run_threaded(__main_loop)
+        __clock_offset = None
+    global __main_thread
+    for i in range(num_workers):
+        __workers.append(__run_threaded(__worker_loop))
+    __main_thread = __run_threaded(__main_loop)
 
 def stop():
-    """Stops execution of the scheduler."""
+    """Stops execution of the scheduler.
+
+    Pending jobs are discarded, and this function waits until running jobs
+    finish.
+    """
     global __main_thread_running
-    if __main_thread_running:
-        global __main_thread
+    with __lock:
+        if not __main_thread_running: return
         __main_thread_running = False
-        while not __jobs.empty():
-            __jobs.get()
-        __awake.set()
-        __check_running_threads(None)
-        __main_thread.join()
-        __main_thread = None
+        for job in __jobs.itervalues():
+            job.cancelled = True
+            job.index = -1
+        del __heap[:]
+        __jobs.clear()
+    __notify()
+    global __main_thread
+    __main_thread.join()
+    __main_thread = None
+    for th in __workers: __ready.put(None)
+    for th in __workers: th.join()
+    del __workers[:]
 
 def is_running():
     """Indicates if scheduler has been started."""
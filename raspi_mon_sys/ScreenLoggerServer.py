@@ -32,6 +32,7 @@ import raspi_mon_sys.Utils as Utils
 
 __transport = LoggerClient.default_transport
 __mac_addr  = Utils.getmac()
+__host_prefix = "%s %s"%(socket.gethostname(), __mac_addr)
 
 # Queues of pending messages.
 __hourly_queue = Queue.PriorityQueue()
@@ -45,16 +46,24 @@ __schedules = LoggerClient.schedules
 def __generate_message_line(msg):
     """Given a message it generates a string to be shown at screen or mail."""
     time_str     = datetime.datetime.strftime(msg["datetime"], "%c")
-    host_str     = socket.gethostname()
     name_str     = msg["name"]
     level_str    = msg["level"]
     schedule_str = msg["schedule"]
     text_str     = msg["text"].replace('\n', '\\n')
-    line_str     = "%s %s %s %9s %17s: %s: %s"%(time_str, host_str, __mac_addr,
-                                                level_str, schedule_str,
-                                                name_str, text_str)
+    line_str     = "%s %s %9s %17s: %s: %s"%(time_str, __host_prefix,
+                                             level_str, schedule_str,
+                                             name_str, text_str)
     return line_str
 
+def __receive(s):
+    """Receives a batch of messages, malformed batches are discarded."""
+    frames = s.recv_multipart()
+    try:
+        return LoggerClient.decode_batch(frames)
+    except ValueError:
+        print "Unexpected error:", traceback.format_exc()
+        return []
+
 def __process_message(msg):
     sched = msg["schedule"]
     txt   = __generate_message_line(msg)
@@ -75,8 +84,8 @@ def start(transport_string=__transport):
     print("Running server at ZMQ transport: " + transport_string)
     try:
         while True:
-            msg   = s.recv_pyobj()
-            __process_message(msg)
+            for msg in __receive(s):
+                __process_message(msg)
     except:
         __process_message({
             "name" : "ScreenLoggerServer",
@@ -0,0 +1,209 @@
+"""Compression of the time series stored in GVA2015_data hour documents.
+
+Compressed documents replace "delta_times" and "values" arrays by::
+
+    {
+        "encoding": ENCODING,
+        "count": NUMBER OF POINTS,
+        "data": BSON BINARY WITH THE COMPRESSED POINTS
+    }
+
+The binary data starts with a packed header with the format version, a flags
+byte and the number of points, followed by a bit stream with the timestamps
+and then the values:
+
+- delta_times are stored in milliseconds, the first one with 32 bits and the
+  rest as the difference between consecutive deltas (delta-of-delta) with a
+  variable length prefix code.
+- values are 64 bits floats, the first one stored as is and the rest as the XOR
+  with the previous value, storing only its meaningful bits, as done by
+  Facebook's Gorilla time series database.
+
+Values which are all integers are restored as integers. Series with values
+which are not numbers can't be compressed, `encode()` returns None for them.
+
+This module is shared with the Grafana data source servers, which decode the
+documents with `decode_document()`.
+"""
+
+# Copyright (C) 2015 Miguel Lorenzo, Francisco Zamora-Martinez
+# Use of this source code is governed by the GPLv3 license found in the LICENSE file.
+
+import struct
+
+ENCODING = "gorilla-v1"
+VERSION = 1
+FLAG_INTEGRAL = 1
+
+_HEADER = struct.Struct("!BBI") # version, flags, number of points
+_DOUBLE = struct.Struct("!d")
+_UINT64 = struct.Struct("!Q")
+
+# delta-of-delta prefix codes: (prefix, prefix bits, value bits)
+_DOD_CODES = ( (0b10, 2, 7), (0b110, 3, 12), (0b1110, 4, 16), (0b1111, 4, 32) )
+
+class _BitWriter(object):
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, n):
+        self.acc = (self.acc << n) | value
+        self.nbits += n
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.out.append( (self.acc >> self.nbits) & 0xFF )
+        self.acc &= (1 << self.nbits) - 1
+
+    def getvalue(self):
+        if self.nbits > 0:
+            self.out.append( (self.acc << (8 - self.nbits)) & 0xFF )
+            self.acc = self.nbits = 0
+        return str(self.out)
+
+class _BitReader(object):
+    def __init__(self, data, offset):
+        self.data = bytearray(data)
+        self.pos = offset
+        self.acc = 0
+        self.nbits = 0
+
+    def read(self, n):
+        while self.nbits < n:
+            self.acc = (self.acc << 8) | self.data[self.pos]
+            self.pos += 1
+            self.nbits += 8
+        self.nbits -= n
+        value = self.acc >> self.nbits
+        self.acc &= (1 << self.nbits) - 1
+        return value
+
+def _leading_zeros(x):
+    return 64 - x.bit_length()
+
+def _trailing_zeros(x):
+    return (x & -x).bit_length() - 1
+
+def _write_times(w, delta_times):
+    prev = prev_delta = 0
+    for i,t in enumerate(delta_times):
+        ms = int(round(t * 1000))
+        if i == 0:
+            w.write(ms & 0xFFFFFFFF, 32)
+        else:
+            delta = ms - prev
+            dod = delta - prev_delta
+            if dod == 0:
+                w.write(0, 1)
+            else:
+                for prefix,prefix_bits,bits in _DOD_CODES:
+                    if -(1 << (bits-1)) < dod <= (1 << (bits-1)) or bits == 32:
+                        w.write(prefix, prefix_bits)
+                        w.write(dod & ((1 << bits) - 1), bits)
+                        break
+            prev_delta = delta
+        prev = ms
+
+def _read_times(r, n):
+    result = []
+    prev = prev_delta = 0
+    for i in xrange(n):
+        if i == 0:
+            ms = r.read(32)
+        else:
+            dod = 0
+            if r.read(1) == 1:
+                for prefix,prefix_bits,bits in _DOD_CODES[:-1]:
+                    if r.read(1) == 0: break
+                else:
+                    bits = _DOD_CODES[-1][2]
+                dod = r.read(bits)
+                if dod > (1 << (bits-1)): dod -= 1 << bits
+            prev_delta += dod
+            ms = prev + prev_delta
+        result.append(ms / 1000.0)
+        prev = ms
+    return result
+
+def _write_values(w, values):
+    prev = None
+    leading = trailing = -1
+    for v in values:
+        bits = _UINT64.unpack(_DOUBLE.pack(v))[0]
+        if prev is None:
+            w.write(bits, 64)
+        else:
+            xor = bits ^ prev
+            if xor == 0:
+                w.write(0, 1)
+            else:
+                lz = min(_leading_zeros(xor), 31)
+                tz = _trailing_zeros(xor)
+                if leading >= 0 and lz >= leading and tz >= trailing:
+                    # the meaningful bits fit in the previous window
+                    w.write(0b10, 2)
+                    w.write(xor >> trailing, 64 - leading - trailing)
+                else:
+                    leading,trailing = lz,tz
+                    meaningful = 64 - lz - tz
+                    w.write(0b11, 2)
+                    w.write(lz, 5)
+                    w.write(meaningful & 0x3F, 6) # 64 is stored as 0
+                    w.write(xor >> tz, meaningful)
+        prev = bits
+
+def _read_values(r, n):
+    result = []
+    prev = 0
+    leading = trailing = 0
+    for i in xrange(n):
+        if i == 0:
+            bits = r.read(64)
+        elif r.read(1) == 0:
+            bits = prev
+        else:
+            if r.read(1) == 1:
+                leading = r.read(5)
+                meaningful = r.read(6) or 64
+                trailing = 64 - leading - meaningful
+            bits = prev ^ (r.read(64 - leading - trailing) << trailing)
+        result.append( _DOUBLE.unpack(_UINT64.pack(bits))[0] )
+        prev = bits
+    return result
+
+def encode(delta_times, values):
+    """Returns the compressed binary string of the given series, or None when
+    it contains values which are not numbers."""
+    integral = True
+    for v in values:
+        t = type(v)
+        if t is float:
+            integral = False
+        elif t is not int and t is not long:
+            return None
+    w = _BitWriter()
+    _write_times(w, delta_times)
+    _write_values(w, [ float(v) for v in values ])
+    flags = FLAG_INTEGRAL if integral else 0
+    return _HEADER.pack(VERSION, flags, len(values)) + w.getvalue()
+
+def decode(data):
+    """Returns the delta_times and values lists of a compressed binary string."""
+    version,flags,n = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("Unknown time series encoding version %d"%(version))
+    r = _BitReader(data, _HEADER.size)
+    delta_times = _read_times(r, n)
+    values = _read_values(r, n)
+    if flags & FLAG_INTEGRAL: values = [ int(v) for v in values ]
+    return delta_times,values
+
+def decode_document(doc):
+    """Returns the delta_times and values lists of a GVA2015_data document,
+    compressed or not."""
+    encoding = doc.get("encoding")
+    if encoding is None: return doc["delta_times"],doc["values"]
+    if encoding != ENCODING:
+        raise ValueError("Unknown time series encoding " + str(encoding))
+    return decode(doc["data"])
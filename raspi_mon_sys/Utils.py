@@ -5,17 +5,37 @@ This module uses /etc/default/raspimon_auth to get a MongoDB connection URI:
 
     mongodb://[username:password@]host1[:port1][,host2[:port2],...[,hostN[:portN]]][/[database][?options]]
 
+The MongoDB client is shared by all the modules of the process. It is
+connected on first use, checked every __MONGO_HEALTH_CHECK_PERIOD seconds and
+connected again when it fails, waiting an exponential back-off between failed
+connections. Connections and pings time out after __MONGO_TIMEOUT_MS and run
+without holding the lock of the shared client, so an unreachable server
+doesn't serialize all the threads. Modules borrow it with `borrowmongoclient()`:
+
+>>> with Utils.borrowmongoclient(logger) as client:
+...     client["raspimon"]["GVA2015_data"].insert(documents)
+
+Configurations returned by `getconfig()` are cached at __CONFIG_CACHE_DIR
+together with their hash. They are always retrieved from MongoDB at start,
+and the cache is only used when MongoDB is not reachable. A background thread refreshes every cached configuration each
+__CONFIG_REFRESH_PERIOD seconds and calls the `on_change` callbacks given to
+`getconfig()` when it changes.
 """
+from bson import json_util
 from email.mime.text import MIMEText
 from uuid import getnode
 
+import contextlib
 import datetime
+import hashlib
 import ntplib
 import os
 import paho.mqtt.client as paho
 import pymongo
 import smtplib
+import threading
 import time
+import traceback
 
 __PAHO_HOST      = "localhost"
 __PAHO_PORT      = 1883
@@ -24,11 +44,41 @@ __PAHO_BIND_ADDRESS = "127.0.0.1"
 
 __RASPIMON_AUTH = "/etc/default/raspimon_auth"
 
+__MONGO_POOL_SIZE = 4              # maximum number of borrowed clients at once
+__MONGO_HEALTH_CHECK_PERIOD = 60   # seconds between pings of the shared client
+__MONGO_MIN_RETRY_DELAY = 1        # seconds after a failed connection
+__MONGO_MAX_RETRY_DELAY = 300
+__MONGO_TIMEOUT_MS = 5000          # server selection and connection timeout
+
+__mongo_lock = threading.Lock()
+__mongo_pool = threading.BoundedSemaphore(__MONGO_POOL_SIZE)
+__mongo_client = None
+__mongo_checked_at = 0
+__mongo_retry_at = 0
+__mongo_retry_delay = 0
+
+__CONFIG_CACHE_DIR = "/var/lib/raspimon/config"
+__CONFIG_REFRESH_PERIOD = 600 # seconds between refreshes of cached configurations
+
+__config_lock = threading.Lock()
+__config_hashes = {}     # source -> hash of the configuration in use
+__config_listeners = {}  # source -> list of on_change callbacks
+__config_thread = None
+
 def __get_mongodb_uri():
     with open(__RASPIMON_AUTH) as f: x = f.readline().strip()
     return x
 
-def sendmail(credentials, subject, msg):
+def smtpconnect(credentials):
+    """Opens an authenticated SMTP session using the given credentials
+    dictionary, as described at `sendmail()`."""
+    smtpserver = smtplib.SMTP_SSL(credentials["server"], credentials["port"])
+    smtpserver.ehlo()
+    #smtpserver.starttls()
+    smtpserver.login(credentials["user"], credentials["password"])
+    return smtpserver
+
+def sendmail(credentials, subject, msg, smtpserver=None):
     """Sends an email using the given credentials dictionary, subject and message
     strings.
 
@@ -41,17 +91,16 @@ def sendmail(credentials, subject, msg):
     - from: string with From header content.
     - to: string with To header content.
 
+    When a session opened with `smtpconnect()` is given it is used and left
+    open, otherwise a new session is opened and closed.
     """
-    smtpserver = smtplib.SMTP_SSL(credentials["server"], credentials["port"])
-    smtpserver.ehlo()
-    #smtpserver.starttls()
-    smtpserver.login(credentials["user"], credentials["password"])
+    session = smtpserver if smtpserver is not None else smtpconnect(credentials)
     msg = MIMEText( msg )
     msg['Subject'] = subject
     msg['From'] = credentials["from"]
     msg['To'] = credentials["to"]
-    smtpserver.sendmail(credentials["from"], credentials["to"], msg.as_string())
-    smtpserver.quit()
+    session.sendmail(credentials["from"], credentials["to"], msg.as_string())
+    if smtpserver is None: session.quit()
 
 def getmac():
     """Returns MAC address of eth0 in a hexadecimal string."""
@@ -89,25 +138,171 @@ def gettopic(name,base="raspimon"):
     as argument to this function."""
     return base + "/" + getmac() + "/" + name
 
+def __close_mongo_client():
+    global __mongo_client
+    if __mongo_client is not None:
+        try:
+            __mongo_client.close()
+        except:
+            pass
+        __mongo_client = None
+
 def getmongoclient(logger):
-    """Returns a client connected to Mongo DB."""
+    """Returns the shared client connected to Mongo DB, which shouldn't be
+    closed by the caller.
+
+    It raises ConnectionFailure when the connection fails or while waiting the
+    back-off of a previous failure.
+    """
+    global __mongo_client, __mongo_checked_at, __mongo_retry_at, __mongo_retry_delay
+    with __mongo_lock:
+        now = time.time()
+        client = __mongo_client
+        check = client is not None and now - __mongo_checked_at > __MONGO_HEALTH_CHECK_PERIOD
+        # only one thread checks the client, the rest keep using it
+        if check: __mongo_checked_at = now
+        if client is None and now < __mongo_retry_at:
+            raise pymongo.errors.ConnectionFailure("MongoDB connection retried in %d seconds"%(__mongo_retry_at - now))
+    if check:
+        try:
+            client.admin.command("ping")
+        except:
+            if logger is not None: logger.warning("MongoDB client health check failed")
+            with __mongo_lock:
+                if __mongo_client is client: __close_mongo_client()
+            client = None
+    if client is not None: return client
     try:
-        client = pymongo.MongoClient( __get_mongodb_uri() )
+        client = pymongo.MongoClient( __get_mongodb_uri(),
+                                      maxPoolSize=__MONGO_POOL_SIZE,
+                                      serverSelectionTimeoutMS=__MONGO_TIMEOUT_MS,
+                                      connectTimeoutMS=__MONGO_TIMEOUT_MS )
+        client.admin.command("ping")
     except:
+        with __mongo_lock:
+            # failures of concurrent connections increase the back-off once
+            if __mongo_retry_at <= time.time():
+                __mongo_retry_delay = min(__MONGO_MAX_RETRY_DELAY,
+                                          max(__MONGO_MIN_RETRY_DELAY, __mongo_retry_delay*2))
+                __mongo_retry_at = time.time() + __mongo_retry_delay
         if logger is not None: logger.alert("Unable to connect with MongoDB server")
         raise
-    if logger is not None: logger.info("MongoDB client connected")
-    return client
-
-def getconfig(source, logger):
-    """Returns the configuration for `source` as stored at Mongo DB in our
-    servers."""
-    client = getmongoclient(logger)
-    collection = client["raspimon"]["GVA2015_config"]
-    config = collection.find_one({ "raspi":getmac(), "source":source })
+    with __mongo_lock:
+        if __mongo_client is None:
+            __mongo_client = client
+            __mongo_checked_at = time.time()
+            __mongo_retry_delay = 0
+            if logger is not None: logger.info("MongoDB client connected")
+            return client
+        shared = __mongo_client
+    # another thread connected at the same time
     client.close()
+    return shared
+
+@contextlib.contextmanager
+def borrowmongoclient(logger):
+    """Context manager which borrows the shared Mongo DB client, at most
+    __MONGO_POOL_SIZE threads borrow it at the same time. When the block raises
+    ConnectionFailure the client is checked again in the next borrow."""
+    global __mongo_checked_at
+    with __mongo_pool:
+        client = getmongoclient(logger)
+        try:
+            yield client
+        except pymongo.errors.ConnectionFailure:
+            with __mongo_lock: __mongo_checked_at = 0
+            raise
+
+def closemongoclient():
+    """Closes the shared Mongo DB client, it is connected again when needed."""
+    with __mongo_lock: __close_mongo_client()
+
+def __config_hash(config):
+    return hashlib.sha1(json_util.dumps(config, sort_keys=True)).hexdigest()
+
+def __config_cache_path(source):
+    return os.path.join(__CONFIG_CACHE_DIR, source + ".json")
+
+def __read_cached_config(source):
+    """Returns the cached configuration of source, or None when it is missing
+    or its hash doesn't match."""
+    try:
+        with open(__config_cache_path(source)) as f: cached = json_util.loads(f.read())
+        if __config_hash(cached["config"]) == cached["hash"]: return cached["config"]
+    except (IOError, ValueError, KeyError):
+        pass
+    return None
+
+def __write_cached_config(source, config):
+    try:
+        if not os.path.isdir(__CONFIG_CACHE_DIR): os.makedirs(__CONFIG_CACHE_DIR)
+        path = __config_cache_path(source)
+        with open(path + ".tmp", "w") as f:
+            f.write(json_util.dumps({ "hash" : __config_hash(config), "config" : config }))
+        os.rename(path + ".tmp", path)
+    except:
+        print "Unexpected error:", traceback.format_exc()
+
+def __fetch_config(source, logger):
+    with borrowmongoclient(logger) as client:
+        collection = client["raspimon"]["GVA2015_config"]
+        config = collection.find_one({ "raspi":getmac(), "source":source })
     assert config is not None
-    if logger is not None: logger.debug("Configuration retrieved properly for source %s", source)
+    return config
+
+def __refresh_configs():
+    """Fetches again all the configurations in use and notifies the changed ones."""
+    with __config_lock: sources = __config_hashes.keys()
+    for source in sources:
+        try:
+            config = __fetch_config(source, None)
+        except:
+            print "Unable to refresh configuration:", traceback.format_exc()
+            continue
+        h = __config_hash(config)
+        with __config_lock:
+            if __config_hashes[source] == h: continue
+            __config_hashes[source] = h
+            listeners = list(__config_listeners.get(source, []))
+        __write_cached_config(source, config)
+        for on_change in listeners:
+            try:
+                on_change(config)
+            except:
+                print "Unexpected error:", traceback.format_exc()
+
+def __config_refresh_loop():
+    while True:
+        __refresh_configs()
+        time.sleep(__CONFIG_REFRESH_PERIOD)
+
+def getconfig(source, logger, on_change=None):
+    """Returns the configuration for `source` as stored at Mongo DB in our
+    servers.
+
+    The configuration is retrieved from Mongo DB, and the cached one is
+    returned only when Mongo DB is not reachable. When the configuration
+    changes, on_change is called with the new configuration from a background
+    thread.
+    """
+    global __config_thread
+    try:
+        config = __fetch_config(source, logger)
+        __write_cached_config(source, config)
+        if logger is not None: logger.debug("Configuration retrieved properly for source %s", source)
+    except pymongo.errors.PyMongoError:
+        config = __read_cached_config(source)
+        if config is None: raise
+        if logger is not None:
+            logger.warning("MongoDB not reachable, configuration of source %s loaded from cache", source)
+    with __config_lock:
+        __config_hashes[source] = __config_hash(config)
+        if on_change is not None:
+            __config_listeners.setdefault(source, []).append(on_change)
+        if __config_thread is None:
+            __config_thread = threading.Thread(target=__config_refresh_loop)
+            __config_thread.setDaemon(True)
+            __config_thread.start()
     return config
 
 def ntpcheck(logger=None):
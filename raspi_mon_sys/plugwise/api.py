@@ -24,7 +24,6 @@
 #   POL v0.2 - written in 2009 by Maarten Damen <http://www.maartendamen.com>
 
 # TODO:
-#   - make communication channel concurrency safe
 #   - return more reasonable responses than response message objects from the functions that don't do so yet
 #   - make message construction syntax better. Fields should only be specified once and contain name so we can serialize response message to dict
 #   - unit tests
@@ -34,6 +33,8 @@
 import re
 import sys
 import time
+import threading
+import collections
 import math
 from datetime import datetime, timedelta
 import calendar
@@ -45,197 +46,444 @@ from .protocol import *
 from .exceptions import *
 
 PULSES_PER_KW_SECOND = 468.9385193
+WATTS_PER_PULSE_SECOND = 1000.0 / PULSES_PER_KW_SECOND
+
+#seconds the pulse counters of a power usage response are counted over (1s, 8s, 1h, production 1h)
+POWER_USAGE_SECONDS = (1, 8, 3600, 3600)
 
 DEFAULT_TIMEOUT = 1
+#seconds the device info read by get_info() is considered valid by get_cached_info()
+DEFAULT_INFO_TTL = 60
+
+#maximum number of requests waiting for a response at the same time
+MAX_OUTSTANDING_REQUESTS = 4
+#seconds to wait for the Stick acknowledgement of a sent request
+ACK_TIMEOUT = 6
+#seconds to wait for the response of a request
+REQUEST_TIMEOUT = 6
+#seconds to wait for the real response after an error status 'E1'
+ERROR_STATUS_TIMEOUT = 2
+#status values of the Stick acknowledgement to a sent request (success, error)
+STICK_ACK_STATUSES = (0xC1, 0xC2)
+#number of seqnrs of completed requests remembered to detect late responses
+COMPLETED_HISTORY = 64
+
+class Calibration(object):
+    """calibration offsets of a circle, converts pulse counts into power
+
+    The correction polynomial seconds*((p+off_noise)**2*gain_b + (p+off_noise)*gain_a + off_tot),
+    where p is the pulse rate per second, is expanded once into c2*p**2 + c1*p + c0.
+    """
+
+    def __init__(self, gain_a, gain_b, off_noise, off_tot):
+        self.gain_a = gain_a
+        self.gain_b = gain_b
+        self.off_noise = off_noise
+        self.off_tot = off_tot
+        self.c2 = gain_b
+        self.c1 = 2.0*gain_b*off_noise + gain_a
+        self.c0 = gain_b*off_noise**2 + gain_a*off_noise + off_tot
+        #constants of the inverse polynomial used by watt_to_pulses()
+        self._inv_disc = gain_a**2.0 - 4.0*gain_b*off_tot
+        self._inv_offset = gain_a + 2.0*gain_b*off_noise
+
+    def pulse_correction(self, pulses, seconds=1):
+        """corrected pulse count, see Circle.pulse_correction()"""
+        if pulses == 0:
+            return 0.0
+        p = pulses / float(seconds)
+        corrected = (self.c2*p + self.c1)*p + self.c0
+        if (p > 0.0 and corrected < 0.0 or p < 0.0 and corrected > 0.0):
+            return 0.0
+        return seconds * corrected
+
+    def to_watts(self, pulses, seconds):
+        """converts a list of pulse counts into a list of watts
+        @param pulses: list of pulse counters
+        @param seconds: list with the seconds every pulse counter was counted over
+        """
+        c2, c1, c0 = self.c2, self.c1, self.c0
+        watts = []
+        for n,s in zip(pulses, seconds):
+            if n == 0:
+                watts.append(0.0)
+                continue
+            p = n / float(s)
+            corrected = (c2*p + c1)*p + c0
+            if (p > 0.0 and corrected < 0.0 or p < 0.0 and corrected > 0.0):
+                watts.append(0.0)
+            else:
+                watts.append(corrected * WATTS_PER_PULSE_SECOND)
+        return watts
+
+    def watt_to_pulses(self, watt, seconds=1):
+        """raw pulse count, see Circle.watt_to_pulses()"""
+        if watt == 0:
+            return 0.0
+        corr_pulses_1s = watt / WATTS_PER_PULSE_SECOND
+        raw_pulses_1s = (math.sqrt(self._inv_disc + 4.0 * self.gain_b * corr_pulses_1s) - self._inv_offset) / (2.0 * self.gain_b)
+        if (corr_pulses_1s > 0.0 and raw_pulses_1s < 0.0 or corr_pulses_1s < 0.0 and raw_pulses_1s > 0.0):
+            return 0.0
+        return seconds*raw_pulses_1s
+
+class PlugwiseFuture(object):
+    """pending response of a request sent with Stick.submit()
+
+    on_response(resp) is called as soon as the response is received and
+    on_failure(reason) when the request fails, it may return a different
+    exception to be raised by result(). Both are called from the reader
+    thread of the Stick. convert(resp) is called by result(), once all the
+    pipelined requests are completed, to transform the response into the
+    returned value. When fail_on_error is True the request fails at the first
+    error status 'E1', without waiting for a late response.
+    """
+
+    def __init__(self, stick, response_class, mac=None, convert=None,
+                 on_response=None, on_failure=None, timeout=REQUEST_TIMEOUT,
+                 fail_on_error=False):
+        self._stick = stick
+        self.response_class = response_class
+        self.mac = mac
+        self.timeout = timeout
+        self.fail_on_error = fail_on_error
+        self.seqnr = None
+        self.deadline = None
+        self.errors = 0
+        self.timestamp = None
+        self._convert = convert
+        self._on_response = on_response
+        self._on_failure = on_failure
+        self._acked = threading.Event()
+        self._event = threading.Event()
+        self._response = None
+        self._exception = None
+        self._converted = False
+        self._result = None
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self):
+        """returns the converted response, waiting for it if needed
+        raises the exception of failed requests
+        """
+        if not self._event.is_set():
+            self._stick.wait([self])
+        if self._exception is not None:
+            raise self._exception
+        if not self._converted:
+            self._result = self._response if self._convert is None else self._convert(self._response)
+            self._converted = True
+        return self._result
+
+    def _set_response(self, resp):
+        self.timestamp = time.time()
+        self._response = resp
+        if self._on_response is not None:
+            self._on_response(resp)
+        self._event.set()
+
+    def _set_exception(self, reason):
+        if self._on_failure is not None:
+            reason = self._on_failure(reason) or reason
+        self._exception = reason
+        self._event.set()
 
 class Stick(SerialComChannel):
-    """provides interface to the Plugwise Stick"""
+    """provides interface to the Plugwise Stick
+
+    A background thread reads the serial port, frames the received bytes
+    into responses and routes them by seqnr (checking mac and function code)
+    to the pending requests. Requests are sent with submit(), which returns a
+    PlugwiseFuture; up to max_outstanding requests wait for their responses
+    at the same time. Frames which do not belong to any pending request are
+    counted in self.counters as 'late' when their request was already
+    completed or expired, and as 'unsolicited' otherwise.
+    """
 
-    def __init__(self, logger, port=0, timeout=DEFAULT_TIMEOUT):
+    def __init__(self, logger, port=0, timeout=DEFAULT_TIMEOUT,
+                 max_outstanding=MAX_OUTSTANDING_REQUESTS):
         self.logger = logger
         SerialComChannel.__init__(self, port=port, timeout=timeout)
         self.unjoined = set()
+        self.max_outstanding = max_outstanding
+        self.counters = { "unsolicited" : 0, "late" : 0, "errors" : 0 }
+        self._pending = {}
+        self._completed = collections.deque(maxlen=COMPLETED_HISTORY)
+        self._sending = None
+        self._sending_deadline = None
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._running = True
+        self._reader = threading.Thread(target=self._reader_loop,
+                                        name="PlugwiseStickReader")
+        self._reader.daemon = True
+        self._reader.start()
         self.init()
 
     def init(self):
         """send init message to the stick"""
         msg = PlugwiseStatusRequest().serialize()
-        self.send_msg(msg)
-        resp = self.expect_response(PlugwiseStatusResponse)
+        resp = self.submit(msg, PlugwiseStatusResponse).result()
         self.logger.debug(str(resp))
 
+    def close(self):
+        """stops the reader thread, fails the pending requests and closes the
+        serial port"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._reader.join()
+        self._fail_pending(SerialException("Stick closed"))
+        SerialComChannel.close(self)
+
     def send_msg(self, cmd):
-        #log communication done in serialize function of message object. Could be too early!
-        self.logger.debug("SEND %4d %s" % (len(cmd), repr(cmd)))
-        self.write(cmd)
-        resp = self.expect_response(PlugwiseAckResponse)
-        success = False
-        if resp.status.value == 0xC1:
-            success = True
-        return (success, resp.command_counter)
-
-    def _recv_response(self, retry_timeout=5):
-        await_response = True
-        msg = ""
-        retry_timeout += 1
-        while await_response:
-            msg += self.readline()
-            # if msg == b"":
-                # logcomm("TOUT      '' - <!> Timeout on serial port" )        
-                # raise TimeoutException("Timeout while waiting for response from device")                
-            # #debug("read:"+repr(msg)+" with length "+str(len(msg)))
-            
-            # if (msg != b""):
-                # if (msg[-1] != '\n'):
-                    # logcomm("lastbyte not 0A")
-                # else:
-                    # logcomm("lastbyte is 0A")
-                # try:    
-                    # logcomm("last bytes: %04X %04X" % (ord(msg[-2]), ord(msg[-1])))
-                # except:
-                    # logcomm("last byte : %04X" % (ord(msg[-1]),))
-                    # pass
-            # logcomm("counter: %2d" % (retry_timeout,))
-            if (msg == b"") or (msg[-1] != '\n'):
-                retry_timeout -= 1
-                if retry_timeout <= 0:
-                    if (msg != b""):
-                        logcomm("TOUT %4d %s - <!> Timeout on serial port" % ( len(msg), repr(msg)))  
-                    else:
-                        logcomm("TOUT      '' - <!> Timeout on serial port" )        
-                    raise TimeoutException("Timeout while waiting for response from device")
-                else:
-                    continue
+        """sends a request which is only acknowledged by the Stick
+        returns (success, seqnr)
+        """
+        ack = self.submit(cmd, None).result()
+        return (ack.status.value == 0xC1, ack.command_counter)
+
+    def _frame(self, msg):
+        """returns the response frame contained in msg, or None"""
+        header_start = msg.find(PlugwiseMessage.PACKET_HEADER5)
+        if header_start < 0:
+            header_start = msg.find(PlugwiseMessage.PACKET_HEADER)
+        if header_start > 0:
+            ### 2011 firmware seems to sometimes send extra \x83 byte before some of the
+            ### response messages but there might a all kinds of chatter going on so just 
+            # look for our packet header. Due to protocol errors it might be in the middle of a response
+            logcomm("DSTR %4d %s" % ( len(msg[:header_start]), repr(msg[:header_start])))
+            msg = msg[header_start:]
             
-            header_start = msg.find(PlugwiseMessage.PACKET_HEADER5)
-            if header_start < 0:
-                header_start = msg.find(PlugwiseMessage.PACKET_HEADER)
-            if header_start > 0:
-                ### 2011 firmware seems to sometimes send extra \x83 byte before some of the
-                ### response messages but there might a all kinds of chatter going on so just 
-                # look for our packet header. Due to protocol errors it might be in the middle of a response
-                logcomm("DSTR %4d %s" % ( len(msg[:header_start]), repr(msg[:header_start])))
-                msg = msg[header_start:]
-                
-            if msg.find('#') >= 0:
-                logcomm("DTRC %4d %s" % ( len(msg), repr(msg)))
-                msg = ""
-            elif len(msg)<22:
-                # Ignore. It is too short to interpet as a message.
-                # It may be part of Stick debug messages.
-                logcomm("DSHR %4d %s" % ( len(msg), repr(msg)))
-                msg = ""
-            else:
-                #message can be interpreted as response
-                #perform logcomm after interpetation of response
-                #logcomm("RECV %4d %s" % ( len(msg), repr(msg)))
-                await_response = False
+        if msg.find('#') >= 0:
+            logcomm("DTRC %4d %s" % ( len(msg), repr(msg)))
+            return None
+        elif len(msg)<22:
+            # Ignore. It is too short to interpet as a message.
+            # It may be part of Stick debug messages.
+            logcomm("DSHR %4d %s" % ( len(msg), repr(msg)))
+            return None
         return msg
-        
-    def is_in_sequence(self, resp, seqnr):
-        if not seqnr is None and resp.command_counter != seqnr:
-            self.logger.info("Out of sequence message. Expected seqnr %s, received seqnr %s" % (seqnr, resp.command_counter))
-            return False
+
+    def _peek_header(self, msg):
+        """returns (function_code, command_counter) of a received frame"""
+        if msg.startswith(PlugwiseMessage.PACKET_HEADER5):
+            msg = msg[1:]
+        return msg[4:8], msg[8:12]
+
+    def _unserialize_ack(self, msg, seqnr):
+        """interprets the frame as Ack or AckMac depending on its length"""
+        if len(msg) in (22, 23):
+            resp = PlugwiseAckResponse(seqnr)
+        elif len(msg) in (38, 39):
+            resp = PlugwiseAckMacResponse(seqnr)
         else:
-            return True
+            raise UnexpectedResponse("unexpected length %d for an Ack message" % (len(msg),))
+        resp.unserialize(msg)
+        return resp
 
-    def expect_response(self, response_class, src_mac=None, seqnr=None, retry_timeout=5):
-        resp = response_class(seqnr)
-        # there's a lot of debug info flowing on the bus so it's
-        # expected that we constantly get unexpected messages
-        while 1:
+    def _reader_loop(self):
+        buf = ""
+        while self._running:
             try:
-                #readlen = len(resp)
-                #debug("expecting to read "+str(readlen)+" bytes for msg. "+str(resp))
-                msg = self._recv_response(retry_timeout)
+                buf += self.readline()
+            except SerialException as reason:
+                self.logger.info("Error reading the serial port: %s" % (str(reason),))
+                self._fail_pending(reason)
+                buf = ""
+                time.sleep(DEFAULT_TIMEOUT)
+                continue
+            if buf != "" and buf[-1] == '\n':
+                msg = self._frame(buf)
+                buf = ""
+                if msg is not None:
+                    try:
+                        self._route(msg)
+                    except Exception as reason:
+                        logcomm("RERR %4d %s - <!> error routing response: %s" % ( len(msg), repr(msg), str(reason)))
+                        self.logger.info("error routing response: %s" % (str(reason),))
+            self._expire_pending(time.time())
+        self._fail_pending(SerialException("Stick reader stopped"))
+
+    def _route(self, msg):
+        function_code, seqnr = self._peek_header(msg)
+        with self._cond:
+            future = self._pending.get(seqnr)
+            if future is not None:
+                self._dispatch_frame(future, function_code, seqnr, msg)
+            elif function_code == '0000' and self._sending is not None and self._accept_ack(msg, seqnr):
+                pass
+            elif seqnr in self._completed:
+                self.counters["late"] += 1
+                logcomm("LATE %4d %s" % ( len(msg), repr(msg)))
+                self.logger.debug("Late response %s for seqnr %s" % (function_code, seqnr))
+            else:
+                self.counters["unsolicited"] += 1
+                self._unsolicited(function_code, msg)
+
+    def _accept_ack(self, msg, seqnr):
+        """assigns the seqnr of a Stick acknowledgement to the request being sent
+        returns False when msg is not an acknowledgement
+        """
+        try:
+            ack = self._unserialize_ack(msg, seqnr)
+        except (ProtocolError, OutOfSequenceException, UnexpectedResponse) as reason:
+            logcomm("RERR %4d %s - <!> unexpected response while expecting Ack: %s" % ( len(msg), repr(msg), str(reason)))
+            return False
+        if ack.status.value not in STICK_ACK_STATUSES:
+            #a status message of a request which is no longer pending
+            return False
+        future = self._sending
+        self._sending = None
+        future.seqnr = seqnr
+        if future.response_class is None:
+            future._set_response(ack)
+        elif ack.status.value == 0xC1:
+            future.deadline = time.time() + future.timeout
+            self._pending[seqnr] = future
+        else:
+            self._completed.append(seqnr)
+            future._set_exception(ProtocolError("request not accepted by the Stick, status '%04X'" % (ack.status.value,)))
+        future._acked.set()
+        return True
+
+    def _unsolicited(self, function_code, msg):
+        try:
+            if function_code == "0006":
+                resp = PlugwiseAdvertiseNodeResponse()
+                resp.unserialize(msg)
+                self.logger.info("unknown advertise MAC %s" % str(resp.mac))
+                self.unjoined.add(resp.mac)
+            elif function_code == "0061":
+                resp = PlugwiseAckAssociationResponse()
                 resp.unserialize(msg)
-                if self.is_in_sequence(resp, seqnr) and src_mac is None or src_mac == resp.mac:
-                    return resp
-            except ProtocolError as reason:
-                #retry to receive the response
-                logcomm("RERR %4d %s - <!> protocol error: %s" % ( len(msg), repr(msg), str(reason)))
-                self.logger.info("protocol error [1]:"+str(reason))
-            except OutOfSequenceException as reason:
-                #retry to receive the response
-                logcomm("RERR %4d %s - <!> out of sequence: %s" % ( len(msg), repr(msg), str(reason)))
-                self.logger.info("protocol error [2]:"+str(reason))
-            except UnexpectedResponse as reason:
-                #response could be an error status message
-                #suppress error logging when expecting a response to ping in case circle is offline
-                if str(reason) != "'expected response code 000E, received code 0000'":
-                    self.logger.info("unexpected response [1]:"+str(reason))
+                self.logger.info("unknown MAC associating %s" % str(resp.mac))
+            else:
+                logcomm("RERR %4d %s - <!> unsolicited response" % ( len(msg), repr(msg)))
+                self.logger.debug("Unsolicited response %s" % (function_code,))
+        except (ProtocolError, OutOfSequenceException, UnexpectedResponse) as reason:
+            logcomm("RERR %4d %s - <!> error in unsolicited response: %s" % ( len(msg), repr(msg), str(reason)))
+            self.logger.info("protocol error [5]:"+str(reason))
+
+    def _complete(self, seqnr):
+        future = self._pending.pop(seqnr)
+        self._completed.append(seqnr)
+        self._cond.notify_all()
+        return future
+
+    def _dispatch_frame(self, future, function_code, seqnr, msg):
+        """routes a received frame to its pending request"""
+        response_class = future.response_class
+        try:
+            if function_code == '0000':
+                resp = self._unserialize_ack(msg, seqnr)
+                if issubclass(response_class, PlugwiseAckResponse):
+                    self._complete(seqnr)._set_response(resp)
+                elif resp.status.value == 0xE1:
+                    #network slow or circle offline, the response may arrive just after it
+                    future.errors += 1
+                    self.logger.debug("Received an error status 'E1' for seqnr %s" % (seqnr,))
+                    if future.fail_on_error:
+                        self._complete(seqnr)._set_exception(TimeoutException("Received an error message for seqnr %s" % (seqnr,)))
+                    elif future.errors > 1:
+                        self._complete(seqnr)._set_exception(TimeoutException("Received multiple error messages for seqnr %s" % (seqnr,)))
+                    else:
+                        future.deadline = min(future.deadline, time.time() + ERROR_STATUS_TIMEOUT)
                 else:
-                    self.logger.debug("unexpected response [1]:"+str(reason))
-                if not issubclass(resp.__class__, PlugwiseAckResponse):
-                    #Could be an Ack or AckMac or AcqAssociation error code response when same seqnr
-                    try:
-                        if (len(msg) == 22 and msg[0:1] == b'\x05') or (len(msg) == 23 and msg[0:1] == b'\x83'):
-                            ackresp = PlugwiseAckResponse()
-                            ackresp.unserialize(msg)
-                            if self.is_in_sequence(ackresp, seqnr):
-                                return ackresp
-                        elif (len(msg) == 38 and msg[0:1] == b'\x05') or(len(msg) == 39 and msg[0:1] == b'\x83'):
-                            ackresp = PlugwiseAckMacResponse()
-                            ackresp.unserialize(msg)
-                            if self.is_in_sequence(ackresp, seqnr):
-                                return ackresp
-                        else:
-                            #it does not appear to be a proper Ack message
-                            #just retry to read next message
-                            logcomm("RERR %4d %s - <!> unexpected response error: %s" % ( len(msg), repr(msg), str(reason)))
-                            pass
-                    except ProtocolError as reason:
-                        #retry to receive the response
-                        logcomm("RERR %4d %s - <!> protocol error while interpreting as Ack: %s" % ( len(msg), repr(msg), str(reason)))
-                        self.logger.info("protocol error [3]:"+str(reason))
-                    except OutOfSequenceException as reason:
-                        #retry to receive the response
-                        logcomm("RERR %4d %s - <!> out of sequence while interpreting as Ack: %s" % ( len(msg), repr(msg), str(reason)))
-                        self.logger.info("protocol error [4]:"+str(reason))
-                    except UnexpectedResponse as reason:
-                        #response could be an error status message
-                        logcomm("RERR %4d %s - <!> unexpected response error while interpreting as Ack: %s" % ( len(msg), repr(msg), str(reason)))
-                        self.logger.info("unexpected response [2]:"+str(reason))
-                self.logger.info("TEST: %s" % (resp.function_code,))
-                if resp.function_code in ['0006', '0061']:
-                    #Could be an unsolicited AdvertiseNode or AcqAssociation response
-                    try:
-                        if resp.function_code == "0006":
-                            self.logger.info("entering unknown advertise MAC ")
-                            ackresp = PlugwiseAdvertiseNodeResponse()
-                            ackresp.unserialize(msg)
-                            self.logger.info("unknown advertise MAC %s" % str(ackresp.mac))
-                            if ackresp.mac not in self.unjoined:
-                                self.unjoined.add(ackresp.mac)
-                        elif resp.function_code == "0061":
-                            ackresp = PlugwiseAckAssociationResponse()
-                            ackresp.unserialize(msg)
-                            self.logger.info("unknown MAC associating %s" % str(ackresp.mac))
-                        else:
-                            #it does not appear to be a proper Ack message
-                            #just retry to read next message
-                            logcomm("RERR %4d %s - <!> unexpected response error: %s" % ( len(msg), repr(msg), str(reason)))
-                            pass
-                    except ProtocolError as reason:
-                        #retry to receive the response
-                        logcomm("RERR %4d %s - <!> protocol error while interpreting as Advertise: %s" % ( len(msg), repr(msg), str(reason)))
-                        self.logger.info("protocol error [5]:"+str(reason))
-                    except OutOfSequenceException as reason:
-                        #retry to receive the response
-                        logcomm("RERR %4d %s - <!> out of sequence while interpreting as Advertise: %s" % ( len(msg), repr(msg), str(reason)))
-                        self.logger.info("protocol error [6]:"+str(reason))
-                    except UnexpectedResponse as reason:
-                        #response could be an error status message
-                        logcomm("RERR %4d %s - <!> unexpected response error while interpreting as Advertise: %s" % ( len(msg), repr(msg), str(reason)))
-                        self.logger.info("unexpected response [3]:"+str(reason))
+                    self.logger.info("Received an error status '%04X' for seqnr %s" % (resp.status.value, seqnr))
+            elif function_code == response_class.ID:
+                resp = response_class(seqnr)
+                resp.unserialize(msg)
+                if future.mac is not None and resp.mac is not None and resp.mac != future.mac:
+                    self.counters["unsolicited"] += 1
+                    self.logger.info("Response for seqnr %s from unexpected mac %s" % (seqnr, resp.mac))
                 else:
-                    logcomm("RERR %4d %s - <!> unexpected response error while expecting Ack: %s" % ( len(msg), repr(msg), str(reason)))                    
-                    self.logger.info("unexpected response [4]:"+str(reason))
+                    self._complete(seqnr)._set_response(resp)
+            else:
+                self.counters["unsolicited"] += 1
+                self.logger.info("Unexpected response code %s for seqnr %s" % (function_code, seqnr))
+        except (ProtocolError, OutOfSequenceException, UnexpectedResponse) as reason:
+            self.counters["errors"] += 1
+            logcomm("RERR %4d %s - <!> error in response: %s" % ( len(msg), repr(msg), str(reason)))
+            self.logger.info("protocol error [7]:"+str(reason))
+
+    def _expire_pending(self, now):
+        with self._cond:
+            if self._sending is not None and self._sending_deadline <= now:
+                future = self._sending
+                self._sending = None
+                future._set_exception(TimeoutException("Timeout while waiting for the Stick acknowledgement"))
+                future._acked.set()
+            for seqnr,future in self._pending.items():
+                if future.deadline <= now:
+                    self._complete(seqnr)._set_exception(TimeoutException("Timeout while waiting for response with seqnr %s" % (seqnr,)))
+
+    def _fail_pending(self, reason):
+        with self._cond:
+            if self._sending is not None:
+                future = self._sending
+                self._sending = None
+                future._set_exception(reason)
+                future._acked.set()
+            for seqnr in self._pending.keys():
+                self._complete(seqnr)._set_exception(reason)
+
+    def submit(self, msg, response_class, mac=None, convert=None,
+               on_response=None, on_failure=None, timeout=REQUEST_TIMEOUT,
+               fail_on_error=False):
+        """sends a request without waiting for its response
+
+        @param msg: serialized request
+        @param response_class: class of the expected response, None when
+            the request is only acknowledged by the Stick
+        @param fail_on_error: fail at the first error status 'E1', used for
+            circles known to be offline
+        @return: a PlugwiseFuture
+        """
+        future = PlugwiseFuture(self, response_class, mac, convert,
+                                on_response, on_failure, timeout, fail_on_error)
+        with self._send_lock:
+            with self._cond:
+                while len(self._pending) >= self.max_outstanding and self._running:
+                    self._cond.wait()
+                if not self._running:
+                    future._set_exception(SerialException("Stick reader stopped"))
+                    return future
+                #the reader thread assigns the seqnr of the next acknowledgement
+                self._sending = future
+                self._sending_deadline = time.time() + ACK_TIMEOUT
+            if self.logger.enabled(self.logger.levels.DEBUG):
+                self.logger.debug("SEND %4d %s" % (len(msg), repr(msg)))
+            try:
+                self.write(msg)
+            except SerialException as reason:
+                with self._cond:
+                    if self._sending is future:
+                        self._sending = None
+                        future._set_exception(reason)
+                        future._acked.set()
+            future._acked.wait()
+        return future
+
+    def wait(self, futures, timeout=None):
+        """waits until all the given futures are done
+        futures still pending after timeout seconds fail with TimeoutException
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for f in futures:
+            if deadline is None:
+                f._event.wait()
+            elif not f._event.wait(max(0, deadline - time.time())):
+                break
+        with self._cond:
+            for f in futures:
+                if not f.done() and f.seqnr in self._pending:
+                    self._complete(f.seqnr)._set_exception(TimeoutException("Timeout while waiting for pipelined responses"))
 
     def enable_joining(self, enabled):
         req = PlugwiseEnableJoiningRequest('', enabled)
-        _, seqnr  = self.send_msg(req.serialize())
-        self.expect_response(PlugwiseAckMacResponse)
+        self.submit(req.serialize(), PlugwiseAckMacResponse).result()
 
     def join_node(self, newmac, permission):
         req = PlugwiseJoinNodeRequest(newmac, permission)
@@ -246,27 +494,25 @@ class Stick(SerialComChannel):
     def reset(self):
         type = 0
         req = PlugwiseResetRequest(self.mac, type, 20)
-        _, seqnr  = self.send_msg(req.serialize())
-        resp = self.expect_response(PlugwiseAckMacResponse)
+        resp = self.submit(req.serialize(), PlugwiseAckMacResponse).result()
         return resp.status.value
 
     def status(self):
         req = PlugwiseStatusRequest(self.mac)
-        _, seqnr  = self.send_msg(req.serialize())
         #TODO: There is a short and a long response to 0011.
         #The short reponse occurs when no cirlceplus is connected, and has two byte parameters.
         #The short repsonse is likely not properly handled (exception?)
-        resp = self.expect_response(PlugwiseStatusResponse)
+        resp = self.submit(req.serialize(), PlugwiseStatusResponse).result()
         return        
         
     def find_circleplus(self):
         req = PlugwiseQueryCirclePlusRequest(self.mac)
-        _, seqnr  = self.send_msg(req.serialize())
+        future = self.submit(req.serialize(), PlugwiseQueryCirclePlusResponse)
         #Receive the circle+ response, but possibly, only an end-protocol response is seen.
         success = False
         circleplusmac = None
         try:
-            resp = self.expect_response(PlugwiseQueryCirclePlusResponse)
+            resp = future.result()
             success=True
             circleplusmac = resp.new_node_mac_id.value
         except (TimeoutException, SerialException) as reason:
@@ -275,8 +521,7 @@ class Stick(SerialComChannel):
 
     def connect_circleplus(self):
         req = PlugwiseConnectCirclePlusRequest(self.mac)
-        _, seqnr  = self.send_msg(req.serialize())
-        resp = self.expect_response(PlugwiseConnectCirclePlusResponse)
+        resp = self.submit(req.serialize(), PlugwiseConnectCirclePlusResponse).result()
         return resp.existing.value, self.allowed.value        
         
 class Circle(object):
@@ -301,11 +546,16 @@ class Circle(object):
         self.attr = attr
         
         self._devtype = None
+        
+        self.info_ttl = float(self.attr.get('info_ttl', DEFAULT_INFO_TTL))
+        self._info = None
+        self._info_ts = 0
 
         self.gain_a = None
         self.gain_b = None
         self.off_noise = None
         self.off_tot = None
+        self.calibration = None
         
         self.scheduleCRC = None
         self.schedule = None
@@ -399,47 +649,34 @@ class Circle(object):
 
         return True
 
-    def _expect_response(self, response_class, seqnr):        
-        retry_count = 1
-        retry_timeout = 5 #allow 5+1 seconds for timeout
-        #instead of expected response a status message with correct seqnr may be received
-        #the common case is the offline status 'E1'
-        #it appears that in case of bad networks the expected response competes with
-        #the offline status. Sometimes the proper response arrives just (<1s) after
-        #the offline status.
-        #the while loop is intended to deal with this situation.
-        while retry_count >= 0:
-            retry_count -= 1
-            try:
-                resp = self._comchan.expect_response(response_class, self.mac, seqnr, retry_timeout)
-            except (TimeoutException, SerialException) as reason:
-                if self.online:
-                    self.logger.info("OFFLINE Circle '%s'." % (self.attr['name'],))
-                self.online = False
-                raise TimeoutException("Timeout while waiting for response from circle '%s'" % (self.attr['name'],))
-            
-            if not isinstance(resp, response_class):
-                #error status returned
-                if resp.status.value == 0xE1:
-                    self.logger.debug("Received an error status '%04X' from circle '%s' - Network slow or circle offline - Retry receive ..." % (resp.status.value, self.attr['name']))
-                    retry_timeout = 1 #allow 1+1 seconds for timeout after an E1.
-                else:
-                    self.logger.info("Received an error status '%04X' from circle '%s' with correct seqnr - Retry receive ..." % (resp.status.value, self.attr['name']))
-            else:
-                ts_now = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
-                if not self.online:
-                    self.logger.info("ONLINE  Circle '%s' after %d seconds." % (self.attr['name'], ts_now - self.last_seen))
-                    self.online = True
-                #self.last_seen = (datetime.datetime.utcnow()-datetime.timedelta(seconds=time.timezone)).isoformat()
-                self.last_seen = ts_now
-                return resp
-        #we only end here when multiple ack or ackmac messages are generated before the real response
+    def _mark_online(self, resp=None):
+        ts_now = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
+        if not self.online:
+            self.logger.info("ONLINE  Circle '%s' after %d seconds." % (self.attr['name'], ts_now - self.last_seen))
+            self.online = True
+        self.last_seen = ts_now
+
+    def _mark_offline(self, reason=None):
         if self.online:
             self.logger.info("OFFLINE Circle '%s'." % (self.attr['name'],))
         self.online = False
-        #TODO: Replace timeout exception by more specific exception
-        raise TimeoutException("Received multiple error messages from circle '%s'" % (self.attr['name'],))
-        
+        return TimeoutException("Timeout while waiting for response from circle '%s'" % (self.attr['name'],))
+
+    def _submit(self, req, response_class, convert=None):
+        """sends a pipelined request to the circle, see Stick.submit()
+        requests to an offline circle fail at the first error status 'E1', so
+        they don't delay the round of the pipelined requests
+        """
+        return self._comchan.submit(req.serialize(), response_class, self.mac,
+                                    convert=convert,
+                                    on_response=self._mark_online,
+                                    on_failure=self._mark_offline,
+                                    fail_on_error=not self.online)
+
+    def _request(self, req, response_class):
+        """sends a request to the circle and waits for its response"""
+        return self._submit(req, response_class).result()
+
     def map_type(self, devtype):
         types = dict({0: 'stick', 1: 'circle+', 2: 'circle'})
         return types[devtype]
@@ -452,24 +689,24 @@ class Circle(object):
     def type(self):
         return self.map_type(self._type())
             
+    def _debug_enabled(self):
+        return self.logger.enabled(self.logger.levels.DEBUG)
+
+    def _calibration(self):
+        if self.calibration is None:
+            self.calibrate()
+        return self.calibration
+
     def pulse_correction(self, pulses, seconds=1):
         """correct pulse count with Circle specific calibration offsets
         @param pulses: pulse counter
         @param seconds: over how many seconds were the pulses counted
         """
-        self.logger.debug("PULSE: uncorrected: %.3f" % (pulses,))
         if pulses == 0:
             return 0.0
-
-        if self.gain_a is None:
-            self.calibrate()
-
-        pulses /= float(seconds)
-        corrected_pulses = seconds * (((((pulses + self.off_noise)**2) * self.gain_b) + ((pulses + self.off_noise) * self.gain_a)) + self.off_tot)
-        self.logger.debug("PULSE:   corrected: %.3f" % (pulses/seconds,))
-        self.logger.debug("PULSE: t corrected: %.3f" % (pulses,))
-        if (pulses > 0.0 and corrected_pulses < 0.0 or pulses < 0.0 and corrected_pulses > 0.0):
-            return 0.0
+        corrected_pulses = self._calibration().pulse_correction(pulses, seconds)
+        if self._debug_enabled():
+            self.logger.debug("PULSE: uncorrected: %.3f corrected: %.3f" % (pulses, corrected_pulses))
         return corrected_pulses
 
     def pulses_to_kWs(self, pulses):
@@ -486,65 +723,85 @@ class Circle(object):
         """
         if watt == 0:
             return 0.0
-
-        if self.gain_a is None:
-            self.calibrate()
-
-        corr_pulses_1s = watt * PULSES_PER_KW_SECOND / 1000.0
-        
-        raw_pulses_1s = (math.sqrt(self.gain_a**2.0 + 4.0 * self.gain_b * (corr_pulses_1s - self.off_tot)) - self.gain_a - 2.0 * self.gain_b * self.off_noise) / (2.0 * self.gain_b);
-        if (corr_pulses_1s > 0.0 and raw_pulses_1s < 0.0 or corr_pulses_1s < 0.0 and raw_pulses_1s > 0.0):
-            return 0.0
-        return seconds*raw_pulses_1s
+        return self._calibration().watt_to_pulses(watt, seconds)
 
     def calibrate(self):
         """fetch calibration info from the device
         """
-        msg = PlugwiseCalibrationRequest(self.mac).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        calibration_response = self._expect_response(PlugwiseCalibrationResponse, seqnr)
+        calibration_response = self._request(PlugwiseCalibrationRequest(self.mac), PlugwiseCalibrationResponse)
         retl = []
 
         for x in ('gain_a', 'gain_b', 'off_noise', 'off_tot'):
             val = getattr(calibration_response, x).value
             retl.append(val)
             setattr(self, x, val)
+        self.calibration = Calibration(*retl)
 
         return retl
 
-    def get_pulse_counters(self):
-        """return pulse counters for 1s interval, 8s interval and for the current hour,
-        both usage and production as a tuple
-        """
-        msg = PlugwisePowerUsageRequest(self.mac).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwisePowerUsageResponse, seqnr)
+    def _pulse_counters_from_response(self, resp):
         p1s, p8s, p1h, pp1h = resp.pulse_1s.value, resp.pulse_8s.value, resp.pulse_hour.value, resp.pulse_prod_hour.value
         if self.attr['production'] == 'False':
             pp1h = 0
         return (p1s, p8s, p1h, pp1h)
 
+    def get_pulse_counters(self):
+        """return pulse counters for 1s interval, 8s interval and for the current hour,
+        both usage and production as a tuple
+        """
+        return self._submit(PlugwisePowerUsageRequest(self.mac), PlugwisePowerUsageResponse,
+                            self._pulse_counters_from_response).result()
+
+    def get_power_usage_async(self):
+        """pipelined version of get_power_usage(), returns a PlugwiseFuture
+        """
+        return self._submit(PlugwisePowerUsageRequest(self.mac), PlugwisePowerUsageResponse,
+                            self._power_usage_from_response)
+
     def get_power_usage(self):
         """returns power usage for the last second in Watts
         might raise ValueError if reading the pulse counters fails
         """
-        pulse_1s, pulse_8s, pulse_1h, pulse_prod_1h = self.get_pulse_counters()
-        kw_1s = 1000*self.pulses_to_kWs(self.pulse_correction(pulse_1s))
-        self.logger.debug("POWER:          1s: %.3f" % (kw_1s,))
-        kw_8s = 1000*self.pulses_to_kWs(self.pulse_correction(pulse_8s, 8))/8.0
-        self.logger.debug("POWER:          8s: %.3f" % (kw_8s,))
-        kw_1h = 1000*self.pulses_to_kWs(self.pulse_correction(pulse_1h, 3600))/3600.0
-        self.logger.debug("POWER:          1h: %.3f" % (kw_1h,))
-        kw_p_1h = 1000*self.pulses_to_kWs(self.pulse_correction(pulse_prod_1h, 3600))/3600.0
-        self.logger.debug("POWER:     prod 1h: %.3f" % (kw_p_1h,))
+        return self.get_power_usage_async().result()
+
+    def _power_usage_from_response(self, resp):
+        kw_1s, kw_8s, kw_1h, kw_p_1h = self._calibration().to_watts(self._pulse_counters_from_response(resp),
+                                                                    POWER_USAGE_SECONDS)
+        if self._debug_enabled():
+            self.logger.debug("POWER: 1s: %.3f 8s: %.3f 1h: %.3f prod 1h: %.3f" % (kw_1s, kw_8s, kw_1h, kw_p_1h))
         self.power = [kw_1s, kw_8s, kw_1h, kw_p_1h]
         self.power_ts = calendar.timegm(datetime.datetime.utcnow().utctimetuple())
         #just return negative values. It is production
         return (kw_1s, kw_8s, kw_1h, kw_p_1h)
 
+    def get_info_async(self):
+        """pipelined version of get_info(), returns a PlugwiseFuture
+        """
+        return self._submit(PlugwiseInfoRequest(self.mac), PlugwiseInfoResponse,
+                            self._info_from_response)
+
     def get_info(self):
         """fetch relay state & current logbuffer index info
         """
+        return self.get_info_async().result()
+
+    def info_expired(self):
+        """True when the cached device info is older than info_ttl seconds
+        """
+        return self._info is None or time.time() - self._info_ts >= self.info_ttl
+
+    def get_cached_info(self):
+        """returns the device info of the last get_info(), which is called again
+        when the cached info is expired
+        """
+        if self.info_expired():
+            self.get_info()
+        return self._info
+
+    def invalidate_info(self):
+        self._info = None
+
+    def _info_from_response(self, resp):
         def map_hz(hz_raw):
             if hz_raw == 133:
                 return 50
@@ -555,15 +812,14 @@ class Circle(object):
             states = dict({0: 'off', 1: 'on'})
             return states[state]
 
-        msg = PlugwiseInfoRequest(self.mac).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseInfoResponse, seqnr)
         retd = response_to_dict(resp)
         retd['hz'] = map_hz(retd['hz'])
         self._devtype = retd['type']
         retd['type'] = self.map_type(retd['type'])
         retd['relay_state'] = relay(retd['relay_state'])
         self.relay_state = retd['relay_state']
+        self._info = retd
+        self._info_ts = time.time()
         if self.attr['always_on'] != 'False' and self.relay_state == 'off':
             return False
         
@@ -572,9 +828,7 @@ class Circle(object):
     def get_clock(self):
         """fetch current time from the device
         """
-        msg = PlugwiseClockInfoRequest(self.mac).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseClockInfoResponse, seqnr)
+        resp = self._request(PlugwiseClockInfoRequest(self.mac), PlugwiseClockInfoResponse)
         self.scheduleCRC = resp.scheduleCRC.value
         self.logger.debug("Circle %s get clock to %s" % (self.attr['name'], resp.time.value.isoformat()))
         return resp.time.value
@@ -583,9 +837,7 @@ class Circle(object):
         """set clock to the value indicated by the datetime object dt
         """
         self.logger.debug("Circle %s set clock to %s" % (self.attr['name'], dt.isoformat()))
-        msg = PlugwiseClockSetRequest(self.mac, dt).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseAckMacResponse, seqnr)
+        resp = self._request(PlugwiseClockSetRequest(self.mac, dt), PlugwiseAckMacResponse)
         #status = '00D7'
         return dt
 
@@ -599,8 +851,8 @@ class Circle(object):
         if self.attr['always_on'] != 'False' and on != True:
             return False
         req = PlugwiseSwitchRequest(self.mac, on)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        resp = self._expect_response(PlugwiseAckMacResponse, seqnr)
+        self.invalidate_info()
+        resp = self._request(req, PlugwiseAckMacResponse)
         if on == True:
             if resp.status.value != 0xD8:
                 self.logger.info("Wrong switch status reply when  switching on. expected '00D8', received '%04X'" % (resp.status.value,))
@@ -646,10 +898,16 @@ class Circle(object):
             if log_buffer_index > 0:
                 log_buffer_index -= 1
 
-        log_req = PlugwisePowerBufferRequest(self.mac, log_buffer_index).serialize()
-        _, seqnr  = self._comchan.send_msg(log_req)
-        resp = self._expect_response(PlugwisePowerBufferResponse, seqnr)
-        
+        return self.get_power_usage_history_async(log_buffer_index, start_dt).result()
+
+    def get_power_usage_history_async(self, log_buffer_index, start_dt=None):
+        """pipelined version of get_power_usage_history(), returns a PlugwiseFuture
+        several log buffers can be requested back-to-back
+        """
+        return self._submit(PlugwisePowerBufferRequest(self.mac, log_buffer_index), PlugwisePowerBufferResponse,
+                            lambda resp: self._power_usage_history_from_response(resp, start_dt))
+
+    def _power_usage_history_from_response(self, resp, start_dt):
         intervals = []
         dts = []
         pulses = []
@@ -676,7 +934,6 @@ class Circle(object):
                 prev2_dt = prev_dt
                 prev_dt = dts[i]
 
-        retl = []        
         for i in range(0, len(dts)):
             #first two elements of interval may be zero. Derive intervals
             #try to get it from intervals within the four readings
@@ -691,12 +948,9 @@ class Circle(object):
                     intervals[i] = (dts[i+1]-dts[i]).total_seconds()
                 else:
                     intervals[i]=3600
-               
-            corrected_pulses = self.pulse_correction(pulses[i], intervals[i])
-            watt = self.pulses_to_kWs(corrected_pulses)/intervals[i]*1000
-            watthour = self.pulses_to_kWs(corrected_pulses)/3600*1000
-            retl.append((dts[i], watt, watthour))
-        return retl
+
+        watts = self._calibration().to_watts(pulses, intervals)
+        return [ (dts[i], watts[i], watts[i]*intervals[i]/3600.0) for i in range(0, len(dts)) ]
 
     def get_power_usage_history_raw(self, log_buffer_index=None):
         """Reads the raw interpreted power usage information from the given log buffer 
@@ -713,9 +967,7 @@ class Circle(object):
             info_resp = self.get_info()
             log_buffer_index = info_resp['last_logaddr']
 
-        log_req = PlugwisePowerBufferRequest(self.mac, log_buffer_index).serialize()
-        _, seqnr  = self._comchan.send_msg(log_req)
-        resp = self._expect_response(PlugwisePowerBufferResponseRaw, seqnr)
+        resp = self._request(PlugwisePowerBufferRequest(self.mac, log_buffer_index), PlugwisePowerBufferResponseRaw)
         retl = getattr(resp, "raw").value
 
         return retl
@@ -728,35 +980,27 @@ class Circle(object):
             False: Usage logging only.
             True:  Usage and Production logging.
         """
-        msg = PlugwiseLogIntervalRequest(self.mac, interval, interval if production else 0).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        return self._expect_response(PlugwiseAckMacResponse, seqnr)
+        return self._request(PlugwiseLogIntervalRequest(self.mac, interval, interval if production else 0), PlugwiseAckMacResponse)
         #status = '00F8'
         
     def get_features(self):
         """fetch feature set
         """
 
-        msg = PlugwiseFeatureSetRequest(self.mac).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseFeatureSetResponse, seqnr)
+        resp = self._request(PlugwiseFeatureSetRequest(self.mac), PlugwiseFeatureSetResponse)
         return resp.features.value
         
     def get_circleplus_datetime(self):
         """fetch current time from the circle+
         """
-        msg = PlugwiseDateTimeInfoRequest(self.mac).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        resp = self._expect_response(PlugwiseDateTimeInfoResponse, seqnr)
+        resp = self._request(PlugwiseDateTimeInfoRequest(self.mac), PlugwiseDateTimeInfoResponse)
         dt = datetime.datetime.combine(resp.date.value, resp.time.value)
         return dt
         
     def set_circleplus_datetime(self, dt):
         """set circle+ clock to the value indicated by the datetime object dt
         """
-        msg = PlugwiseSetDateTimeRequest(self.mac, dt).serialize()
-        _, seqnr  = self._comchan.send_msg(msg)
-        return self._expect_response(PlugwiseAckMacResponse, seqnr)
+        return self._request(PlugwiseSetDateTimeRequest(self.mac, dt), PlugwiseAckMacResponse)
         #status = '00DF'=ack '00E7'=nack
         
     def define_schedule(self, name, scheddata, dst=0):
@@ -778,8 +1022,7 @@ class Circle(object):
                 _, seqnr  = self._comchan.send_msg(req.serialize())
             for idx in range(1,43):
                 req = PlugwiseSendScheduleRequest(self.mac, idx)
-                _, seqnr  = self._comchan.send_msg(req.serialize())
-                resp = self._expect_response(PlugwiseSendScheduleResponse, seqnr)
+                resp = self._request(req, PlugwiseSendScheduleResponse)
             self.logger.info("circle.load_schedule. exit function")
 
     def schedule_onoff(self, on):
@@ -792,8 +1035,7 @@ class Circle(object):
         if self.attr['always_on'] != 'False':
             return False
         req = PlugwiseEnableScheduleRequest(self.mac, on)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        resp = self._expect_response(PlugwiseAckMacResponse, seqnr)
+        resp = self._request(req, PlugwiseAckMacResponse)
         if on == True:
             if resp.status.value != 0xE4:
                 self.logger.info("Wrong schedule status reply when setting schedule on. expected '00E4', received '%04X'" % (resp.status.value,))
@@ -821,8 +1063,7 @@ class Circle(object):
         #TODO: incorporate this in Schedule object
         val = self.watt_to_pulses(val) if val>=0 else val
         req = PlugwiseSetScheduleValueRequest(self.mac, val)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        return self._expect_response(PlugwiseAckMacResponse, seqnr)
+        return self._request(req, PlugwiseAckMacResponse)
         #status = '00FA'
         
         
@@ -848,34 +1089,34 @@ class Circle(object):
             self.production=True
         self.interval = int(interval.total_seconds())/60
         
+    def ping_async(self):
+        """pipelined version of ping(), returns a PlugwiseFuture
+        """
+        return self._submit(PlugwisePingRequest(self.mac), PlugwisePingResponse)
+
     def ping(self):
         """ping circle
         """
-        req = PlugwisePingRequest(self.mac)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        return self._expect_response(PlugwisePingResponse, seqnr)
+        return self.ping_async().result()
 
     def read_node_table(self):
         #Needs to be called on Circle+
         nodetable = []
         for idx in range(0,64):
             req = PlugwiseAssociatedNodesRequest(self.mac, idx)
-            _, seqnr  = self._comchan.send_msg(req.serialize())
-            resp = self._expect_response(PlugwiseAssociatedNodesResponse, seqnr)
+            resp = self._request(req, PlugwiseAssociatedNodesResponse)
             nodetable.append(resp.node_mac_id.value)
         return nodetable
         
     def remove_node(self, removemac):
         #Needs to be called on Circle+
         req = PlugwiseRemoveNodeRequest(self.mac, removemac)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        resp = self._expect_response(PlugwiseRemoveNodeResponse, seqnr)
+        resp = self._request(req, PlugwiseRemoveNodeResponse)
         return resp.status.value
             
     def reset(self):
         req = PlugwiseResetRequest(self.mac, self._type(), 20)
-        _, seqnr  = self._comchan.send_msg(req.serialize())
-        resp = self._expect_response(PlugwiseAckMacResponse, seqnr)
+        resp = self._request(req, PlugwiseAckMacResponse)
         return resp.status.value
             
 def response_to_dict(r):
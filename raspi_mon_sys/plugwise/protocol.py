@@ -71,13 +71,15 @@ class CompositeType(BaseType):
         return b''.join(a.serialize() for a in self.contents)
 
     def unserialize(self, val):
+        offset = 0
         for p in self.contents:
-            myval = val[:len(p)]
-            #debug("PARS      "+repr(str(myval)))
+            length = len(p)
+            myval = val[offset:offset+length]
             p.unserialize(myval)
-            debug("PARS      "+repr(str(myval)) + " EVAL "+repr(str(p.value)))
-            val = val[len(myval):]
-        return val
+            if debug_enabled():
+                debug("PARS      "+repr(str(myval)) + " EVAL "+repr(str(p.value)))
+            offset += length
+        return val[offset:]
         
     def __len__(self):
         return sum(len(x) for x in self.contents)
@@ -241,6 +243,26 @@ class LogAddr(Int):
 
 # /base types
 
+class _ResponseLayout(object):
+    """field offsets of a response class, computed once by _response_layout()
+    the params are split with a single struct pass over the frame
+    """
+
+    def __init__(self, response):
+        self.params = struct.Struct("".join("%ds" % len(p) for p in response.params))
+        self.length = len(response)
+
+_HEADER = struct.Struct("4s4s4s")
+_TRAILER = struct.Struct("4s2s")
+_NO_MAC_FUNCTION_CODES = frozenset(['0000', '0002', '0003', '0005'])
+_response_layouts = {}
+
+def _response_layout(response):
+    layout = _response_layouts.get(response.__class__)
+    if layout is None:
+        layout = _response_layouts[response.__class__] = _ResponseLayout(response)
+    return layout
+
 class PlugwiseMessage(object):
     PACKET_HEADER = b'\x05\x05\x03\x03'
     PACKET_HEADER5 = b'\x83\x05\x05\x03\x03'
@@ -274,47 +296,38 @@ class PlugwiseResponse(PlugwiseMessage):
         self.expected_command_counter = seqnr
 
     def unserialize(self, response):
-        # FIXME: avoid magic numbers
-
-        header5 = False
-        header_start = response.find(PlugwiseMessage.PACKET_HEADER5)
-        if header_start == 0:
-            #A response from a circle seems to be preceeded by the x/83 in the header
-            #Just strip this character to not further complcate the code
-            response = response[1:]
-            header5 = True
-                
-        header, self.function_code, self.command_counter = struct.unpack("4s4s4s", response[:12])
-        crc, footer = struct.unpack("4s2s", response[-6:])
-        raw_msg_len = len(response)
-        
+        layout = _response_layout(self)
+
+        #A response from a circle seems to be preceeded by the x/83 in the header
+        #Just skip this character to not further complcate the code
+        header5 = response.startswith(PlugwiseMessage.PACKET_HEADER5)
+        start = 1 if header5 else 0
+        end = len(response) - 6
+        raw_msg_len = len(response) - start
+
+        header, self.function_code, self.command_counter = _HEADER.unpack_from(response, start)
+        crc, footer = _TRAILER.unpack_from(response, end)
 
         #check for protocol errors
         protocol_error = ''
         if footer != self.PACKET_FOOTER:
             protocol_error = "broken footer!"
-        else:
-            footer = '<---'
         if header != self.PACKET_HEADER:
             protocol_error = "broken header!"
-        else:
-            if header5:
-                header = '-->>'
-            else:
-                header = '--->'
-        if crc != self.calculate_checksum(response[4:-6]):
+        if crc != self.calculate_checksum(response[start+4:end]):
             protocol_error = "checksum error!"
-        debug("STRU      "+repr(header)+" "+repr(self.function_code)+" "+repr(self.command_counter)+" <data> "+repr(crc)+" "+repr(footer))
+        if debug_enabled():
+            debug("STRU      "+repr(header)+" "+repr(self.function_code)+" "+repr(self.command_counter)+" <data> "+repr(crc)+" "+repr(footer))
         if len(protocol_error) > 0:
             raise ProtocolError(protocol_error)
             
-            
-        if self.function_code in ['0000', '0002', '0003', '0005']:
-            response = response[12:-6]
+        if self.function_code in _NO_MAC_FUNCTION_CODES:
+            data_start = start + 12
         else:
-            self.mac = response[12:28]
-            response = response[28:-6]
-        debug("DATA %4d %s" % (len(response), repr(response)))
+            self.mac = response[start+12:start+28]
+            data_start = start + 28
+        if debug_enabled():
+            debug("DATA %4d %s" % (end - data_start, repr(response[data_start:end])))
         
         if self.function_code in ['0006', '0061']:
             error("response.unserialize: detected %s expected %s" % (self.function_code, self.ID))
@@ -323,10 +336,18 @@ class PlugwiseResponse(PlugwiseMessage):
             raise UnexpectedResponse("expected response code %s, received code %s" % (self.ID, self.function_code))
         if self.expected_command_counter != None and self.expected_command_counter != self.command_counter:
             raise OutOfSequenceException("expected seqnr %s, received seqnr %s - this may be a duplicate message" % (self.expected_command_counter, self.command_counter))
-        if raw_msg_len != len(self):
-            raise UnexpectedResponse("response doesn't have expected length. expected %d bytes got %d" % (len(self), raw_msg_len))
+        if raw_msg_len != layout.length:
+            raise UnexpectedResponse("response doesn't have expected length. expected %d bytes got %d" % (layout.length, raw_msg_len))
         
         #log communication when no exceptions will be raised
+        if logcomm_enabled():
+            self._logcomm(response[data_start:end], raw_msg_len, header5, crc)
+        
+        # FIXME: check function code match
+        self._parse_params(response, data_start, layout)
+
+    def _logcomm(self, response, raw_msg_len, header5, crc):
+        header = '-->>' if header5 else '--->'
         if self.mac is None:
             logmac = '................'
         else:
@@ -340,20 +361,18 @@ class PlugwiseResponse(PlugwiseMessage):
         else:
             respstatus = '....'
             logresp = response
-        logcomm("RECV %4d %s %4s %4s %4s %16s %s %4s %s" % (raw_msg_len, header, self.function_code, self.command_counter, respstatus, logmac, logresp, crc, footer))
-        #logcomm("RECV      "+repr(header)+" "+repr(self.function_code)+" "+repr(self.command_counter)+" <data> "+repr(crc)+" "+repr(footer))
-        
-        # FIXME: check function code match
-        response = self._parse_params(response)
+        logcomm("RECV %4d %s %4s %4s %4s %16s %s %4s %s" % (raw_msg_len, header, self.function_code, self.command_counter, respstatus, logmac, logresp, crc, '<---'))
 
-    def _parse_params(self, response):
-        for p in self.params:
-            myval = response[:len(p)]
-            #debug("PARS      "+repr(str(myval)))
+    def _parse_params(self, response, offset=0, layout=None):
+        if layout is None:
+            layout = _response_layout(self)
+        values = layout.params.unpack_from(response, offset)
+        for p,myval in zip(self.params, values):
             p.unserialize(myval)
-            debug("PARS      "+repr(str(myval)) + " EVAL "+repr(str(p.value)))
-            response = response[len(myval):]
-        return response
+        if debug_enabled():
+            for p,myval in zip(self.params, values):
+                debug("PARS      "+repr(str(myval)) + " EVAL "+repr(str(p.value)))
+        return response[offset+layout.params.size:]
 
     def __len__(self):
         arglen = sum(len(x) for x in self.params)
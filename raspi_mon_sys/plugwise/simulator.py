@@ -0,0 +1,222 @@
+"""Simulated Plugwise Stick and circles, for benchmarks and tests without hardware.
+
+The simulator opens a pseudo-terminal and answers the requests written to its
+slave device, so a Stick can be opened on it as on a real serial port::
+
+    sim = StickSimulator(num_circles=10, latency=0.05, loss=0.01)
+    sim.start()
+    stick = Stick(logger, sim.port)
+    circles = [ Circle(logger, mac, stick, attr) for mac in sim.macs() ]
+    ...
+    stick.close()
+    sim.stop()
+
+Every request is acknowledged at once, and the response of a circle is sent
+after latency plus a random jitter, so responses of pipelined requests may
+arrive out of sequence. Offline circles and lost messages answer with the
+error status 'E1', duplicates are sent again later and the header5 ratio of
+the responses is preceded by the '\\x83' byte, as done by the 2011 firmware.
+"""
+
+# Copyright (C) 2015 Miguel Lorenzo, Francisco Zamora-Martinez
+# Use of this source code is governed by the GPLv3 license found in the LICENSE file.
+
+import datetime
+import heapq
+import os
+import random
+import select
+import struct
+import binascii
+import threading
+import time
+import tty
+
+from .protocol import PlugwiseMessage, LogAddr, crc_fun
+from .api import PULSES_PER_KW_SECOND
+
+STICK_MAC = "000D6F0000000001"
+LOG_HOURS_PER_BUFFER = 4
+
+def _float(value):
+    return binascii.hexlify(struct.pack("!f", value)).upper()
+
+def _datetime(dt):
+    minutes = ((dt.day - 1)*24 + dt.hour)*60 + dt.minute
+    return "%02X%02X%04X" % (dt.year - 2000, dt.month, minutes)
+
+class SimulatedCircle(object):
+    """state of a simulated circle, its power draw is watts plus a relative noise"""
+
+    def __init__(self, mac, watts=100.0, noise=0.05, online=True, relay_state=1,
+                 logaddr=100):
+        self.mac = mac
+        self.watts = watts
+        self.noise = noise
+        self.online = online
+        self.relay_state = relay_state
+        # log buffers are hourly and the current one is logaddr at start time
+        now = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        self.log_start = now - datetime.timedelta(hours=logaddr*LOG_HOURS_PER_BUFFER)
+
+    def pulses(self, seconds):
+        watts = self.watts * (1.0 + random.uniform(-self.noise, self.noise))
+        if not self.relay_state: watts = 0.0
+        return int(round(watts * PULSES_PER_KW_SECOND / 1000.0 * seconds))
+
+    def last_logaddr(self):
+        hours = (datetime.datetime.utcnow() - self.log_start).total_seconds() // 3600
+        return int(hours) // LOG_HOURS_PER_BUFFER
+
+    def power_usage(self, params):
+        hour = datetime.datetime.utcnow()
+        seconds = hour.minute*60 + hour.second
+        return "%04X%04X%08X%08X%04X" % (self.pulses(1), self.pulses(8), self.pulses(seconds), 0, 0)
+
+    def info(self, params):
+        return (_datetime(datetime.datetime.utcnow()) +
+                "%08X" % (self.last_logaddr()*32 + LogAddr.LOGADDR_OFFSET) +
+                "%02X" % self.relay_state + "85" + "000000000000" + "4E0843A9" + "02")
+
+    def calibration(self, params):
+        # gain_a, gain_b, off_tot, off_noise of an ideal circle
+        return _float(1.0) + _float(0.0) + _float(0.0) + _float(0.0)
+
+    def power_buffer(self, params):
+        logaddr = (int(params[:8], 16) - LogAddr.LOGADDR_OFFSET) // 32
+        now = datetime.datetime.utcnow()
+        result = ""
+        for i in range(LOG_HOURS_PER_BUFFER):
+            dt = self.log_start + datetime.timedelta(hours=logaddr*LOG_HOURS_PER_BUFFER + i)
+            if dt + datetime.timedelta(hours=1) > now:
+                result += "FFFFFFFF" + "00000000"
+            else:
+                result += _datetime(dt) + "%08X" % self.pulses(3600)
+        return result + params[:8]
+
+    def ping(self, params):
+        return "%02X%02X%04X" % (0x40, 0x40, 0x10)
+
+class StickSimulator(object):
+    """pseudo-terminal answering as a Plugwise Stick with num_circles circles
+
+    @param latency: seconds between a request and the response of a circle
+    @param jitter: maximum random seconds added to latency
+    @param loss: probability of a circle response being replaced by 'E1'
+    @param duplicates: probability of a response being sent twice
+    @param header5: probability of a response preceded by '\\x83'
+    @param error_status_delay: seconds before an 'E1' status is sent
+    """
+
+    # function code of a request -> (function code of its response, circle method)
+    RESPONSES = {
+        "0012" : ("0013", "power_usage"),
+        "0023" : ("0024", "info"),
+        "0026" : ("0027", "calibration"),
+        "0048" : ("0049", "power_buffer"),
+        "000D" : ("000E", "ping"),
+    }
+
+    def __init__(self, num_circles=4, latency=0.05, jitter=0.0, loss=0.0,
+                 duplicates=0.0, header5=0.5, error_status_delay=0.5, seed=None):
+        self.circles = {}
+        for i in range(num_circles):
+            mac = "000D6F00%08X" % (0x00B10000 + i)
+            self.circles[mac] = SimulatedCircle(mac, watts=10.0*(i+1))
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicates = duplicates
+        self.header5 = header5
+        self.error_status_delay = error_status_delay
+        self.random = random.Random(seed)
+        self.port = None
+        self.requests = 0
+        self.__master = None
+        self.__slave = None
+        self.__seqnr = 0
+        self.__outbox = []
+        self.__cond = threading.Condition()
+        self.__running = False
+        self.__threads = []
+
+    def macs(self):
+        return sorted(self.circles.keys())
+
+    def start(self):
+        self.__master, self.__slave = os.openpty()
+        tty.setraw(self.__slave)
+        self.port = os.ttyname(self.__slave)
+        self.__running = True
+        self.__threads = [ threading.Thread(target=self.__reader_loop),
+                           threading.Thread(target=self.__writer_loop) ]
+        for t in self.__threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        self.__running = False
+        with self.__cond: self.__cond.notify()
+        for t in self.__threads: t.join()
+        os.close(self.__master)
+        os.close(self.__slave)
+
+    def __frame(self, body, header5=False):
+        msg = PlugwiseMessage.PACKET_HEADER + body + "%04X" % crc_fun(body) + PlugwiseMessage.PACKET_FOOTER
+        return PlugwiseMessage.PACKET_HEADER5[0] + msg if header5 else msg
+
+    def __send(self, delay, msg):
+        with self.__cond:
+            heapq.heappush(self.__outbox, (time.time() + delay, msg))
+            self.__cond.notify()
+
+    def __reader_loop(self):
+        buf = ""
+        while self.__running:
+            ready,_,_ = select.select([self.__master], [], [], 0.1)
+            if not ready: continue
+            buf += os.read(self.__master, 4096)
+            while PlugwiseMessage.PACKET_FOOTER in buf:
+                msg,buf = buf.split(PlugwiseMessage.PACKET_FOOTER, 1)
+                start = msg.find(PlugwiseMessage.PACKET_HEADER)
+                if start >= 0: self.__request(msg[start+4:-4])
+
+    def __writer_loop(self):
+        while True:
+            with self.__cond:
+                while self.__running and (not self.__outbox or self.__outbox[0][0] > time.time()):
+                    timeout = None if not self.__outbox else self.__outbox[0][0] - time.time()
+                    self.__cond.wait(timeout)
+                if not self.__running: return
+                _,msg = heapq.heappop(self.__outbox)
+            os.write(self.__master, msg)
+
+    def __request(self, body):
+        self.requests += 1
+        function_code, mac, params = body[:4], body[4:20], body[20:]
+        self.__seqnr = (self.__seqnr + 1) & 0xFFFF
+        seqnr = "%04X" % self.__seqnr
+        self.__send(0, self.__frame("0000" + seqnr + "00C1"))
+        rnd = self.random
+        if function_code == "000A":
+            self.__send(0, self.__frame("0011" + seqnr + STICK_MAC + "00" + "01" + "0"*16 + "0000" + "00"))
+            return
+        circle = self.circles.get(mac)
+        if circle is None or not circle.online or rnd.random() < self.loss:
+            self.__send(self.error_status_delay, self.__frame("0000" + seqnr + "00E1" + mac, True))
+            return
+        delay = self.latency + rnd.uniform(0, self.jitter)
+        if function_code == "0017":
+            circle.relay_state = int(params[:2], 16)
+            status = "00D8" if circle.relay_state else "00DE"
+            response = self.__frame("0000" + seqnr + status + mac, rnd.random() < self.header5)
+        elif function_code in self.RESPONSES:
+            response_code, method = self.RESPONSES[function_code]
+            response = self.__frame(response_code + seqnr + mac + getattr(circle, method)(params),
+                                    rnd.random() < self.header5)
+        else:
+            # only acknowledged by the Stick
+            return
+        self.__send(delay, response)
+        if rnd.random() < self.duplicates:
+            self.__send(delay + self.latency, response)
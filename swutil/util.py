@@ -83,6 +83,10 @@ def log_comm(enable):
     global LOG_COMMUNICATION
     LOG_COMMUNICATION = enable
 
+def debug_enabled():
+    """True when debug() messages are written, to skip formatting them otherwise"""
+    return pw_logger is not None and pw_logger.isEnabledFor(logging.DEBUG)
+
 def debug(msg):
     #if __debug__ and DEBUG_PROTOCOL:
         #print("%s: %s" % (datetime.datetime.now().isoformat(), msg,))
@@ -115,6 +119,10 @@ def close_logcomm():
     #logcommfile.close()
     return
     
+def logcomm_enabled():
+    """True when logcomm() messages are written, to skip formatting them otherwise"""
+    return LOG_COMMUNICATION and pw_comm_logger is not None
+
 def logcomm(msg):
     if LOG_COMMUNICATION:
         #logcommfile.write("%s %s \n" % (datetime.datetime.now().isoformat(), msg,))
@@ -134,6 +142,9 @@ class SerialComChannel(object):
     def open(self):
         self._fd = Serial(port=self.port, baudrate=self.baud, bytesize=self.bits, parity='N', stopbits=stop)
 
+    def close(self):
+        self._fd.close()
+
     def read(self, bytecount):
         return self._fd.read(bytecount)
 
@@ -0,0 +1,153 @@
+"""Compares the NumPy aggregation engine of the Grafana servers with the
+JavaScript map-reduce which they used before.
+
+usage: benchmark_grafana_aggregation.py [num_hours [max_data_points [host [port]]]]
+
+It needs a MongoDB server with JavaScript enabled. A topic with num_hours hour
+documents of 1 Hz values is written to a raspimon_benchmark database, which is
+dropped at the end, and every operator is computed by both implementations,
+reporting their time and the largest difference between their results.
+"""
+import datetime
+import os
+import random
+import sys
+import time
+
+import pymongo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                                "utils", "grafana_datasources", "server"))
+import aggregation
+
+TOPIC = "raspimon:benchmark:plugwise:power"
+
+mapfn_template = """function() {{
+    period = {0};
+    b = this.basetime;
+    for(i=0; i<this.values.length; ++i) {{
+        secs = b.getTime()/1000.0 + this.delta_times[i];
+        key  = Math.floor( secs / period ) * period;
+        emit(key, {{ secs: secs, value: this.values[i] }});
+    }}
+}}"""
+
+take_one_reducefn = """function(key,values) {{
+    values.sort(function(a,b) {{ return a.secs - b.secs; }});
+    return {{ secs:values[{0}].secs, value: values[{0}].value }};
+}}"""
+
+avg_reducefn = """function(key,values) {{
+    values.sort(function(a,b) {{ return a.secs - b.secs; }});
+    sum = 0.0;
+    t = 0.0;
+    for(i=1; i<values.length; ++i) {{
+        dt = values[i].secs - values[i-1].secs;
+        if (dt > 0.0) {{
+            value = 0.5*values[i].value + 0.5*values[i-1].value;
+            sum  += value * dt;
+            t    += dt;
+        }}
+    }}
+    if (t < 1.0) t = 1.0;
+    if (sum == 0.0) sum = values[0].value;
+    return {{ secs: 0.5*values[0].secs + 0.5*values[values.length-1].secs, value: sum/t }};
+}}"""
+
+sum_reducefn = """function(key,values) {{
+    values.sort(function(a,b) {{ return a.secs - b.secs; }});
+    sum = 0.0;
+    for(i=1; i<values.length; ++i) {{
+        dt = values[i].secs - values[i-1].secs;
+        if (dt > 0.0) {{
+            value = 0.5*values[i].value + 0.5*values[i-1].value;
+            sum  += value * dt;
+        }}
+    }}
+    if (sum == 0.0) sum = values[0].value;
+    return {{ secs: 0.5*values[0].secs + 0.5*values[values.length-1].secs, value: sum }};
+}}"""
+
+generic_math_reducefn = """function(key,values) {{
+    values.sort(function(a,b) {{ return a.secs - b.secs; }});
+    result = values[0].value;
+    t = 0.0;
+    for(i=1; i<values.length; ++i) {{
+        secs   = values[i].secs;
+        value  = values[i].value;
+        dt     = secs - values[i-1].secs;
+        result = Math.{0}(result, value);
+        t     += dt;
+    }}
+    if (t < 1.0) t = 1.0;
+    return {{ secs: values[0].secs + t*0.5, value: result }};
+}}"""
+
+reduce_operators = {
+    "first" : [ take_one_reducefn, 0 ],
+    "last" : [ take_one_reducefn, "values.length-1" ],
+    "sum" : [ sum_reducefn ],
+    "avg" : [ avg_reducefn ],
+    "min" : [ generic_math_reducefn, "min" ],
+    "max" : [ generic_math_reducefn, "max" ]
+}
+
+def inline_map_reduce(col, query, step, agg):
+    mapfn = mapfn_template.format(step)
+    reducefn = reduce_operators[agg][0].format(*reduce_operators[agg][1:])
+    data = col.inline_map_reduce(mapfn, reducefn, full_response=False,
+                                 query=query, sort={"topic":1,"basetime":1})
+    data.sort(key=lambda x: x["_id"])
+    return [ x["value"]["secs"] for x in data ],[ x["value"]["value"] for x in data ]
+
+def numpy_aggregate(col, query, step, agg):
+    secs,values = aggregation.fetch_series(col, query)
+    keys,secs,values = aggregation.aggregate(secs, values, step, agg)
+    return secs,values
+
+def max_difference(a, b):
+    if len(a) != len(b): return float("inf")
+    return max([ abs(x - y) for x,y in zip(a,b) ] + [ 0.0 ])
+
+num_hours = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+max_data_points = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+host = sys.argv[3] if len(sys.argv) > 3 else "localhost"
+port = int(sys.argv[4]) if len(sys.argv) > 4 else 27017
+
+client = pymongo.MongoClient(host, port)
+col = client["raspimon_benchmark"]["GVA2015_data"]
+col.drop()
+rnd = random.Random(1234)
+start = 1448150400
+value = 100.0
+for h in range(num_hours):
+    delta_times = []
+    values = []
+    for i in range(3600):
+        value = max(0.0, value + rnd.gauss(0.0, 5.0))
+        delta_times.append(i + rnd.uniform(0.0, 0.2))
+        values.append(round(value, 2))
+    col.insert_one({ "house" : "benchmark", "topic" : TOPIC,
+                     "basetime" : datetime.datetime.utcfromtimestamp(start + h*3600),
+                     "delta_times" : delta_times, "values" : values })
+stop = start + num_hours*3600
+query = {
+    "topic" : TOPIC,
+    "basetime" : { "$gte" : datetime.datetime.utcfromtimestamp(start),
+                   "$lte" : datetime.datetime.utcfromtimestamp(stop) }
+}
+step = max((stop - start) / max_data_points, 1)
+
+print("%d values, step %d s" % (num_hours*3600, step))
+for agg in aggregation.OPERATORS:
+    t0 = time.time()
+    js_secs,js_values = inline_map_reduce(col, query, step, agg)
+    t1 = time.time()
+    np_secs,np_values = numpy_aggregate(col, query, step, agg)
+    t2 = time.time()
+    print("%-5s map-reduce %.3f s, numpy %.3f s, speed-up %.1fx, max difference secs %g values %g" %
+          (agg, t1 - t0, t2 - t1, (t1 - t0) / max(t2 - t1, 1e-6),
+           max_difference(js_secs, np_secs.tolist()),
+           max_difference(js_values, np_values.tolist())))
+client.drop_database("raspimon_benchmark")
+client.close()
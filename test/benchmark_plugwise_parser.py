@@ -0,0 +1,59 @@
+"""Measures how many Stick frames per second PlugwiseResponse.unserialize parses.
+
+It uses a sample of Stick traffic for a poll round of power usage and info
+requests, or the frames stored in the file given as argument, one repr() of
+a frame per line.
+"""
+import sys
+import time
+
+from raspi_mon_sys.plugwise.protocol import *
+
+N = 20000
+
+RESPONSE_CLASSES = dict( (x.ID, x) for x in (PlugwisePowerUsageResponse,
+                                             PlugwiseInfoResponse,
+                                             PlugwiseCalibrationResponse,
+                                             PlugwisePowerBufferResponse) )
+
+def frame(body, header5=False):
+    msg = PlugwiseMessage.PACKET_HEADER + body + "%04X" % crc_fun(body) + PlugwiseMessage.PACKET_FOOTER
+    return PlugwiseMessage.PACKET_HEADER5[0] + msg if header5 else msg
+
+def sample_traffic():
+    mac = "000D6F0000B1B64B"
+    return [
+        frame("0000" + "00A1" + "00C1"),
+        frame("0013" + "00A1" + mac + "0004" + "0021" + "00000E10" + "00000000" + "0000", True),
+        frame("0000" + "00A2" + "00C1"),
+        frame("0024" + "00A2" + mac + "0F01" + "0000" + "00044020" + "01" + "85" + "000000000000" + "4E0843A9" + "02", True),
+        frame("0000" + "00A3" + "00C1"),
+        frame("0000" + "00A3" + "00E1" + mac, True),
+        frame("0000" + "00A4" + "00C1"),
+        frame("0049" + "00A4" + mac + "10010000" + "00000E10" + "1001003C" + "00000E10" +
+              "10010078" + "00000E10" + "100100B4" + "00000E10" + "00044020", True),
+    ]
+
+def parse(msg):
+    if msg.startswith(PlugwiseMessage.PACKET_HEADER5):
+        function_code = msg[5:9]
+    else:
+        function_code = msg[4:8]
+    if function_code == "0000":
+        resp = PlugwiseAckMacResponse() if len(msg) in (38, 39) else PlugwiseAckResponse()
+    else:
+        resp = RESPONSE_CLASSES[function_code]()
+    resp.unserialize(msg)
+    return resp
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        traffic = [ eval(line) for line in open(sys.argv[1]) if line.strip() ]
+    else:
+        traffic = sample_traffic()
+    for msg in traffic: parse(msg)
+    t0 = time.time()
+    for i in xrange(N):
+        parse(traffic[i % len(traffic)])
+    t = time.time() - t0
+    print("%d frames in %.3f s, %.0f frames/s" % (N, t, N/t))
@@ -0,0 +1,56 @@
+"""Measures Plugwise polling throughput and timeout recovery with a simulated Stick.
+
+usage: benchmark_plugwise_stick.py [num_circles [latency [loss [rounds]]]]
+
+Every round pipelines a power usage request to all the circles, as done by
+PlugwiseMonitor.publish(), one of them being offline.
+"""
+import sys
+import time
+
+import raspi_mon_sys.plugwise.api as plugwise_api
+from raspi_mon_sys.plugwise.simulator import StickSimulator
+
+class QuietLogger:
+    class levels:
+        DEBUG, INFO = "DEBUG", "INFO"
+    def enabled(self, level): return False
+    def debug(self, strfmt, *args): pass
+    def info(self, strfmt, *args): pass
+
+num_circles = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+loss = float(sys.argv[3]) if len(sys.argv) > 3 else 0.01
+rounds = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+
+sim = StickSimulator(num_circles, latency=latency, jitter=latency, loss=loss,
+                     duplicates=0.01, seed=1234)
+sim.circles[sim.macs()[0]].online = False
+sim.start()
+logger = QuietLogger()
+stick = plugwise_api.Stick(logger, sim.port)
+circles = [ plugwise_api.Circle(logger, mac, stick, {
+    "name" : mac, "location" : "", "always_on" : "False", "production" : "False"
+}) for mac in sim.macs() ]
+
+times = []
+failures = 0
+t0 = time.time()
+for i in range(rounds):
+    t = time.time()
+    futures = [ c.get_power_usage_async() for c in circles ]
+    stick.wait(futures)
+    for f in futures:
+        try:
+            f.result()
+        except plugwise_api.TimeoutException:
+            failures += 1
+    times.append(time.time() - t)
+total = time.time() - t0
+stick.close()
+sim.stop()
+
+times.sort()
+print("%d rounds of %d circles in %.2f s, %.1f readings/s" % (rounds, num_circles, total, rounds*num_circles/total))
+print("round time: median %.3f s, max %.3f s" % (times[len(times)//2], times[-1]))
+print("failed readings: %d, stick counters: %s" % (failures, stick.counters))
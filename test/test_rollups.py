@@ -0,0 +1,96 @@
+"""Compares the keys computed from the rollups written by MongoDBHub with the
+keys computed from the raw values by the Grafana servers.
+
+usage: test_rollups.py
+
+Sparse and dense series are split in hour documents, as done by MongoDBHub,
+and their rollups are reduced by every rollup resolution and step multiple of
+it, up to one week, reporting the largest relative difference with the
+aggregation of the raw values of every operator.
+"""
+import os
+import random
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                                "utils", "grafana_datasources", "server"))
+import aggregation
+import raspi_mon_sys.MongoDBHub as MongoDBHub
+
+rollup_points = getattr(MongoDBHub, "__rollup_points")
+
+START = 1451606400 # 2016-01-01 00:00:00 UTC
+DAYS = 14
+TOLERANCE = 1e-9
+
+def series(period, jitter):
+    """Returns sorted secs and values with one value every period seconds."""
+    rnd = random.Random(period)
+    secs = []
+    t = START + rnd.random() * period
+    while t < START + DAYS*86400:
+        secs.append(round(t, 3))
+        t += period * (1.0 + jitter * (rnd.random() - 0.5))
+    values = [ 100.0 + 50.0 * rnd.random() for x in secs ]
+    return np.array(secs),np.array(values)
+
+def rollups(secs, values, resolution):
+    """Returns the rollups of the hour documents of a series sorted by time,
+    merging the ones with the same time as done by the upserts of MongoDBHub."""
+    result = {}
+    hours = np.floor(secs / 3600) * 3600
+    for basetime in np.unique(hours):
+        inside = hours == basetime
+        delta_times = list(secs[inside] - basetime)
+        points = rollup_points(delta_times, list(values[inside]), basetime, resolution)
+        for key,r in points.iteritems():
+            first = { "secs" : r["first"][0], "value" : r["first"][1] }
+            last = { "secs" : r["last"][0], "value" : r["last"][1] }
+            x = result.get(key)
+            if x is None:
+                result[key] = {
+                    "time" : key, "count" : r["count"], "min" : r["min"], "max" : r["max"],
+                    "first" : first, "last" : last, "sum" : r["sum"], "t" : r["t"],
+                    "head" : { "sum" : r["head_sum"], "t" : r["head_t"] },
+                }
+            else:
+                x["count"] += r["count"]
+                x["sum"] += r["sum"]
+                x["t"] += r["t"]
+                x["head"]["sum"] += r["head_sum"]
+                x["head"]["t"] += r["head_t"]
+                x["min"] = min(x["min"], r["min"])
+                x["max"] = max(x["max"], r["max"])
+                if first["secs"] < x["first"]["secs"]: x["first"] = first
+                if last["secs"] > x["last"]["secs"]: x["last"] = last
+    return [ result[key] for key in sorted(result) ]
+
+def max_error(a, b):
+    if len(a) != len(b): return float("inf")
+    if len(a) == 0: return 0.0
+    return float(np.max(np.abs(a - b) / np.maximum(np.abs(b), 1.0)))
+
+failures = 0
+for name,period,jitter in ( ("hourly", 3600, 0.5), ("10 minutes", 600, 0.5),
+                            ("1 minute", 60, 1.0), ("irregular", 7, 1.9) ):
+    secs,values = series(period, jitter)
+    for resolution in aggregation.ROLLUP_RESOLUTIONS:
+        rolled = rollups(secs, values, resolution)
+        for step in sorted(set([ resolution, 2*resolution, 3600, 86400, 7*86400 ])):
+            if step % resolution != 0: continue
+            lo = np.floor(START / step) * step
+            hi = np.floor((START + DAYS*86400) / step) * step + step
+            for agg in aggregation.OPERATORS:
+                expected = aggregation.aggregate(secs, values, step, agg)
+                result = aggregation.reduce_rollups(rolled, lo, hi, step, agg)
+                error = max(max_error(result[1], expected[1]), max_error(result[2], expected[2]))
+                if error > TOLERANCE:
+                    failures += 1
+                    print "FAIL %s series, resolution %d, step %d, %s: relative error %g" % (name, resolution, step, agg, error)
+    print "%s series: %d values compared" % (name, len(secs))
+
+print "%d failures" % (failures,)
+sys.exit(1 if failures > 0 else 0)
@@ -4,6 +4,10 @@ import time
 def say(something, more):
     print(time.time(), something, more)
 
+def slow_say(something, more):
+    print(time.time(), something, more)
+    time.sleep(2.5)
+
 sched.start()
 
 sched.once_after(100, say, "it's", "me")
@@ -11,15 +15,24 @@ sched.once_when(int(time.time()*1000 + 200), say, "it's", "me")
 a = sched.repeat_every(5000, say, "Hello", "World")
 b = sched.repeat_o_clock("60s", say, "One", "Minute")
 b = sched.repeat_o_clock_with_offset("60s", 5, say, "One", "Minute plus five")
+d = sched.repeat_every(1000, slow_say, "Slow", "skipped")
+e = sched.repeat_every(1000, slow_say, "Slow", "queued")
+sched.set_overlap_policy(e, sched.OVERLAP_QUEUE)
+f = sched.repeat_every(1000, slow_say, "Slow", "concurrent")
+sched.set_overlap_policy(f, sched.OVERLAP_CONCURRENT)
 
 time.sleep(31)
 
 sched.remove(a)
+sched.remove(d)
+sched.remove(e)
+sched.remove(f)
 print("Removed ", time.time())
 
 c = sched.repeat_o_clock_with_offset(500, 5, say, "something", "funny")
 time.sleep(31)
 print("Stopping", time.time())
+print(sched.get_stats())
 
 sched.stop()
 print("Stopped ", time.time())
@@ -99,9 +99,9 @@ define([
                };
                
                // This function processes all queries in array `options.target`
-               // using the configuration of `options` object. It requests every
-               // query to datasource server and transforms its response into a
-               // time-series expected by Grafana.
+               // using the configuration of `options` object. It requests all
+               // queries to datasource server in one batch and transforms its
+               // response into time-series expected by Grafana.
                RaspimonPandasDatasource.prototype.query = function(options) {
                    console.log('options: ' + JSON.stringify(options));
                    var self = this; // forward declaration
@@ -122,13 +122,13 @@ define([
                        return d.promise;
                    }
                    
-                   var buildQueryUrl = function(topic, aggregator) {
-                       return "/raspimon_pandas/api/pandas/" + aggregator + "/" + topic + "/" + from + "/" + to + "/" + maxDataPoints;
+                   var buildBatchUrl = function() {
+                       return "/raspimon_pandas/api/batch/" + from + "/" + to + "/" + maxDataPoints;
                    };
                    
-                   // chain all promises, one per each element at qs (targets)
-                   var promises = []
-                   _.each(qs, function(q) {
+                   // one target per each element at qs, all of them are
+                   // requested together in a batch
+                   var targets = _.map(qs, function(q) {
                        var funcs_list = [];
                        _.each(q.functions, function(x) {
                            if (x.name) {
@@ -136,14 +136,17 @@ define([
                                funcs_list.push( x.name+"("+ args + ")" );
                            }
                        });
-                       promises.push( self._post(buildQueryUrl(q.topic, q.consolidateby || "last"),
-                                                 funcs_list)
-                                      .then(function(response) {
-                                          return transformToTimeSeries(q, response.data);
-                                      }) );
+                       return {
+                           topic: q.topic,
+                           agg: q.consolidateby || "last",
+                           funcs: funcs_list,
+                       };
                    });
                    
-                   return $q.all(promises).then(function(result) {
+                   return self._post(buildBatchUrl(), targets).then(function(response) {
+                       var result = _.map(qs, function(q, i) {
+                           return transformToTimeSeries(q, response.data[i]);
+                       });
                        // this is the object expected by Grafana
                        return { data: result };
                    });
@@ -0,0 +1,455 @@
+"""Aggregation engine shared by raspimon.py and raspimon_pandas.py.
+
+Time-series are aggregated in keys of `step` seconds, where the key of every
+value is `floor(secs / step) * step`, and every key is reduced to a pair of
+(secs, value) by one of the following operators:
+
+- `first` and `last` take the first or last value of the key.
+- `avg` computes the time-weighted average using trapezoids between
+  consecutive values, placed at the middle of the key values.
+- `sum` computes the time-weighted sum using trapezoids, placed at the middle
+  of the key values.
+- `min` and `max` take the minimum or maximum value, placed at the middle of
+  the key values (at least half a second after the first one).
+
+A key with only one value returns that value. This follows the semantics of
+the JavaScript map-reduce functions used before by the Grafana servers.
+
+Hour documents are fetched with a projection of their time-series fields,
+decoded by `raspi_mon_sys.TimeSeriesCodec` when they are compressed, and
+concatenated into NumPy arrays, so every operator is computed in a vectorised
+way. When the step is at least one minute, it is rounded up to a multiple of
+the coarsest rollup resolution not above it, and keys are computed from the
+GVA2015_rollups collection written by MongoDBHub at that resolution. Keys of
+days or weeks are reduced from the hourly rollups, joining the rollups of
+different hour documents by the trapezoid between them. Rollups are only used
+when they contain all the documents of the queried interval, otherwise
+GVA2015_data is aggregated.
+
+Queries return the keys which overlap the queried interval, so they are aligned
+to multiples of the step and the keys of a sliding window are reused by the
+next request. Keys older than CACHE_SETTLE_TIME are finished and are kept by
+`cache`, a LRU cache keyed by (topic, agg, step) with a contiguous range of
+keys per entry and bounded to CACHE_MAX_BYTES. A request only computes the
+edges which its entry doesn't cover, and the keys which aren't finished yet.
+
+Hour documents are never modified, late values (retried uploads, messages
+after the deadline of their hour, Plugwise backfill) are inserted as new
+documents. So every entry stores the number of documents of its range, which
+is counted again at most every CACHE_VERIFY_PERIOD seconds, dropping the entry
+when it has changed.
+
+`batch_query()` computes many (topic, agg) targets of the same interval. The
+ranges which aren't cached are fetched for all the topics together, with one
+query using `$in` per collection, and the targets are computed in parallel by
+a pool of BATCH_THREADS threads shared by all the requests.
+"""
+import calendar
+import collections
+import datetime
+import multiprocessing.pool
+import numpy as np
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+import raspi_mon_sys.TimeSeriesCodec as TimeSeriesCodec
+
+OPERATORS = [ "first", "last", "avg", "sum", "min", "max" ]
+ROLLUP_RESOLUTIONS = [ 3600, 900, 60 ] # written by MongoDBHub, coarsest first
+PROJECTION = [ "topic", "basetime", "delta_times", "values", "encoding", "data" ]
+CACHE_MAX_BYTES = 64*1024*1024 # memory bound of cached arrays
+CACHE_SETTLE_TIME = 3*3600     # age of keys which aren't changed by new documents
+CACHE_MAX_AGE = 24*3600        # seconds before recomputing a cached entry
+CACHE_VERIFY_PERIOD = 60       # seconds between counts of the documents of an entry
+ENTRY_OVERHEAD = 256           # estimated bytes of an entry besides its arrays
+BATCH_THREADS = 4
+
+def _data_query(topic, lo, hi):
+    """Returns the query of the hour documents with values between lo and hi
+    timestamps."""
+    return {
+        "topic" : topic,
+        "basetime" : { "$gte" : datetime.datetime.utcfromtimestamp(lo // 3600 * 3600),
+                       "$lt" : datetime.datetime.utcfromtimestamp(hi) }
+    }
+
+def fetch_many(col, query):
+    """Returns a dictionary of topic => (secs, values) arrays with all the
+    documents of the query, sorted by secs."""
+    columns = {}
+    for doc in col.find(query, PROJECTION, sort=[ ("basetime",1) ]):
+        b = calendar.timegm(doc["basetime"].utctimetuple())
+        delta_times,doc_values = TimeSeriesCodec.decode_document(doc)
+        secs,values = columns.setdefault(doc["topic"], ([],[]))
+        secs.append( np.asarray(delta_times, dtype=np.float64) + b )
+        values.append( np.asarray(doc_values, dtype=np.float64) )
+    series = {}
+    for topic,(secs,values) in columns.iteritems():
+        secs = np.concatenate(secs)
+        values = np.concatenate(values)
+        # late messages may be stored in a second document of the same hour
+        order = np.argsort(secs, kind="mergesort")
+        series[topic] = (secs[order],values[order])
+    return series
+
+def fetch_series(col, query):
+    """Returns secs and values arrays with all the documents of the query for
+    one topic, sorted by secs."""
+    return fetch_many(col, query).get(query["topic"], (np.empty(0),np.empty(0)))
+
+def __trapezoids(secs, values, starts):
+    """Returns time-weighted sum and covered seconds of every key, given the
+    positions where every key starts."""
+    n = len(secs)
+    area = np.zeros(n)
+    dt = np.zeros(n)
+    # the trapezoid between i-1 and i is stored at i, dropping the ones which
+    # start a key
+    dt[1:] = np.diff(secs)
+    area[1:] = (0.5*values[1:] + 0.5*values[:-1]) * dt[1:]
+    dt[starts] = 0.0
+    area[starts] = 0.0
+    positive = dt > 0.0
+    area = np.where(positive, area, 0.0)
+    dt = np.where(positive, dt, 0.0)
+    return np.add.reduceat(area, starts),np.add.reduceat(dt, starts)
+
+def aggregate(secs, values, step, agg):
+    """Aggregates sorted secs and values arrays in keys of step seconds,
+    returning keys, secs and values arrays of the reduced keys."""
+    if len(secs) == 0: return secs,secs,values
+    keys = np.floor(secs / step) * step
+    starts = np.flatnonzero(np.concatenate(( [True], keys[1:] != keys[:-1] )))
+    ends = np.append(starts[1:], len(secs)) - 1
+    first_secs,last_secs = secs[starts],secs[ends]
+    first,last = values[starts],values[ends]
+    keys = keys[starts]
+    if agg == "first":
+        return keys,first_secs,first
+    elif agg == "last":
+        return keys,last_secs,last
+    elif agg == "avg" or agg == "sum":
+        total,t = __trapezoids(secs, values, starts)
+        total = np.where(total == 0.0, first, total)
+        if agg == "avg": total = total / np.maximum(t, 1.0)
+        result_secs = 0.5*first_secs + 0.5*last_secs
+    elif agg == "min" or agg == "max":
+        func = np.minimum if agg == "min" else np.maximum
+        total = func.reduceat(values, starts)
+        result_secs = first_secs + 0.5*np.maximum(last_secs - first_secs, 1.0)
+    else:
+        raise KeyError(agg)
+    single = starts == ends
+    return keys,np.where(single, first_secs, result_secs),np.where(single, first, total)
+
+def find_rollup_resolution(col, query, topic, step):
+    """Returns the coarsest rollup resolution which divides step, or None when
+    there isn't any or its rollups don't contain every document of the
+    query."""
+    lo = calendar.timegm(query["basetime"]["$gte"].utctimetuple())
+    hi = calendar.timegm(query["basetime"]["$lt"].utctimetuple())
+    return find_rollup_resolutions(col, [ topic ], lo, hi, step)[topic]
+
+def find_rollup_resolutions(col, topics, lo, hi, step):
+    """Returns a dictionary of topic => resolution, as find_rollup_resolution()
+    for the documents between lo and hi timestamps, with one query per
+    collection for all the topics."""
+    result = dict( (topic,None) for topic in topics )
+    for resolution in ROLLUP_RESOLUTIONS:
+        if step % resolution == 0: break
+    else:
+        return result
+    ids = {}
+    for doc in col.find(_data_query({ "$in" : list(topics) }, lo, hi), [ "topic" ]):
+        ids.setdefault(doc["topic"], set()).add(doc["_id"])
+    if len(ids) == 0: return result
+    # the values of a document may be up to one hour after its basetime, and
+    # the _id of a document is unique across topics
+    query = _rollups_query({ "$in" : sorted(ids) }, lo // 3600 * 3600, hi + 3600, resolution)
+    sources = set(col.database["GVA2015_rollups"].distinct("sources", query))
+    for topic,x in ids.iteritems():
+        if x.issubset(sources): result[topic] = resolution
+    return result
+
+def _rollups_query(topic, lo, hi, resolution):
+    return {
+        "topic" : topic,
+        "resolution" : resolution,
+        "time" : { "$gte" : datetime.datetime.utcfromtimestamp(lo // resolution * resolution),
+                   "$lt" : datetime.datetime.utcfromtimestamp(hi) }
+    }
+
+def rollup_query(col, topic, lo, hi, step, resolution, agg):
+    """Aggregates the rollups of the given resolution in keys of step seconds
+    between lo and hi keys, returning keys, secs and values arrays of the
+    reduced keys."""
+    rollups = col.database["GVA2015_rollups"].find(_rollups_query(topic, lo, hi, resolution),
+                                                   sort=[ ("time",1) ])
+    return reduce_rollups(rollups, lo, hi, step, agg)
+
+def reduce_rollups(rollups, lo, hi, step, agg):
+    """Aggregates rollups sorted by time in keys of step seconds between lo and
+    hi keys, the rollups aren't modified. The head of the first rollup of every
+    key is dropped, and consecutive rollups without head (values of different
+    documents) are joined by the trapezoid between them."""
+    groups = []
+    for r in rollups:
+        key = np.floor( r["first"]["secs"] / step ) * step
+        if key < lo or key >= hi: continue
+        head = r.get("head", {})
+        if len(groups) == 0 or groups[-1][0] != key:
+            g = dict(r)
+            g["sum"] -= head.get("sum", 0.0)
+            g["t"]   -= head.get("t", 0.0)
+            groups.append( (key,g) )
+        else:
+            g = groups[-1][1]
+            dt = r["first"]["secs"] - g["last"]["secs"]
+            if dt > 0.0 and head.get("t", 0.0) == 0.0:
+                g["sum"] += (0.5*r["first"]["value"] + 0.5*g["last"]["value"]) * dt
+                g["t"]   += dt
+            g["count"] += r["count"]
+            g["sum"]   += r["sum"]
+            g["t"]     += r["t"]
+            g["min"]    = min(g["min"], r["min"])
+            g["max"]    = max(g["max"], r["max"])
+            g["last"]   = r["last"]
+    result_keys = []
+    result_secs = []
+    result_values = []
+    for key,g in groups:
+        first,last = g["first"],g["last"]
+        secs,value = first["secs"],first["value"]
+        if g["count"] > 1:
+            if agg == "last":
+                secs,value = last["secs"],last["value"]
+            elif agg == "avg" or agg == "sum":
+                value = g["sum"] or first["value"]
+                if agg == "avg": value = value / max(g["t"], 1.0)
+                secs = 0.5*first["secs"] + 0.5*last["secs"]
+            elif agg == "min" or agg == "max":
+                value = g[agg]
+                secs = first["secs"] + 0.5*max(last["secs"] - first["secs"], 1.0)
+            elif agg != "first":
+                raise KeyError(agg)
+        result_keys.append(key)
+        result_secs.append(secs)
+        result_values.append(value)
+    return (np.array(result_keys, dtype=np.float64),
+            np.array(result_secs, dtype=np.float64),
+            np.array(result_values, dtype=np.float64))
+
+class Prefetch(object):
+    """Values of many topics between lo and hi timestamps, fetched with one
+    query per collection, which compute() uses instead of querying every
+    topic."""
+
+    def __init__(self, col, topics, lo, hi, step):
+        self.lo = lo
+        self.hi = hi
+        self.series = {}
+        self.rollups = {}
+        self.resolutions = find_rollup_resolutions(col, topics, lo, hi, step)
+        raw = [ x for x in topics if self.resolutions[x] is None ]
+        rolled = [ x for x in topics if self.resolutions[x] is not None ]
+        if len(raw) > 0:
+            self.series = fetch_many(col, _data_query({ "$in" : raw }, lo, hi))
+        if len(rolled) > 0:
+            query = _rollups_query({ "$in" : rolled }, lo, hi, self.resolutions[rolled[0]])
+            for r in col.database["GVA2015_rollups"].find(query, sort=[ ("time",1) ]):
+                self.rollups.setdefault(r["topic"], []).append(r)
+
+    def covers(self, topic, lo, hi):
+        return topic in self.resolutions and self.lo <= lo and hi <= self.hi
+
+def compute(col, topic, lo, hi, step, agg, prefetch=None):
+    """Returns keys, secs and values arrays of the keys between lo and hi,
+    computed from the values between lo and hi timestamps."""
+    if prefetch is not None and prefetch.covers(topic, lo, hi):
+        resolution = prefetch.resolutions[topic]
+        if resolution is not None:
+            return reduce_rollups(prefetch.rollups.get(topic, []), lo, hi, step, agg)
+        secs,values = prefetch.series.get(topic, (np.empty(0),np.empty(0)))
+    else:
+        query = _data_query(topic, lo, hi)
+        resolution = find_rollup_resolution(col, query, topic, step)
+        if resolution is not None:
+            return rollup_query(col, topic, lo, hi, step, resolution, agg)
+        secs,values = fetch_series(col, query)
+    inside = (secs >= lo) & (secs < hi)
+    return aggregate(secs[inside], values[inside], step, agg)
+
+class _Entry(object):
+    """Finished keys of one (topic, agg, step), covering [lo, hi)."""
+    __slots__ = ("lo", "hi", "keys", "secs", "values", "ndocs", "created", "verified")
+
+    def __init__(self, lo, hi, arrays, ndocs):
+        self.lo = lo
+        self.hi = hi
+        self.keys,self.secs,self.values = arrays
+        self.ndocs = ndocs # documents of the range before computing it
+        self.created = self.verified = time.time()
+
+    def nbytes(self):
+        return self.keys.nbytes + self.secs.nbytes + self.values.nbytes + ENTRY_OVERHEAD
+
+    def slice(self, lo, hi):
+        i,j = np.searchsorted(self.keys, [lo, hi])
+        return self.keys[i:j],self.secs[i:j],self.values[i:j]
+
+class QueryCache(object):
+    """LRU cache of finished keys, keyed by (topic, agg, step) and bounded by
+    the bytes of its arrays."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def peek(self, key):
+        """Returns the entry of key without updating its LRU position, nor hits
+        and misses."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or time.time() - entry.created > CACHE_MAX_AGE: return None
+            return entry
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or time.time() - entry.created > CACHE_MAX_AGE:
+                if entry is not None: self.nbytes -= entry.nbytes()
+                self.misses += 1
+                return None
+            self.__entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None: self.nbytes -= old.nbytes()
+            self.__entries[key] = entry
+            self.nbytes += entry.nbytes()
+            while self.nbytes > self.max_bytes and len(self.__entries) > 0:
+                _,old = self.__entries.popitem(last=False)
+                self.nbytes -= old.nbytes()
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.nbytes = 0
+
+cache = QueryCache(CACHE_MAX_BYTES)
+__pool = multiprocessing.pool.ThreadPool(BATCH_THREADS)
+
+def __concatenate(*parts):
+    return tuple( np.concatenate([ x[i] for x in parts ]) for i in range(3) )
+
+def __finished(hi, step):
+    return min(hi, np.floor( (time.time() - CACHE_SETTLE_TIME) / step ) * step)
+
+def __count_documents(col, topic, lo, hi):
+    return col.count(_data_query(topic, lo, hi))
+
+def __verified(col, topic, entry):
+    """Returns True when the documents of the entry range haven't changed."""
+    now = time.time()
+    if now - entry.verified < CACHE_VERIFY_PERIOD: return True
+    if __count_documents(col, topic, entry.lo, entry.hi) != entry.ndocs: return False
+    entry.verified = now
+    return True
+
+def __reusable(col, topic, entry, lo, finished):
+    return (entry is not None and entry.hi >= lo and entry.lo <= finished and
+            __verified(col, topic, entry))
+
+def uncached_ranges(col, topic, lo, hi, step, agg):
+    """Returns the (lo, hi) ranges which cached_compute() would compute."""
+    finished = __finished(hi, step)
+    if finished <= lo: return [ (lo,hi) ]
+    entry = cache.peek( (topic, agg, step) )
+    if not __reusable(col, topic, entry, lo, finished): return [ (lo,hi) ]
+    ranges = [ (finished,hi) ] if finished < hi else []
+    if lo < entry.lo: ranges.append( (lo,entry.lo) )
+    if entry.hi < finished: ranges.append( (entry.hi,finished) )
+    return ranges
+
+def cached_compute(col, topic, lo, hi, step, agg, prefetch=None):
+    """As compute(), but finished keys are taken from the cache, computing only
+    the edges which it doesn't cover and the keys which aren't finished."""
+    finished = __finished(hi, step)
+    if finished <= lo: return compute(col, topic, lo, hi, step, agg, prefetch)
+    key = (topic, agg, step)
+    entry = cache.get(key)
+    if not __reusable(col, topic, entry, lo, finished):
+        entry = None
+    else:
+        new_lo,new_hi = min(lo, entry.lo),max(finished, entry.hi)
+        if new_lo < entry.lo or new_hi > entry.hi:
+            # the cached keys must be up to date before extending them
+            if __count_documents(col, topic, entry.lo, entry.hi) != entry.ndocs:
+                entry = None
+            else:
+                ndocs = __count_documents(col, topic, new_lo, new_hi)
+    if entry is None:
+        # nothing to reuse, the entry is replaced by this range
+        ndocs = __count_documents(col, topic, lo, finished)
+        entry = _Entry(lo, finished, compute(col, topic, lo, finished, step, agg, prefetch), ndocs)
+    else:
+        parts = []
+        if lo < entry.lo: parts.append( compute(col, topic, lo, entry.lo, step, agg, prefetch) )
+        parts.append( (entry.keys, entry.secs, entry.values) )
+        if entry.hi < finished:
+            parts.append( compute(col, topic, entry.hi, finished, step, agg, prefetch) )
+        if len(parts) > 1:
+            entry = _Entry(new_lo, new_hi, __concatenate(*parts), ndocs)
+    cache.put(key, entry)
+    result = entry.slice(lo, finished)
+    if finished < hi:
+        result = __concatenate(result, compute(col, topic, finished, hi, step, agg, prefetch))
+    return result
+
+def __keys_range(start, stop, max_data_points):
+    """Returns the step and the (lo, hi) keys of a query. Steps of at least one
+    minute are rounded up to a multiple of a rollup resolution."""
+    step = (stop - start) / max_data_points
+    if step < 1.0: step = 1.0
+    for resolution in ROLLUP_RESOLUTIONS:
+        if resolution <= step:
+            step = int(np.ceil(step / float(resolution))) * resolution
+            break
+    return step,np.floor( start / step ) * step,np.floor( stop / step ) * step + step
+
+def query(col, topic, start, stop, max_data_points, agg):
+    """Returns secs and values arrays with the aggregation of topic in the keys
+    which overlap start and stop timestamps, with at most max_data_points
+    keys."""
+    if agg not in OPERATORS: raise KeyError(agg)
+    step,lo,hi = __keys_range(start, stop, max_data_points)
+    keys,secs,values = cached_compute(col, topic, lo, hi, step, agg)
+    return secs,values
+
+def batch_query(col, targets, start, stop, max_data_points):
+    """Returns a list with secs and values arrays of every (topic, agg) target,
+    as done by query()."""
+    for topic,agg in targets:
+        if agg not in OPERATORS: raise KeyError(agg)
+    if len(targets) == 0: return []
+    step,lo,hi = __keys_range(start, stop, max_data_points)
+    ranges = [ r for topic,agg in targets for r in uncached_ranges(col, topic, lo, hi, step, agg) ]
+    prefetch = None
+    if len(ranges) > 0:
+        topics = sorted(set( topic for topic,agg in targets ))
+        prefetch = Prefetch(col, topics, min(x[0] for x in ranges), max(x[1] for x in ranges), step)
+    def run(target):
+        keys,secs,values = cached_compute(col, target[0], lo, hi, step, target[1], prefetch)
+        return secs,values
+    if len(targets) == 1: return [ run(targets[0]) ]
+    return __pool.map(run, targets)
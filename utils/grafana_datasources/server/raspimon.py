@@ -12,119 +12,54 @@ API with following commands:
 - `/raspimon/api/aggregate/<agg>/<topic>/<from>/<to>/<max>` returns a JSON array
   with the time-series aggregation for given `<topic>` name in the time interval
   `<from>-<to>` given as timestamps. The size of the returned array will be at
-  most `<max>`.
-
+  most `<max>`. Aggregators not in `/raspimon/api/aggregators` are answered with
+  status 400.
+- `/raspimon/api/batch/<from>/<to>/<max>` receives via POST a JSON array of
+  `{ "topic" : ..., "agg" : ... }` targets and returns a JSON array with the
+  time-series aggregation of every target, as done by `/raspimon/api/aggregate`.
+  Malformed targets or aggregators not in `/raspimon/api/aggregators` are
+  answered with status 400.
+
+Aggregations are computed by the NumPy engine of `aggregation.py`, from the
+GVA2015_rollups collection when possible, or from the hour documents of
+GVA2015_data, compressed or not.
 """
 import datetime
 import json
 import logging
 import pymongo
+import threading
 import time
 
 from flask import Flask, request
 from logging.handlers import RotatingFileHandler
 
+import aggregation
+
 app = Flask(__name__)
 
 IN_DEBUG=True
 MONGO_HOST = "localhost"
 MONGO_PORT = 27018
+MONGO_POOL_SIZE = 10
+AGGREGATORS = [ "first", "last", "avg", "min", "max" ]
 
-mapfn = """function() {{
-    period = {0};
-    b = this.basetime;
-    for(i=0; i<this.values.length; ++i) {{
-        secs = b.getTime()/1000.0 + this.delta_times[i];
-        key  = Math.floor( secs / period ) * period;
-        emit(key, {{ secs: secs, value: this.values[i] }});
-    }}
-}}"""
-
-take_one_reducefn = """function(key,values) {{
-    values.sort(function(a,b) {{ return a.secs - b.secs; }});
-    return {{ secs:values[{0}].secs, value: values[{0}].value }};
-}}"""
-
-avg_reducefn = """function(key,values) {{
-    values.sort(function(a,b) {{ return a.secs - b.secs; }});
-    sum = 0.0;
-    t = 0.0;
-    for(i=1; i<values.length; ++i) {{
-        dt = values[i].secs - values[i-1].secs;
-        if (dt > 0.0) {{
-            value = 0.5*values[i].value + 0.5*values[i-1].value;
-            sum  += value * dt;
-            t    += dt;
-        }}
-    }}
-    if (t < 1.0) t = 1.0;
-    if (sum == 0.0) sum = values[0].value;
-    return {{ secs: 0.5*values[0].secs + 0.5*values[values.length-1].secs, value: sum/t }};
-}}"""
-
-sum_reducefn = """function(key,values) {{
-    values.sort(function(a,b) {{ return a.secs - b.secs; }});
-    sum = 0.0;
-    t = 0.0;
-    for(i=1; i<values.length; ++i) {{
-        dt = values[i].secs - values[i-1].secs;
-        if (dt > 0.0) {{
-            value = 0.5*values[i].value + 0.5*values[i-1].value;
-            sum  += value * dt;
-            t    += dt;
-        }}
-    }}
-    if (t < 1.0) t = 1.0;
-    if (sum == 0.0) sum = values[0].value;
-    return {{ secs: values[values.length-1].secs, value: sum }};
-}}"""
-
-generic_math_reducefn = """function(key,values) {{
-    values.sort(function(a,b) {{ return a.secs - b.secs; }});
-    result = values[0].value;
-    t = 0.0;
-    for(i=1; i<values.length; ++i) {{
-        secs   = values[i].secs;
-        value  = values[i].value;
-        dt     = secs - values[i-1].secs;
-        result = Math.{0}(result, value);
-        t     += dt;
-    }}
-    if (t < 1.0) t = 1.0;
-    return {{ secs: values[0].secs + t*0.5, value: result }};
-}}"""
-
-reduce_operators = {
-    "first" : [ take_one_reducefn, 0 ],
-    "last" : [ take_one_reducefn, "values.length-1" ],
-    #"sum" : [ sum_reducefn ],
-    "avg" : [ avg_reducefn ],
-    "min" : [ generic_math_reducefn, "min" ],
-    "max" : [ generic_math_reducefn, "max" ]
-}
-
-def build_mapfn(step): return mapfn.format(step)
-
-def build_reducefn(agg):
-    func = reduce_operators[agg][0]
-    params = reduce_operators[agg][1:]
-    return func.format(*params)
+mongo_client = None
+mongo_client_lock = threading.Lock()
 
 def connect():
-    client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT)
-    db = client["raspimon"]
+    """Returns the client shared by all requests, its connections are pooled."""
+    global mongo_client
+    with mongo_client_lock:
+        if mongo_client is None:
+            mongo_client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT,
+                                               maxPoolSize=MONGO_POOL_SIZE)
+    db = mongo_client["raspimon"]
     collection = db["GVA2015_data"]
-    return (client,collection)
-
-def transform_to_time_series(data):
-    if len(data) == 0: return []
-    if len(data) == 1: return [ [data[0]["value"]["value"],data[0]["value"]["secs"]] ]
-    result = []
-    for pair in data:
-        p   = pair["value"]
-        k,v = p["secs"],p["value"]
-        result.append([v,k])
-    return result
+    return (mongo_client,collection)
+
+def transform_to_time_series(secs, values):
+    return [ [v,k] for k,v in zip(secs.tolist(), values.tolist()) ]
 
 def get_topics(filters=None):
     client,col = connect()
@@ -143,30 +78,30 @@ def get_topics(filters=None):
         if filters is not None and type(filters) is list and len(filters) > 0:
             topics = [ x for x in topics if any([x.find(y)!=-1 for y in filters]) ]
     topics = filter(lambda x: not x.startswith("forecast"), topics)
-    client.close()
     return topics
 
 def mapreduce_query(topic, start, stop, max_data_points, agg):
     client,col = connect()
-    query = {
-        "topic" : topic,
-        "basetime" : { "$gte" : datetime.datetime.utcfromtimestamp(start),
-                       "$lte" : datetime.datetime.utcfromtimestamp(stop) }
-    }
-    step = (stop - start) / max_data_points;
-    if step < 1.0: step = 1.0;
-    query_mapfn = build_mapfn(step)
-    query_reducefn = build_reducefn(agg)
-    data = col.inline_map_reduce(query_mapfn,
-                                 query_reducefn,
-                                 full_response=False,
-                                 query=query,
-                                 sort={"topic":1,"basetime":1})
-    client.close()
-    #data.sort(key=lambda x: x["_id"])
-    result = transform_to_time_series(data)
+    secs,values = aggregation.query(col, topic, start, stop, max_data_points, agg)
+    result = transform_to_time_series(secs, values)
     return result
 
+def valid_targets(targets):
+    """Returns True when targets is a list of { "topic" : ..., "agg" : ... }
+    objects with a topic string and one of AGGREGATORS."""
+    if not isinstance(targets, list): return False
+    for x in targets:
+        if not isinstance(x, dict) or not isinstance(x.get("topic"), basestring) or \
+           x.get("agg") not in AGGREGATORS:
+            return False
+    return True
+
+def batch_query(targets, start, stop, max_data_points):
+    client,col = connect()
+    results = aggregation.batch_query(col, [ (x["topic"],x["agg"]) for x in targets ],
+                                      start, stop, max_data_points)
+    return [ transform_to_time_series(secs, values) for secs,values in results ]
+
 @app.route("/raspimon/api/topics")
 def http_get_topics():
     return json.dumps( get_topics() )
@@ -178,14 +113,23 @@ def http_post_topics_filtered():
 
 @app.route("/raspimon/api/aggregators")
 def http_get_aggregators():
-    return json.dumps( reduce_operators.keys() );
+    return json.dumps( AGGREGATORS );
 
 # http://localhost:5000/raspimon/api/aggregate/last/raspimon:b827eb7c62d8:rfemon:10:6:vrms1:value/0/1448193433/100
 
 @app.route('/raspimon/api/aggregate/<string:agg>/<string:topic>/<int:start>/<int:stop>/<int:max_data_points>')
 def http_get_aggregation_query(agg, topic, start, stop, max_data_points):
+    if agg not in AGGREGATORS:
+        return json.dumps( { "error" : "Unknown aggregator " + agg } ),400
     return json.dumps( mapreduce_query(topic, start, stop, max_data_points, agg) )
 
+@app.route('/raspimon/api/batch/<int:start>/<int:stop>/<int:max_data_points>', methods=["POST"])
+def http_post_batch_query(start, stop, max_data_points):
+    targets = request.get_json(force=True)
+    if not valid_targets(targets):
+        return json.dumps( { "error" : "Expected an array of topic and aggregator targets" } ),400
+    return json.dumps( batch_query(targets, start, stop, max_data_points) )
+
 if __name__ == "__main__":
     app.debug = IN_DEBUG
     if not IN_DEBUG:
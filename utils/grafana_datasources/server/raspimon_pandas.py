@@ -1,6 +1,12 @@
 #!/usr/bin/env python2.7
 """This is a bit more complicated module, similar to raspimon.py but allowing to
 incorporate complex statistics using numpy and pandas.
+
+Aggregations are computed by the NumPy engine of `aggregation.py`, as done in
+raspimon.py. `/raspimon_pandas/api/batch/<from>/<to>/<max>` receives via POST
+a JSON array of `{ "topic" : ..., "agg" : ..., "funcs" : [ ... ] }` targets and
+returns a JSON array with the processed time-series of every target, fetching
+all of them together. Malformed targets are answered with status 400.
 """
 import datetime
 import json
@@ -11,6 +17,7 @@ import pandas as pd
 import pymongo
 import pytz
 import re
+import threading
 import time
 
 from pandas import Series
@@ -18,81 +25,15 @@ from pandas import Series
 from flask import Flask, request
 from logging.handlers import RotatingFileHandler
 
+import aggregation
+
 app = Flask(__name__)
 
 IN_DEBUG=True
 MONGO_HOST = "localhost"
 MONGO_PORT = 27018
-
-mapfn = """function() {{
-    period = {0};
-    b = this.basetime;
-    for(i=0; i<this.values.length; ++i) {{
-        secs = b.getTime()/1000.0 + this.delta_times[i];
-        key  = Math.floor( secs / period ) * period;
-        emit(key, {{ secs: secs, value: this.values[i] }});
-    }}
-}}"""
-
-take_one_reducefn = """function(key,values) {{
-    values.sort(function(a,b) {{ return a.secs - b.secs; }});
-    return {{ secs:values[{0}].secs, value: values[{0}].value }};
-}}"""
-
-avg_reducefn = """function(key,values) {{
-    values.sort(function(a,b) {{ return a.secs - b.secs; }});
-    sum = 0.0;
-    t = 0.0;
-    for(i=1; i<values.length; ++i) {{
-        dt = values[i].secs - values[i-1].secs;
-        if (dt > 0.0) {{
-            value = 0.5*values[i].value + 0.5*values[i-1].value;
-            sum  += value * dt;
-            t    += dt;
-        }}
-    }}
-    if (t < 1.0) t = 1.0;
-    if (sum == 0.0) sum = values[0].value;
-    return {{ secs: 0.5*values[0].secs + 0.5*values[values.length-1].secs, value: sum/t }};
-}}"""
-
-sum_reducefn = """function(key,values) {{
-    values.sort(function(a,b) {{ return a.secs - b.secs; }});
-    sum = 0.0;
-    for(i=1; i<values.length; ++i) {{
-        dt = values[i].secs - values[i-1].secs;
-        if (dt > 0.0) {{
-            value = 0.5*values[i].value + 0.5*values[i-1].value;
-            sum  += value * dt;
-        }}
-    }}
-    if (sum == 0.0) sum = values[0].value;
-    return {{ secs: 0.5*values[0].secs + 0.5*values[values.length-1].secs, value: sum }};
-}}"""
-
-generic_math_reducefn = """function(key,values) {{
-    values.sort(function(a,b) {{ return a.secs - b.secs; }});
-    result = values[0].value;
-    t = 0.0;
-    for(i=1; i<values.length; ++i) {{
-        secs   = values[i].secs;
-        value  = values[i].value;
-        dt     = secs - values[i-1].secs;
-        result = Math.{0}(result, value);
-        t     += dt;
-    }}
-    if (t < 1.0) t = 1.0;
-    return {{ secs: values[0].secs + t*0.5, value: result }};
-}}"""
-
-reduce_operators = {
-    "first" : [ take_one_reducefn, 0 ],
-    "last" : [ take_one_reducefn, "values.length-1" ],
-    "sum" : [ sum_reducefn ],
-    "avg" : [ avg_reducefn ],
-    "min" : [ generic_math_reducefn, "min" ],
-    "max" : [ generic_math_reducefn, "max" ]
-}
+MONGO_POOL_SIZE = 10
+AGGREGATORS = aggregation.OPERATORS
 
 class MySeries:
     def __init__(self, *args, **kwargs):
@@ -208,34 +149,25 @@ class MySeries:
     def replace(self, *args, **kwargs):
         return MySeries(self.x.replace(*args, **kwargs))
     
-def build_mapfn(step): return mapfn.format(step)
 
-def build_reducefn(agg):
-    func = reduce_operators[agg][0]
-    params = reduce_operators[agg][1:]
-    return func.format(*params)
+mongo_client = None
+mongo_client_lock = threading.Lock()
 
 def connect():
-    client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT)
-    db = client["raspimon"]
+    """Returns the client shared by all requests, its connections are pooled."""
+    global mongo_client
+    with mongo_client_lock:
+        if mongo_client is None:
+            mongo_client = pymongo.MongoClient(MONGO_HOST, MONGO_PORT,
+                                               maxPoolSize=MONGO_POOL_SIZE)
+    db = mongo_client["raspimon"]
     collection = db["GVA2015_data"]
-    return (client,collection)
+    return (mongo_client,collection)
 
-def transform_to_time_series(data):
+def transform_to_time_series(secs, values):
     tz = pytz.timezone("Europe/Madrid")
-    if len(data) == 0: return MySeries(np.array([]))
-    if len(data) == 1:
-        idx = np.array([ datetime.datetime.fromtimestamp(data[0]["value"]["secs"],tz) ])
-        ts = np.array([data[0]["value"]["value"]])
-        return MySeries(ts, index=idx)
-    idx = []
-    ts = []
-    for pair in data:
-        p = pair["value"]
-        dt = datetime.datetime.fromtimestamp(p["secs"],tz)
-        idx.append( dt )
-        ts.append( p["value"] )
-    return MySeries(np.array(ts), index=np.array(idx))
+    idx = np.array([ datetime.datetime.fromtimestamp(x,tz) for x in secs.tolist() ])
+    return MySeries(values, index=idx)
 
 def get_topics(filters=None):
     client,col = connect()
@@ -254,33 +186,34 @@ def get_topics(filters=None):
         if filters is not None and type(filters) is list and len(filters) > 0:
             topics = [ x for x in topics if any([x.find(y)!=-1 for y in filters]) ]
     topics = filter(lambda x: not x.startswith("forecast"), topics)
-    client.close()
     return topics
 
 def mapreduce_query(topic, start, stop, max_data_points, agg):
     client,col = connect()
-    query = {
-        "topic" : topic,
-        "basetime" : { "$gte" : datetime.datetime.utcfromtimestamp(start),
-                       "$lte" : datetime.datetime.utcfromtimestamp(stop) }
-    }
-    step = (stop - start) / max_data_points;
-    if step < 1.0: step = 1.0;
-    query_mapfn = build_mapfn(step)
-    query_reducefn = build_reducefn(agg)
-    data = col.inline_map_reduce(query_mapfn,
-                                 query_reducefn,
-                                 full_response=False,
-                                 query=query,
-                                 sort={"topic":1,"basetime":1})
-    client.close()
-    #data.sort(key=lambda x: x["_id"])
-    result = transform_to_time_series(data)
+    secs,values = aggregation.query(col, topic, start, stop, max_data_points, agg)
+    result = transform_to_time_series(secs, values)
     return result
 
 #def series(topic, start, stop, max_data_points, agg):
 #    return mapreduce_query(topic, start, stop, max_data_points, agg)
 
+def valid_targets(targets):
+    """Returns True when targets is a list of { "topic" : ..., "agg" : ... }
+    objects with a topic string, one of AGGREGATORS and an optional list of
+    funcs."""
+    if not isinstance(targets, list): return False
+    for x in targets:
+        if not isinstance(x, dict) or not isinstance(x.get("topic"), basestring) or \
+           x.get("agg") not in AGGREGATORS or not isinstance(x.get("funcs", []), list):
+            return False
+    return True
+
+def batch_query(targets, start, stop, max_data_points):
+    client,col = connect()
+    results = aggregation.batch_query(col, [ (x["topic"],x["agg"]) for x in targets ],
+                                      start, stop, max_data_points)
+    return [ transform_to_time_series(secs, values) for secs,values in results ]
+
 def to_grafana_time_series(s):
     def filt(x):
         try:
@@ -313,7 +246,7 @@ def http_post_topics_filtered():
 
 @app.route("/raspimon_pandas/api/aggregators")
 def http_get_aggregators():
-    return json.dumps( reduce_operators.keys() );
+    return json.dumps( AGGREGATORS );
 
 # http://localhost:5000/raspimon_pandas/api/aggregate/last/raspimon:b827eb7c62d8:rfemon:10:6:vrms1:value/0/1448193433/100
 
@@ -327,6 +260,15 @@ def http_get_pandas_query(agg, topic, start, stop, max_data_points):
     ts = mapreduce_query(topic, start, stop, max_data_points, agg)
     return json.dumps( to_grafana_time_series( process_series(ts, funcs) ) )
 
+@app.route('/raspimon_pandas/api/batch/<int:start>/<int:stop>/<int:max_data_points>', methods=["POST"])
+def http_post_batch_query(start, stop, max_data_points):
+    targets = request.get_json(force=True)
+    if not valid_targets(targets):
+        return json.dumps( { "error" : "Expected an array of topic and aggregator targets" } ),400
+    series = batch_query(targets, start, stop, max_data_points)
+    return json.dumps( [ to_grafana_time_series( process_series(ts, x.get("funcs", [])) )
+                         for x,ts in zip(targets, series) ] )
+
 if __name__ == "__main__":
     app.debug = IN_DEBUG
     if not IN_DEBUG: